@@ -2,15 +2,16 @@ import os
 import pandas as pd
 import numpy as np
 import math
-from torch.utils.data import Dataset, ConcatDataset, DataLoader
+from torch.utils.data import ConcatDataset, DataLoader
 from torchvision.io import read_image
 from torchvision import transforms, datasets
-from PIL import Image
 import PIL
 from tqdm import tqdm
 
-class CustomBachDataset(Dataset):
-    def __init__(self, img_dir, train = False, transform=None, target_transform=None, download=False):
+from datasets.image_cache import CachedImageDataset
+
+class CustomBachDataset(CachedImageDataset):
+    def __init__(self, img_dir, train = False, transform=None, target_transform=None, download=False, cache_size=None, cache_dir='./misc/image_cache'):
         # Random seed
         random_state = 42
         # Read in csv containing path information
@@ -29,10 +30,17 @@ class CustomBachDataset(Dataset):
         self.img_dir = img_dir
         self.transform = transform
         self.target_transform = target_transform
+        # Read the images from the pre-resized image cache (see datasets/image_cache.py)
+        self.init_image_cache(img_dir, cache_size, cache_dir)
 
     def __len__(self):
         return len(self.img_labels)
 
+    @property
+    def targets(self):
+        """Class label of every image, read from the label columns without loading any image"""
+        return self.img_labels.map({"Normal": 0, "Benign": 1, "InSitu": 2, "Invasive": 3}).to_numpy()
+
     def __getitem__(self, idx):
         # Extract label
         label_name = self.img_labels.iloc[idx] 
@@ -48,9 +56,9 @@ class CustomBachDataset(Dataset):
         else:
             raise ValueError
         # Get full image path
-        img_path = os.path.join(os.path.join(self.img_dir,"ICIAR2018_BACH_Challenge/Photos/"+label_name),self.img_paths.iloc[idx])
+        img_path = self.image_path(idx)
         # Load in RGB image
-        image = Image.open(img_path)
+        image = self.load_image(img_path)
         # Convert to appropriate format
         label = np.float32(label)
         # Apply transformations
@@ -60,6 +68,11 @@ class CustomBachDataset(Dataset):
             label = self.target_transform(label)
         return image, label
 
+    def image_path(self, idx):
+        """Full path of image idx"""
+        label_name = self.img_labels.iloc[idx]
+        return os.path.join(os.path.join(self.img_dir,"ICIAR2018_BACH_Challenge/Photos/"+label_name),self.img_paths.iloc[idx])
+
     def _split_labels(self,dataframe):
         """Split Ch dataframe into path, aux and label dataframes"""
         path = dataframe.iloc[:,0]
@@ -2,16 +2,16 @@ import os
 import pandas as pd
 import numpy as np
 import math
-from torch.utils.data import Dataset
 from torchvision.io import read_image
 import torchvision.transforms as transforms
-from PIL import Image
 
 # Most of this class has been taken from https://github.com/linusericsson/ssl-transfer/tree/main/datasets/chestx.py
 # We change the arguments to match with the rest of our datasets and
 # add a train/test split
-class CustomChestXDataset(Dataset):
-    def __init__(self, img_dir, train = False, transform=None, target_transform=None, download=False):
+from datasets.image_cache import CachedImageDataset
+
+class CustomChestXDataset(CachedImageDataset):
+    def __init__(self, img_dir, train = False, transform=None, target_transform=None, download=False, cache_size=None, cache_dir='./misc/image_cache'):
         """
         Args:
             img_dir (string): path to dataset
@@ -58,13 +58,13 @@ class CustomChestXDataset(Dataset):
 
         self.image_name = np.asarray(self.image_name)
         self.labels = np.asarray(self.labels)        
+        # Read the images from the pre-resized image cache (see datasets/image_cache.py)
+        self.init_image_cache(img_dir, cache_size, cache_dir)
 
     def __getitem__(self, index):
-        # Get image name from the pandas df
-        single_image_name = self.image_name[index]
         # Open image
-        img_path = os.path.join(self.img_path, single_image_name)
-        img = Image.open(img_path).convert('RGB')
+        img_path = self.image_path(index)
+        img = self.load_image(img_path)
 
         # Transform
         if self.transform:
@@ -81,6 +81,15 @@ class CustomChestXDataset(Dataset):
     def __len__(self):
         return self.data_len
 
+    def image_path(self, index):
+        """Full path of image index"""
+        return os.path.join(self.img_path, self.image_name[index])
+
+    @property
+    def targets(self):
+        """Class label of every image, read from the label columns without loading any image"""
+        return self.labels
+
 def test_class():
     cid = CustomChestXDataset("/vol/bitbucket/g21mscprj03/SSL/data/chestx", train = True)
     print(cid[40])
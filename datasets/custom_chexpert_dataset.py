@@ -2,12 +2,12 @@ import os
 import pandas as pd
 import numpy as np
 import math
-from torch.utils.data import Dataset
 from torchvision.io import read_image
-from PIL import Image
 
-class CustomChexpertDataset(Dataset):
-    def __init__(self, img_dir, train = False, transform=None, target_transform=None, download=False, focus = "Pleural Effusion",few_shot = False, group_front_lateral = False):
+from datasets.image_cache import CachedImageDataset
+
+class CustomChexpertDataset(CachedImageDataset):
+    def __init__(self, img_dir, train = False, transform=None, target_transform=None, download=False, focus = "Pleural Effusion",few_shot = False, group_front_lateral = False, cache_size=None, cache_dir='./misc/image_cache'):
         # Random seed
         random_state = 42
         # Read in csv containing path information
@@ -32,6 +32,8 @@ class CustomChexpertDataset(Dataset):
         self.img_dir = img_dir
         self.transform = transform
         self.target_transform = target_transform
+        # Read the images from the pre-resized image cache (see datasets/image_cache.py)
+        self.init_image_cache(img_dir, cache_size, cache_dir)
         # Specify label for many to one
         try:
             self.many_to_one_label = ["Atelectasis", "Cardiomegaly", "Consolidation","Edema", "Pleural Effusion"].index(focus)
@@ -41,11 +43,16 @@ class CustomChexpertDataset(Dataset):
     def __len__(self):
         return len(self.img_labels)
 
+    @property
+    def targets(self):
+        """Class label of every image, read from the label columns without loading any image"""
+        return self.img_labels.iloc[:, self.many_to_one_label].to_numpy()
+
     def __getitem__(self, idx):
         # Create full image path
-        img_path = os.path.join(self.img_dir, self.img_paths.iloc[idx])
+        img_path = self.image_path(idx)
         # Open image with PIL, stack grayscale images to create 3 channel
-        image = Image.open(img_path).convert('RGB')
+        image = self.load_image(img_path)
         # Extract the full label of image
         multi_label = self.img_labels.iloc[idx]
         # Convert to many to one label
@@ -63,6 +70,10 @@ class CustomChexpertDataset(Dataset):
             image = (image,image2)
         return image, label
     
+    def image_path(self, idx):
+        """Full path of image idx"""
+        return os.path.join(self.img_dir, self.img_paths.iloc[idx])
+
     def group_additional_images(self, img_path):
         """ Find the frontal image associated with given lateral image
 
@@ -78,7 +89,7 @@ class CustomChexpertDataset(Dataset):
         path_list[-1] = "view1_frontal.jpg"
         img_path = "/".join(path_list)
         # open Image object
-        image = Image.open(img_path).convert('RGB')
+        image = self.load_image(img_path)
         # apply any given transformations
         if self.transform:
             image = self.transform(image)
@@ -5,15 +5,16 @@ import math
 from tqdm import tqdm
 
 import torch
-from torch.utils.data import Dataset, ConcatDataset, DataLoader
+from torch.utils.data import ConcatDataset, DataLoader
 from torchvision.io import read_image
 from torchvision import transforms, datasets
 import PIL
-from PIL import Image
 import pickle
 
-class CustomDiabeticRetinopathyDataset(Dataset):
-    def __init__(self, img_dir, train = False, transform=None, target_transform=None, download=False, group_front_lateral = False):
+from datasets.image_cache import CachedImageDataset
+
+class CustomDiabeticRetinopathyDataset(CachedImageDataset):
+    def __init__(self, img_dir, train = False, transform=None, target_transform=None, download=False, group_front_lateral = False, cache_size=None, cache_dir='./misc/image_cache'):
         # Random seed
         random_state = 42
         # Load the appropriate csv file
@@ -36,15 +37,22 @@ class CustomDiabeticRetinopathyDataset(Dataset):
         self.img_paths, self.img_labels = self._basic_preclean(self.preclean_dataframe) 
         self.transform = transform
         self.target_transform = target_transform
+        # Read the images from the pre-resized image cache (see datasets/image_cache.py)
+        self.init_image_cache(img_dir, cache_size, cache_dir)
 
     def __len__(self):
         return len(self.img_labels)
 
+    @property
+    def targets(self):
+        """Class label of every image, read from the label columns without loading any image"""
+        return self.img_labels.to_numpy()
+
     def __getitem__(self, idx):
         # Get full path
-        img_path = os.path.join(self.img_dir, self.img_paths.iloc[idx]+".jpeg")
+        img_path = self.image_path(idx)
         # Open RGB image
-        image = Image.open(img_path)
+        image = self.load_image(img_path)
         # Extract label
         label = self.img_labels.iloc[idx]
         # Convert to correct format
@@ -60,6 +68,10 @@ class CustomDiabeticRetinopathyDataset(Dataset):
             image = (image,image2)
         return image, label
     
+    def image_path(self, idx):
+        """Full path of image idx"""
+        return os.path.join(self.img_dir, self.img_paths.iloc[idx]+".jpeg")
+
     def group_additional_images(self, img_path):
         """ Find the right eye image associated with given left eye image
 
@@ -75,7 +87,7 @@ class CustomDiabeticRetinopathyDataset(Dataset):
         path_list[-1] = number+"_right.jpeg"
         img_path = "/".join(path_list)
         # Open image
-        image = Image.open(img_path)
+        image = self.load_image(img_path)
         # Apply transformation
         if self.transform:
             image = self.transform(image)
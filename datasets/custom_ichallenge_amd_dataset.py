@@ -2,12 +2,12 @@ import os
 import pandas as pd
 import numpy as np
 import math
-from torch.utils.data import Dataset
 from torchvision.io import read_image
-from PIL import Image
 
-class CustomiChallengeAMDDataset(Dataset):
-    def __init__(self, img_dir, train = False, transform=None, target_transform=None, download=False):
+from datasets.image_cache import CachedImageDataset
+
+class CustomiChallengeAMDDataset(CachedImageDataset):
+    def __init__(self, img_dir, train = False, transform=None, target_transform=None, download=False, cache_size=None, cache_dir='./misc/image_cache'):
         # Random seed
         random_state = 42
         # Read in csv containing path information
@@ -26,23 +26,26 @@ class CustomiChallengeAMDDataset(Dataset):
         self.img_dir = img_dir
         self.transform = transform
         self.target_transform = target_transform
+        # Read the images from the pre-resized image cache (see datasets/image_cache.py)
+        self.init_image_cache(img_dir, cache_size, cache_dir)
 
     def __len__(self):
         return len(self.img_labels)
 
+    @property
+    def targets(self):
+        """Class label of every image, read from the label columns without loading any image"""
+        return self.img_labels.to_numpy()
+
     def __getitem__(self, idx):
         # Get associated label 
         label = self.img_labels.iloc[idx]
         # Convert to correct form 
         label = np.float32(label)
         # Get image path
-        if math.isclose(label, 1.0):
-            img_path = os.path.join(self.img_dir,"Training400/AMD/")
-        else:
-            img_path = os.path.join(self.img_dir,"Training400/Non-AMD/")
-        img_path = os.path.join(img_path,self.img_paths.iloc[idx]+".jpg")
+        img_path = self.image_path(idx)
         # Load in RGB image
-        image = Image.open(img_path)
+        image = self.load_image(img_path)
         # Apply transformations
         if self.transform:
             image = self.transform(image)
@@ -50,6 +53,14 @@ class CustomiChallengeAMDDataset(Dataset):
             label = self.target_transform(label)
         return image, label
     
+    def image_path(self, idx):
+        """Full path of image idx"""
+        if math.isclose(np.float32(self.img_labels.iloc[idx]), 1.0):
+            img_path = os.path.join(self.img_dir,"Training400/AMD/")
+        else:
+            img_path = os.path.join(self.img_dir,"Training400/Non-AMD/")
+        return os.path.join(img_path,self.img_paths.iloc[idx]+".jpg")
+
     def _split_labels(self,dataframe):
         """Split dataframe into path, aux and label dataframes"""
         path = dataframe.iloc[:,0]
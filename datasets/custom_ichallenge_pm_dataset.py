@@ -2,12 +2,12 @@ import os
 import pandas as pd
 import numpy as np
 import math
-from torch.utils.data import Dataset
 from torchvision.io import read_image
-from PIL import Image
 
-class CustomiChallengePMDataset(Dataset):
-    def __init__(self, img_dir, train = False, transform=None, target_transform=None, download=False):
+from datasets.image_cache import CachedImageDataset
+
+class CustomiChallengePMDataset(CachedImageDataset):
+    def __init__(self, img_dir, train = False, transform=None, target_transform=None, download=False, cache_size=None, cache_dir='./misc/image_cache'):
         # Random seed
         random_state = 42
         # Read in csv containing path information
@@ -26,10 +26,18 @@ class CustomiChallengePMDataset(Dataset):
         self.img_dir = img_dir
         self.transform = transform
         self.target_transform = target_transform
+        # Read the images from the pre-resized image cache (see datasets/image_cache.py)
+        self.init_image_cache(img_dir, cache_size, cache_dir)
 
     def __len__(self):
         return len(self.img_labels)
 
+    @property
+    def targets(self):
+        """Class label of every image, read from the label columns without loading any image"""
+        # classes 1 and 0 are combined, as in __getitem__
+        return (self.img_labels.to_numpy() == 2).astype(int)
+
     def __getitem__(self, idx):
         # Extract the associated label
         label = self.img_labels.iloc[idx] 
@@ -41,9 +49,9 @@ class CustomiChallengePMDataset(Dataset):
         elif label == 2:
             label = np.float32(1)
         # Create full path
-        img_path = os.path.join(os.path.join(self.img_dir,"PALM-Training400/PALM-Training400/"),self.img_paths.iloc[idx])
+        img_path = self.image_path(idx)
         # Open RGB image
-        image = Image.open(img_path)
+        image = self.load_image(img_path)
         # Apply transformations
         if self.transform:
             image = self.transform(image)
@@ -51,6 +59,10 @@ class CustomiChallengePMDataset(Dataset):
             label = self.target_transform(label)
         return image, label
     
+    def image_path(self, idx):
+        """Full path of image idx"""
+        return os.path.join(os.path.join(self.img_dir,"PALM-Training400/PALM-Training400/"),self.img_paths.iloc[idx])
+
     def _split_labels(self,dataframe):
         """Split dataframe into path and label dataframes"""
         # Split dataframe into path, aux and label dataframes
@@ -2,12 +2,12 @@ import os
 import pandas as pd
 import numpy as np
 import math
-from torch.utils.data import Dataset
 from torchvision.io import read_image
-from PIL import Image
 
-class CustomMontgomeryCXRDataset(Dataset):
-    def __init__(self, img_dir, train = False, transform=None, target_transform=None, download=False):
+from datasets.image_cache import CachedImageDataset
+
+class CustomMontgomeryCXRDataset(CachedImageDataset):
+    def __init__(self, img_dir, train = False, transform=None, target_transform=None, download=False, cache_size=None, cache_dir='./misc/image_cache'):
         # Random seed
         random_state = 42
         # Load in csv file
@@ -26,14 +26,21 @@ class CustomMontgomeryCXRDataset(Dataset):
         self.img_dir = img_dir
         self.transform = transform
         self.target_transform = target_transform
+        # Read the images from the pre-resized image cache (see datasets/image_cache.py)
+        self.init_image_cache(img_dir, cache_size, cache_dir)
 
     def __len__(self):
         return len(self.img_labels)
 
+    @property
+    def targets(self):
+        """Class label of every image, read from the label columns without loading any image"""
+        return self.img_labels.to_numpy()
+
     def __getitem__(self, idx):
         # Load in image
-        img_path = os.path.join(os.path.join(self.img_dir, "MontgomerySet/CXR_png/"), self.img_paths.iloc[idx])
-        image = Image.open(img_path).convert('RGB')
+        img_path = self.image_path(idx)
+        image = self.load_image(img_path)
         # Get label in correct format
         label = self.img_labels.iloc[idx]
         label = np.float32(label)
@@ -44,6 +51,10 @@ class CustomMontgomeryCXRDataset(Dataset):
             label = self.target_transform(label)
         return image, label
 
+    def image_path(self, idx):
+        """Full path of image idx"""
+        return os.path.join(os.path.join(self.img_dir, "MontgomerySet/CXR_png/"), self.img_paths.iloc[idx])
+
     def _clean_labels(self, labels):
         """Convert categorical labels into numeric"""
         vectorized_convert_to_numerical = np.vectorize(self.convert_to_numerical)
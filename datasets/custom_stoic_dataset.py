@@ -3,12 +3,13 @@ import pandas as pd
 import numpy as np
 import math
 import medpy.io as medpy
-from torch.utils.data import Dataset
 from torchvision.io import read_image
 from PIL import Image
 
-class CustomStoicDataset(Dataset):
-    def __init__(self, img_dir, train = False, transform=None, target_transform=None, download=False):
+from datasets.image_cache import CachedImageDataset
+
+class CustomStoicDataset(CachedImageDataset):
+    def __init__(self, img_dir, train = False, transform=None, target_transform=None, download=False, cache_size=None, cache_dir='./misc/image_cache'):
         # Random seed
         random_state = 42
         # Read in csv containing path information
@@ -27,19 +28,41 @@ class CustomStoicDataset(Dataset):
         self.img_dir = img_dir
         self.transform = transform
         self.target_transform = target_transform
+        # Read the images from the pre-resized image cache (see datasets/image_cache.py)
+        self.init_image_cache(img_dir, cache_size, cache_dir)
 
     def __len__(self):
         return len(self.img_labels)
 
+    @property
+    def targets(self):
+        """Class label of every image, read from the label columns without loading any image"""
+        return self.img_labels.to_numpy()
+
     def __getitem__(self, idx):
-        # Load the frame n of the way through the stack
-        n = 0.5
         # Find associated label
         label = self.img_labels.iloc[idx] 
         # Converts Label
         label = np.float32(label) 
         # Find full image path
-        img_path = os.path.join(self.img_dir,"data/mha/"+str(self.img_paths.iloc[idx])+".mha")
+        img_path = self.image_path(idx)
+        # Load the slice of the CT scan
+        image = self.load_image(img_path)
+        # Apply transformations
+        if self.transform:
+            image = self.transform(image)
+        if self.target_transform:
+            label = self.target_transform(label)
+        return image, label
+
+    def image_path(self, idx):
+        """Full path of CT scan idx"""
+        return os.path.join(self.img_dir,"data/mha/"+str(self.img_paths.iloc[idx])+".mha")
+
+    def decode_image(self, img_path):
+        """Load the slice n of the way through the CT scan at img_path as an RGB image"""
+        # Load the frame n of the way through the stack
+        n = 0.5
         # Load in mha style image using medpy library
         image, _ = medpy.load(img_path)
         # Extract a slice at a given depth
@@ -53,12 +76,7 @@ class CustomStoicDataset(Dataset):
         # Rescale to [0,255] and uint8 (as needed for loading L) 
         # Then convert to RGB
         image = Image.fromarray((image* 255).astype(np.uint8)).convert("RGB")
-        # Apply transformations
-        if self.transform:
-            image = self.transform(image)
-        if self.target_transform:
-            label = self.target_transform(label)
-        return image, label
+        return image
     
     def _split_labels(self,dataframe):
         """Split STOIC dataframe into path and label dataframes"""
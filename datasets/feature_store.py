@@ -0,0 +1,102 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+
+
+_CHECKPOINT_HASHES = {}
+
+
+def checkpoint_hash(model_name, model_dir='models', chunk_size=1 << 20):
+    """Return the sha1 hash of the prepared checkpoint `models/<model_name>.pth` (cached per process)."""
+    path = os.path.join(model_dir, model_name + '.pth')
+    if path not in _CHECKPOINT_HASHES:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha1.update(chunk)
+        _CHECKPOINT_HASHES[path] = sha1.hexdigest()
+    return _CHECKPOINT_HASHES[path]
+
+
+class FeatureStore(object):
+    """
+    Content-addressed on-disk store for features extracted from a frozen backbone.
+    Each entry is keyed by (model name, checkpoint hash, dataset, split, transform spec, sample indices, dtype,
+    image cache size, fingerprint of the source data)
+    and saved as a pair of .npy files (features, labels). The features can be written in place through
+    a memory-mapped array (see `allocate`) and are memory-mapped on load.
+    Args:
+        root: directory in which the features are stored.
+    """
+
+    def __init__(self, root='./misc/features'):
+        self.root = root
+
+    def key(self, model_name, dataset, split, transform, indices=None, dtype='float32', image_cache=None, source=None):
+        """ Build the key identifying the features of `split` of `dataset` under `model_name`.
+
+        Args:
+            model_name (str) : name of the pretrained model (as in `models/<model_name>.pth`)
+            dataset (str) : name of the dataset
+            split (str) : name of the split (train | val | trainval | test)
+            transform (callable) : transform applied to the images, identified through its repr
+            indices (list) : indices of the dataset samples in the split (None for the full dataset)
+            dtype (str) : dtype the features are stored in
+            image_cache (int) : short side of the pre-resized image cache the images are read from (None for the
+                original images)
+            source (str) : fingerprint of the data the features are computed from, e.g. of a prepared image store
+
+        Returns:
+            dict : key of the entry
+        """
+        if indices is not None:
+            indices = np.sort(np.asarray(indices, dtype=np.int64))
+            indices = hashlib.sha1(indices.tobytes()).hexdigest()
+        return {
+            'model': model_name,
+            'checkpoint': checkpoint_hash(model_name),
+            'dataset': dataset,
+            'split': split,
+            'transform': repr(transform),
+            'indices': indices,
+            'dtype': str(np.dtype(dtype)),
+            'image_cache': image_cache,
+            'source': source,
+        }
+
+    def path(self, key):
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+        return os.path.join(self.root, key['model'], key['dataset'], f"{key['split']}_{digest[:16]}")
+
+    def load(self, key, mmap_mode='r'):
+        """Return the (features, labels) stored under `key`, or None if they have not been computed yet."""
+        path = self.path(key)
+        # key.json is written last, so its presence marks a complete entry
+        if not os.path.exists(os.path.join(path, 'key.json')):
+            return None
+        features = np.load(os.path.join(path, 'features.npy'), mmap_mode=mmap_mode)
+        labels = np.load(os.path.join(path, 'labels.npy'))
+        return features, labels
+
+    def allocate(self, key, shape):
+        """Return a writable memory-mapped features array of the given shape for the entry `key`."""
+        path = self.path(key)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return np.lib.format.open_memmap(os.path.join(path, 'features.npy'), mode='w+',
+                                         dtype=np.dtype(key['dtype']), shape=shape)
+
+    def save(self, key, features, labels):
+        path = self.path(key)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        if isinstance(features, np.memmap) and features.filename == os.path.abspath(os.path.join(path, 'features.npy')):
+            # written in place through `allocate`
+            features.flush()
+        else:
+            np.save(os.path.join(path, 'features.npy'), features.astype(key['dtype'], copy=False))
+        np.save(os.path.join(path, 'labels.npy'), labels)
+        with open(os.path.join(path, 'key.json'), 'w') as f:
+            json.dump(key, f, indent=4)
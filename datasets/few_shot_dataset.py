@@ -6,9 +6,9 @@ from PIL import Image
 import numpy as np
 import pandas as pd
 from torchvision import datasets, transforms
-from torch.utils.data import Dataset, ConcatDataset, DataLoader
+from torch.utils.data import Dataset, ConcatDataset, DataLoader, Subset
 from abc import abstractmethod
-import pickle
+import json
 
 from datasets.custom_chexpert_dataset import CustomChexpertDataset
 from datasets.custom_diabetic_retinopathy_dataset import CustomDiabeticRetinopathyDataset
@@ -41,70 +41,93 @@ class ImageJitter(object):
 
 
 def get_dataset(dset, root, split, transform):
+    if dset is CustomChexpertDataset:
+        # few-shot needs binary labels
+        return dset(root, train=(split == 'train'), transform=transform, download=True, few_shot=True)
     return dset(root, train=(split == 'train'), transform=transform, download=True)
 
 
+def get_targets(dataset):
+    """Class label of every sample of `dataset`, without decoding any image"""
+    if isinstance(dataset, ConcatDataset):
+        return np.concatenate([get_targets(d) for d in dataset.datasets])
+    return np.asarray(dataset.targets)
+
+
 class SetDataset:
+    """
+    Episodic view of a dataset: item i is a random batch of `batch_size` images of class i.
+    Only the per-class index lists are built up front (from the labels alone), the images are decoded
+    and transformed when they are sampled into an episode.
+    """
     def __init__(self, dset, root, num_classes, batch_size, transform, load_submeta, submeta_path, normalise=False, hist_norm=False):
         self.cl_list = list(range(num_classes)) # changed this to list
+        self.batch_size = batch_size
 
         if load_submeta:
-            print(f'Loading sub meta dictionary')
-            self.sub_meta = pickle.load(open(submeta_path, 'rb'))
-            print(f'Finished loading')
-        else:
-
-            self.sub_meta = {}
-            for cl in self.cl_list:
-                self.sub_meta[cl] = []
-
-
-            if dset in [datasets.CIFAR10, datasets.CIFAR100]:
-                trainval_dataset = get_dataset(dset, root, 'train', identity)
-            else:
-                trainval_dataset = get_dataset(dset, root, 'train', transform)
-
-            if dset in [datasets.CIFAR10, datasets.CIFAR100]:
-                test_dataset = get_dataset(dset, root, 'test', identity)
+            if hist_norm:
+                transform_sub_dset = HistogramNormalize()
+            elif normalise:
+                transform_sub_dset = transforms.Normalize(mean=[0.485, 0.456, 0.406] , std=[0.229, 0.224, 0.225])
             else:
-                test_dataset = get_dataset(dset, root, 'test', transform)
-
-
-            d = ConcatDataset([trainval_dataset, test_dataset])
+                transform_sub_dset = identity
 
-            print(f'Total dataset size: {len(d)}')
+            self.dataset = SubmetaDataset(submeta_path, transform=transform_sub_dset)
+        else:
+            trainval_dataset = get_dataset(dset, root, 'train', transform)
+            test_dataset = get_dataset(dset, root, 'test', transform)
+            self.dataset = ConcatDataset([trainval_dataset, test_dataset])
 
-            for i, (data, label) in enumerate(d):
-                self.sub_meta[label].append(data)
+        labels = get_targets(self.dataset)
 
-        self.sub_dataloader = []
-        sub_data_loader_params = dict(batch_size = batch_size,
-                                  shuffle = True,
-                                  num_workers = 0, #use main thread only or may receive multiple batches
-                                  pin_memory = False)
+        print(f'Total dataset size: {len(self.dataset)}')
 
-        for cl in self.cl_list:
+        self.class_indices = [np.flatnonzero(labels == cl) for cl in self.cl_list]
 
-            if dset in [datasets.CIFAR10, datasets.CIFAR100]:
-                transform_sub_dset = transform
-            elif load_submeta:
-                if hist_norm:
-                    transform_sub_dset = HistogramNormalize()
-                elif normalise:
-                    transform_sub_dset = transforms.Normalize(mean=[0.485, 0.456, 0.406] , std=[0.229, 0.224, 0.225])
-                else:
-                    transform_sub_dset = identity
-            else:
-                transform_sub_dset = identity
+    def __getitem__(self, i):
+        # decode only the images sampled into the episode
+        indices = self.class_indices[i][torch.randperm(len(self.class_indices[i]))[:self.batch_size].numpy()]
+        images = torch.stack([self.dataset[j][0] for j in indices])
+        return images, torch.full((len(indices),), i, dtype=torch.long)
 
-            sub_dataset = SubDataset(self.sub_meta[cl], cl, transform=transform_sub_dset)
-            self.sub_dataloader.append(torch.utils.data.DataLoader(sub_dataset, **sub_data_loader_params))
+    def __len__(self):
+        return len(self.cl_list)
+
+    def flat_dataset(self):
+        """All the (image, class) pairs of the set, class by class, as a single dataset."""
+        return Subset(self.dataset, np.concatenate(self.class_indices))
+
+
+# dataset class to read the uint8 image store written by datasets/prepare_submeta.py
+class SubmetaDataset(Dataset):
+    """
+    Images stored class by class in one uint8 memory-mapped array (`images.npy`), with the [start, end) offsets
+    of each class in `index.json`. The array is opened lazily (once per data loading worker) and only the sampled
+    images are converted to float and transformed.
+    Args:
+        store_dir: directory of the store.
+        transform: transform applied to the sampled (float, in [0, 1]) image tensors.
+    """
+    def __init__(self, store_dir, transform=identity):
+        self.store_dir = store_dir
+        self.transform = transform
+        with open(os.path.join(store_dir, 'index.json')) as f:
+            index = json.load(f)
+        self.image_size = index['image_size']
+        self.offsets = {int(cl): offsets for cl, offsets in index['offsets'].items()}
+        self.targets = np.empty(max([end for start, end in self.offsets.values()], default=0), dtype=int)
+        for cl, (start, end) in self.offsets.items():
+            self.targets[start:end] = cl
+        self.images = None
 
     def __getitem__(self, i):
-        return next(iter(self.sub_dataloader[i]))
+        if self.images is None:
+            self.images = np.load(os.path.join(self.store_dir, 'images.npy'), mmap_mode='r')
+        img = torch.from_numpy(np.array(self.images[i])).float().div(255)
+        return self.transform(img), self.targets[i]
 
     def __len__(self):
-        return len(self.sub_dataloader)
+        return len(self.targets)
 
 
 # dataset class to deal with each individual class
@@ -209,12 +232,15 @@ class SetDataManager(DataManager):
         np.random.seed(seed)
         torch.manual_seed(seed)
 
-    def get_data_loader(self, aug, normalise, hist_norm, load_submeta=False, submeta_path=None): #parameters that would change on train/val set
+    def get_data_loader(self, aug, normalise, hist_norm, load_submeta=False, submeta_path=None, num_workers=4, prefetch_factor=2): #parameters that would change on train/val set
         transform = self.trans_loader.get_composed_transform(aug, normalise, hist_norm)
         dataset = SetDataset(self.dset, self.root, self.num_classes, self.batch_size, transform, load_submeta, submeta_path, normalise, hist_norm)
         # Custom sampler that yields n_way random class indices each time it's called
         sampler = EpisodicBatchSampler(len(dataset), self.n_way, self.n_episode )
-        data_loader_params = dict(batch_sampler = sampler,  num_workers = 0, pin_memory = True)
+        # each worker decodes whole episodes, the next ones are prefetched while the current one is evaluated
+        data_loader_params = dict(batch_sampler = sampler,  num_workers = num_workers, pin_memory = True)
+        if num_workers > 0:
+            data_loader_params['prefetch_factor'] = prefetch_factor
         data_loader = torch.utils.data.DataLoader(dataset, **data_loader_params)
         return data_loader
 
@@ -0,0 +1,178 @@
+import os
+import json
+import shutil
+import argparse
+from pprint import pprint
+
+import numpy as np
+from PIL import Image
+import PIL
+from tqdm import tqdm
+from torch.utils.data import Dataset, DataLoader
+from torchvision import transforms
+
+
+class ImageCache(object):
+    """
+    Pre-decoded images of a dataset, resized to a short side of `size` (bicubic, as the evaluation pipelines),
+    stored as raw uint8 RGB pixels in shard files (`shard_<i>.bin`) of `<cache_dir>/<name>/<size>`.
+    `index.json` maps the path of each image (relative to the dataset root) to its (shard, offset, height, width).
+    The shards are all memory-mapped when the cache is opened (so a rebuilt cache moved into place later does not mix
+    with this one), and can be shared by data loading workers.
+    Args:
+        cache_dir: directory of the image caches.
+        name: name of the cached dataset (the dataset class name).
+        root: root directory of the dataset, the images are identified by their path relative to it.
+        size: short side of the cached images.
+    """
+
+    def __init__(self, cache_dir, name, root, size):
+        self.path = os.path.join(cache_dir, name, str(size))
+        self.root = root
+        self.size = size
+        index_path = os.path.join(self.path, 'index.json')
+        if not os.path.exists(index_path):
+            raise FileNotFoundError(f'No image cache of size {size} in {self.path}, build it with '
+                                    f'python -m datasets.image_cache --dataset <dataset> --sizes {size}')
+        with open(index_path) as f:
+            self.index = json.load(f)
+        self.shards = {shard: np.memmap(os.path.join(self.path, f'shard_{shard}.bin'), dtype=np.uint8, mode='r')
+                       for shard in sorted(set(entry[0] for entry in self.index.values()))}
+
+    def key(self, img_path):
+        return os.path.relpath(img_path, self.root)
+
+    def __contains__(self, img_path):
+        return self.key(img_path) in self.index
+
+    def load(self, img_path):
+        shard, offset, h, w = self.index[self.key(img_path)]
+        pixels = np.array(self.shards[shard][offset:offset + h * w * 3]).reshape(h, w, 3)
+        return Image.fromarray(pixels)
+
+
+class CachedImageDataset(Dataset):
+    """
+    Base class of the datasets whose images can be read from an ImageCache instead of the original files.
+    Subclasses call `init_image_cache` in their constructor and load their images through `load_image`,
+    `decode_image` decodes an original file (to be overridden for non-standard formats).
+    When a cache is used, every image must be in it (a stale or partial cache raises a KeyError rather than
+    mixing cached and full-resolution images).
+    """
+
+    def init_image_cache(self, root, cache_size=None, cache_dir='./misc/image_cache'):
+        self.image_cache = None
+        if cache_size is not None:
+            self.image_cache = ImageCache(cache_dir, type(self).__name__, root, cache_size)
+
+    def decode_image(self, img_path):
+        return Image.open(img_path).convert('RGB')
+
+    def load_image(self, img_path):
+        image_cache = getattr(self, 'image_cache', None)
+        if image_cache is None:
+            return self.decode_image(img_path)
+        if img_path not in image_cache:
+            raise KeyError(f'{image_cache.key(img_path)} is not in the image cache {image_cache.path}, rebuild it with '
+                           f'python -m datasets.image_cache --dataset <dataset> --sizes {image_cache.size}')
+        return image_cache.load(img_path)
+
+
+class _ResizedImages(Dataset):
+    """Decode the images at `img_paths` with `dataset` and resize them to every short side in `sizes`."""
+
+    def __init__(self, dataset, img_paths, sizes):
+        self.dataset = dataset
+        self.img_paths = img_paths
+        self.resizes = [transforms.Resize(size, interpolation=PIL.Image.BICUBIC) for size in sizes]
+
+    def __getitem__(self, i):
+        image = self.dataset.decode_image(self.img_paths[i])
+        return self.img_paths[i], [np.asarray(resize(image).convert('RGB')) for resize in self.resizes]
+
+    def __len__(self):
+        return len(self.img_paths)
+
+
+def _collate_list(batch):
+    return batch
+
+
+def build_image_cache(datasets, root, cache_dir, sizes=(224, 242, 256), shard_bytes=1 << 30, num_workers=8):
+    """ Decode every image of `datasets` (e.g. the train and test splits) once, in parallel, and write it to
+    an ImageCache for each short side in `sizes`.
+
+    Args:
+        datasets (list) : CachedImageDataset objects, all of the same class, with an `image_path(idx)` method
+        root (str) : root directory of the dataset
+        cache_dir (str) : directory of the image caches
+        sizes (tuple) : short sides to cache the images at
+        shard_bytes (int) : maximum size of a shard file
+        num_workers (int) : number of workers decoding the images
+
+    Returns:
+        int : number of cached images
+    """
+    name = type(datasets[0]).__name__
+    img_paths = list(dict.fromkeys(d.image_path(i) for d in datasets for i in range(len(d))))
+
+    # build into temporary directories, moved into place once complete
+    final_paths = [os.path.join(cache_dir, name, str(size)) for size in sizes]
+    paths = [path + '.tmp' for path in final_paths]
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+    indices = [{} for _ in sizes]
+    shards = [[0, 0, open(os.path.join(path, 'shard_0.bin'), 'wb')] for path in paths]
+
+    loader = DataLoader(_ResizedImages(datasets[0], img_paths, sizes), batch_size=16, shuffle=False,
+                        num_workers=num_workers, collate_fn=_collate_list)
+    for batch in tqdm(loader, desc=f'Caching {name} images'):
+        for img_path, images in batch:
+            key = os.path.relpath(img_path, root)
+            for path, index, shard, pixels in zip(paths, indices, shards, images):
+                if shard[1] + pixels.nbytes > shard_bytes and shard[1] > 0:
+                    shard[2].close()
+                    shard[0], shard[1] = shard[0] + 1, 0
+                    shard[2] = open(os.path.join(path, f'shard_{shard[0]}.bin'), 'wb')
+                shard[2].write(np.ascontiguousarray(pixels).tobytes())
+                index[key] = [shard[0], shard[1], pixels.shape[0], pixels.shape[1]]
+                shard[1] += pixels.nbytes
+
+    for path, final_path, index, shard in zip(paths, final_paths, indices, shards):
+        shard[2].close()
+        # index.json is written last, so its presence marks a complete cache
+        with open(os.path.join(path, 'index.json'), 'w') as f:
+            json.dump(index, f)
+        # an existing cache is replaced only now, readers see either the old or the new complete cache
+        if os.path.isdir(final_path):
+            old_path = final_path + '.old'
+            if os.path.isdir(old_path):
+                shutil.rmtree(old_path)
+            os.replace(final_path, old_path)
+            os.replace(path, final_path)
+            shutil.rmtree(old_path)
+        else:
+            os.replace(path, final_path)
+
+    return len(img_paths)
+
+
+if __name__ == "__main__":
+    from datasets.prepare_submeta import DATASETS
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', default='diabetic_retinopathy', type=str, help='name of the dataset to cache')
+    parser.add_argument('--sizes', default=[224, 242, 256], type=int, nargs='+', help='short sides to cache the images at')
+    parser.add_argument('--cache_dir', default='./misc/image_cache', type=str, help='directory of the image caches')
+    parser.add_argument('--num_workers', default=8, type=int, help='number of workers decoding the images')
+    args = parser.parse_args()
+    pprint(args)
+
+    dset, data_dir, num_classes = DATASETS[args.dataset]
+    if not issubclass(dset, CachedImageDataset):
+        raise ValueError(f'{args.dataset} images cannot be cached')
+    dsets = [dset(data_dir, train=True), dset(data_dir, train=False)]
+    num_images = build_image_cache(dsets, data_dir, args.cache_dir, args.sizes, num_workers=args.num_workers)
+    print(f'Cached {num_images} images in {os.path.join(args.cache_dir, dset.__name__)}')
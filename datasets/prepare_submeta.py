@@ -7,12 +7,12 @@ from tqdm import tqdm
 from pprint import pprint
 
 import torch
-from torch.utils.data import Dataset, ConcatDataset, DataLoader
+from torch.utils.data import Dataset, ConcatDataset, DataLoader, Subset
 from torchvision.io import read_image
 from torchvision import transforms, datasets
 import PIL
 from PIL import Image
-import pickle
+import json
 
 from datasets.custom_chexpert_dataset import CustomChexpertDataset
 from datasets.custom_diabetic_retinopathy_dataset import CustomDiabeticRetinopathyDataset
@@ -23,6 +23,7 @@ from datasets.custom_ichallenge_amd_dataset import CustomiChallengeAMDDataset
 from datasets.custom_ichallenge_pm_dataset import CustomiChallengePMDataset
 from datasets.custom_chestx_dataset import CustomChestXDataset
 from datasets.custom_stoic_dataset import CustomStoicDataset
+from datasets.few_shot_dataset import get_targets
 
 
 # Data classes and functions
@@ -41,11 +42,11 @@ def get_train_val_test_dset(dset_name,
                               image_size):
 
 
-    # define transforms
+    # define transforms (images are kept as uint8, normalisation is applied when they are sampled)
     transform = transforms.Compose([
             transforms.Resize(image_size, interpolation=PIL.Image.BICUBIC),
             transforms.CenterCrop(image_size),
-            transforms.ToTensor(),
+            transforms.PILToTensor(),
             ])
 
     
@@ -56,6 +57,38 @@ def get_train_val_test_dset(dset_name,
     return dataset
 
 
+def build_submeta_store(dataset, num_classes, image_size, store_dir, max_images=10000, batch_size=64, num_workers=8):
+    """ Write (at most `max_images` of) the resized images of `dataset` to a SubmetaDataset store in `store_dir`.
+
+    The images are stored class by class in one uint8 memory-mapped array `images.npy`, `index.json` holds the
+    [start, end) offsets of each class. The images are decoded in parallel by `num_workers` data loading workers.
+    """
+    labels = get_targets(dataset)[:max_images].astype(int)
+    # stable sort, so that each class keeps the dataset order
+    order = np.argsort(labels, kind='stable')
+    counts = np.bincount(labels, minlength=num_classes)
+    ends = np.cumsum(counts)
+    offsets = {cl: [int(end - count), int(end)] for cl, (count, end) in enumerate(zip(counts, ends))}
+
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    images = np.lib.format.open_memmap(os.path.join(store_dir, 'images.npy'), mode='w+', dtype=np.uint8,
+                                       shape=(len(order), 3, image_size, image_size))
+
+    loader = DataLoader(Subset(dataset, order), batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    offset = 0
+    for data, _ in tqdm(loader, desc='Iterating through dataset'):
+        images[offset:offset + len(data)] = data.numpy()
+        offset += len(data)
+    images.flush()
+
+    # index.json is written last, so its presence marks a complete store
+    with open(os.path.join(store_dir, 'index.json'), 'w') as f:
+        json.dump({'image_size': image_size, 'offsets': offsets}, f, indent=4)
+
+    return offsets
+
+
 
 # name: {class, root, num_classes}
 DATASETS = {
@@ -79,32 +112,22 @@ if __name__ == "__main__":
     parser.add_argument('--dataset', default='cifar10', type=str,
                         help='name of the dataset to compute sub meta dict for')
     parser.add_argument('--image_size', default=224, type=int, help='image size')
+    parser.add_argument('--max_images', default=10000, type=int, help='maximum number of images to store')
+    parser.add_argument('--batch_size', default=64, type=int, help='the size of the mini-batches when decoding images')
+    parser.add_argument('--num_workers', default=8, type=int, help='number of workers decoding the images')
     args = parser.parse_args()
     pprint(args)
 
     # load dataset
     dset, data_dir, num_classes = DATASETS[args.dataset]
-    d = get_train_valid_test_dset(args.dataset, dset, data_dir, args.image_size)
+    d = get_train_val_test_dset(args.dataset, dset, data_dir, args.image_size)
     print(f'Total dataset size: {len(d)}')
 
-    cl_list = range(num_classes)
-    sub_meta = {}
-    for cl in cl_list:
-        sub_meta[cl] = []
-
-    pbar = tqdm(range(len(d)), desc='Iterating through dataset')
-    # For maximum 10,000 images in dataset, hash each image in a dictionary dependent on its class label
-    for i, (data, label) in enumerate(d):
-        if i > 10000:
-            break
-        sub_meta[label].append(data)
-        pbar.update(1)
-    pbar.close()
+    store_dir = os.path.join('misc/few_shot_submeta', args.dataset)
+    offsets = build_submeta_store(d, num_classes, args.image_size, store_dir, max_images=args.max_images,
+                                  batch_size=args.batch_size, num_workers=args.num_workers)
 
     print('Number of images per class')
-    for key, item in sub_meta.items():
-        print(len(sub_meta[key]))
-    
-    # Save sub_meta dictionary in pickle file
-    with open(f'misc/few_shot_submeta/{args.dataset}.pickle', 'wb') as handle:
-        pickle.dump(sub_meta, handle, protocol=pickle.HIGHEST_PROTOCOL)
\ No newline at end of file
+    for cl, (start, end) in offsets.items():
+        print(end - start)
+    print(f'Saved sub meta store to {store_dir}')
@@ -30,6 +30,9 @@ class HistogramNormalize(object):
         image = torch.tensor(image_equalized.reshape(image.shape), dtype=torch.float32)
         return image
 
+    def __repr__(self):
+        return f'{self.__class__.__name__}(number_bins={self.number_bins})'
+
 
 if __name__ == "__main__":
     pass
\ No newline at end of file
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import argparse
+import logging
+
+import torch
+from torch.utils.data import DataLoader
+from torchvision import transforms
+
+import PIL
+import numpy as np
+from tqdm import tqdm
+
+from datasets.transforms import HistogramNormalize
+from datasets.feature_store import FeatureStore
+from models.backbones import load_backbone
+from linear import LINEAR_DATASETS, get_dataset, get_transform
+
+
+# Class to extract frozen features of several pretrained backbones from one stream of decoded images
+class MultiBackboneExtractor():
+    def __init__(self, model_names, feature_store, dataset, normalise_dict, image_size, batch_size, device,
+                 feature_dtype='float32', num_workers=1):
+        self.feature_store = feature_store
+        self.dataset = dataset
+        self.normalise_dict = normalise_dict
+        self.image_size = image_size
+        self.batch_size = batch_size
+        self.device = device
+        self.feature_dtype = feature_dtype
+        self.num_workers = num_workers
+
+        self.models = {}
+        self.feature_dims = {}
+        for model_name in model_names:
+            model, feature_dim = load_backbone(model_name)
+            self.models[model_name] = model.to(self.device).eval()
+            self.feature_dims[model_name] = feature_dim
+
+        # images are decoded, resized and cropped once, normalisation is applied per model on the batch
+        self.decode_transform = transforms.Compose([
+            transforms.Resize(image_size, interpolation=PIL.Image.BICUBIC),
+            transforms.CenterCrop(image_size),
+            transforms.ToTensor(),
+        ])
+        self.normalize = transforms.Normalize(**normalise_dict)
+        self.hist_normalize = HistogramNormalize()
+
+    def uses_hist_norm(self, model_name):
+        return 'mimic-chexpert' in model_name
+
+    def model_transform(self, model_name):
+        """The full transform a single-model run of linear.py would use (identifies the features in the store)."""
+        return get_transform(self.normalise_dict, self.uses_hist_norm(model_name), self.image_size)
+
+    def extract(self, dset, data_dir, split):
+        """ Push one pass over the `split` set through every backbone and write the features to the store.
+
+        The train set is stored in index order under split 'train_full', as used by linear.py --single-pass.
+        """
+        dataset = get_dataset(dset, data_dir, split, self.decode_transform)
+        store_split = 'train_full' if split == 'train' else split
+
+        keys = {}
+        for model_name in self.models:
+            key = self.feature_store.key(model_name, self.dataset, store_split, self.model_transform(model_name),
+                                         dtype=self.feature_dtype)
+            if self.feature_store.load(key) is not None:
+                print(f'Found stored {split} features for {model_name}, skipping it')
+                logging.info(f'Found stored {split} features for {model_name}, skipping it')
+            else:
+                keys[model_name] = key
+        if not keys:
+            return
+
+        loader = DataLoader(dataset, batch_size=self.batch_size, shuffle=False,
+                            num_workers=self.num_workers, pin_memory=True)
+
+        num_samples = len(dataset)
+        feature_vectors = {
+            model_name: self.feature_store.allocate(key, (num_samples, self.feature_dims[model_name]))
+            for model_name, key in keys.items()
+        }
+        labels_vector = np.empty(num_samples, dtype=int)
+
+        offset = 0
+        with torch.no_grad():
+            for batch_x, batch_y in tqdm(loader, desc=f'Computing features for {split} set'):
+                inputs = {}
+                for model_name in keys:
+                    hist_norm = self.uses_hist_norm(model_name)
+                    if hist_norm not in inputs:
+                        if hist_norm:
+                            x = torch.stack([self.hist_normalize(img) for img in batch_x])
+                        else:
+                            x = self.normalize(batch_x)
+                        inputs[hist_norm] = x.to(self.device)
+
+                    features = self.models[model_name](inputs[hist_norm])
+                    feature_vectors[model_name][offset:offset + len(features)] = features.cpu().numpy()
+
+                labels_vector[offset:offset + len(batch_y)] = np.asarray(batch_y)
+                offset += len(batch_y)
+
+        for model_name, key in keys.items():
+            self.feature_store.save(key, feature_vectors[model_name], labels_vector)
+            print(f'Saved {split} features for {model_name} to {self.feature_store.path(key)}')
+            logging.info(f'Saved {split} features for {model_name} to {self.feature_store.path(key)}')
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Extract frozen features of several pretrained models in one pass over a dataset.')
+    parser.add_argument('-m', '--models', nargs='+', type=str, required=True,
+                        help='names of the pretrained models to extract features with')
+    parser.add_argument('-d', '--dataset', type=str, default='cifar10', help='name of the dataset to extract features of')
+    parser.add_argument('-b', '--batch-size', type=int, default=64, help='the size of the mini-batches when inferring features')
+    parser.add_argument('-i', '--image-size', type=int, default=224, help='the size of the input images')
+    parser.add_argument('-n', '--no-norm', action='store_true', default=False,
+                        help='whether to turn off data normalisation (based on ImageNet values)')
+    parser.add_argument('--feature-dtype', type=str, default='float32',
+                        help='dtype to store the extracted features in (float32 | float16)')
+    parser.add_argument('--feature-dir', type=str, default='./misc/features', help='directory of the feature store')
+    parser.add_argument('--num-workers', type=int, default=1, help='number of data loading workers')
+    parser.add_argument('--device', type=str, default='cuda', help='CUDA or CPU training (cuda | cpu)')
+    args = parser.parse_args()
+    args.norm = not args.no_norm
+    print(args)
+
+    # set-up logging
+    log_fname = f'{args.dataset}.log'
+    if not os.path.isdir('./logs/extract_features'):
+        os.makedirs('./logs/extract_features')
+    log_path = os.path.join('./logs/extract_features', log_fname)
+    logging.basicConfig(filename=log_path, filemode='w', level=logging.INFO)
+    logging.info(args)
+
+    if args.norm:
+        normalise_dict = {'mean': [0.485, 0.456, 0.406], 'std': [0.229, 0.224, 0.225]}
+    else:
+        normalise_dict = {'mean': [0.0, 0.0, 0.0], 'std': [1.0, 1.0, 1.0]}
+
+    dset, data_dir, num_classes, metric = LINEAR_DATASETS[args.dataset]
+
+    extractor = MultiBackboneExtractor(args.models, FeatureStore(args.feature_dir), args.dataset, normalise_dict,
+                                       args.image_size, args.batch_size, args.device,
+                                       feature_dtype=args.feature_dtype, num_workers=args.num_workers)
+    for split in ['train', 'test']:
+        extractor.extract(dset, data_dir, split)
@@ -4,7 +4,11 @@
 # coding: utf-8
 
 import os
+import csv
+import zlib
+import hashlib
 import argparse
+import itertools
 from pprint import pprint
 import logging
 
@@ -12,6 +16,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
+from torch.utils.data import DataLoader
 from torchvision import models, datasets
 
 from datasets import few_shot_dataset
@@ -24,17 +29,53 @@ from datasets.custom_ichallenge_amd_dataset import CustomiChallengeAMDDataset
 from datasets.custom_ichallenge_pm_dataset import CustomiChallengePMDataset
 from datasets.custom_stoic_dataset import CustomStoicDataset
 from datasets.custom_chestx_dataset import CustomChestXDataset
-from models.backbones import ResNetBackbone, ResNet18Backbone, DenseNetBackbone
+from datasets.feature_store import FeatureStore
+from models.backbones import load_backbone
 
 import numpy as np
 from tqdm import tqdm
 
 
+def embed_dataset(backbone, dataset, batch_size, device, feature_vectors=None):
+    """ Embed every (image, label) of `dataset` once with the frozen backbone.
+
+    Returns:
+        np.ndarray : (len(dataset), feature_dim) embeddings (written into `feature_vectors` if given)
+        np.ndarray : (len(dataset),) labels
+    """
+    backbone.eval()
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False)
+    labels_vector = np.empty(len(dataset), dtype=int)
+
+    offset = 0
+    with torch.no_grad():
+        for data, targets in tqdm(loader, desc='Embedding few-shot images'):
+            features = backbone(data.to(device)).cpu().numpy()
+            if feature_vectors is None:
+                feature_vectors = np.empty((len(dataset), features.shape[1]), dtype=np.float32)
+            feature_vectors[offset:offset + len(features)] = features
+            labels_vector[offset:offset + len(features)] = np.asarray(targets)
+            offset += len(features)
+
+    return feature_vectors, labels_vector
+
+
 class FewShotTester():
-    def __init__(self, backbone, dataloader, n_way, n_support, n_query, iter_num, device):
+    """
+    ProtoNet few-shot evaluation of a frozen backbone.
+    If `embeddings` (a (features, labels) pair covering the dataset) is given, episodes are sampled as index sets over
+    the embedding matrix and the backbone is never run, otherwise every episode of `dataloader` is embedded.
+    Episodes over the embeddings are evaluated `episode_batch_size` at a time, and drawn from a generator seeded
+    with `seed` (if not None), so that the same episodes can be replayed for every backbone.
+    """
+    def __init__(self, backbone, dataloader, n_way, n_support, n_query, iter_num, device, embeddings=None,
+                 episode_batch_size=100, seed=None):
         self.backbone = backbone
         self.protonet = ProtoNet(self.backbone)
         self.dataloader = dataloader
+        self.embeddings = embeddings
+        self.episode_batch_size = episode_batch_size
+        self.seed = seed
 
         self.n_way = n_way
         self.n_support = n_support
@@ -43,7 +84,11 @@ class FewShotTester():
         self.device = device
 
     def test(self):
-        loss, acc, std = self.evaluate(self.protonet, self.dataloader, self.n_support, self.n_query, self.iter_num)
+        if self.embeddings is not None:
+            loss, acc, std = self.evaluate_embeddings(self.protonet, self.embeddings, self.n_way, self.n_support,
+                                                      self.n_query, self.iter_num)
+        else:
+            loss, acc, std = self.evaluate(self.protonet, self.dataloader, self.n_support, self.n_query, self.iter_num)
         print('Test Acc = %4.2f%% +- %4.2f%%' %(acc, 1.96 * std / np.sqrt(self.iter_num)))
         logging.info('Test Acc = %4.2f%% +- %4.2f%%' %(acc, 1.96 * std / np.sqrt(self.iter_num)))
         return acc, std
@@ -89,6 +134,66 @@ class FewShotTester():
 
         return loss, acc, std
 
+    def evaluate_embeddings(self, model, embeddings, n_way, n_support, n_query, iter_num):
+        features, labels = embeddings
+        features = torch.as_tensor(np.asarray(features), dtype=torch.float32, device=self.device)
+        labels = np.asarray(labels)
+        class_indices = [np.flatnonzero(labels == cl) for cl in range(labels.max() + 1)]
+        counts = torch.tensor([len(inds) for inds in class_indices])
+
+        if n_query == -1:
+            n_query = int(counts.min()) - n_support
+
+        # [padded_indices] = [n_classes, max class size], [valid] marks the actual images of each class
+        padded_indices = torch.zeros(len(class_indices), int(counts.max()), dtype=torch.long)
+        for cl, inds in enumerate(class_indices):
+            padded_indices[cl, :len(inds)] = torch.from_numpy(inds)
+        valid = (torch.arange(padded_indices.size(1)).unsqueeze(0) < counts.unsqueeze(1)).float()
+
+        generator = torch.Generator()
+        if self.seed is not None:
+            generator.manual_seed(self.seed)
+
+        loss_all = []
+        acc_all = []
+
+        for start in tqdm(range(0, iter_num, self.episode_batch_size), desc=f'Few-shot test episodes'):
+            n_episodes = min(self.episode_batch_size, iter_num - start)
+            # as the episodic data loader: n_way random classes, n_support + n_query random images of each
+            classes = torch.rand(n_episodes, len(class_indices), generator=generator).argsort(dim=1)[:, :n_way]
+            positions = torch.multinomial(valid[classes.view(-1)], n_support + n_query, replacement=False,
+                                          generator=generator)
+            inds = padded_indices[classes.view(-1, 1), positions].view(n_episodes, n_way, n_support + n_query)
+            z = features[inds.to(self.device)]
+            loss_val, acc_val = model.batched_loss_from_embeddings(z[:, :, :n_support], z[:, :, n_support:])
+            loss_all.extend(loss_val.tolist())
+            acc_all.extend((acc_val * 100.).tolist())
+
+        loss = np.mean(loss_all)
+        acc = np.mean(acc_all)
+        std = np.std(acc_all)
+
+        return loss, acc, std
+
+
+def episode_seed(seed, n_way, n_support, n_query):
+    """Seed of the episode stream of one few-shot configuration (independent of the other configurations swept)"""
+    return zlib.crc32(f'{seed}_{n_way}_{n_support}_{n_query}'.encode())
+
+
+def set_dataset_fingerprint(set_dataset, submeta_path=None):
+    """Hash of the labels of the flattened set (and of the submeta store it is read from), to key cached embeddings"""
+    sha1 = hashlib.sha1()
+    targets = few_shot_dataset.get_targets(set_dataset.dataset)[np.concatenate(set_dataset.class_indices)]
+    sha1.update(np.asarray(targets, dtype=np.int64).tobytes())
+    if submeta_path is not None:
+        # a rebuilt store has a new index (and images file)
+        with open(os.path.join(submeta_path, 'index.json'), 'rb') as f:
+            sha1.update(f.read())
+        stat = os.stat(os.path.join(submeta_path, 'images.npy'))
+        sha1.update(f'{stat.st_size}_{stat.st_mtime_ns}'.encode())
+    return sha1.hexdigest()
+
 
 def euclidean_dist(x, y):
     # x: N x D
@@ -104,6 +209,17 @@ def euclidean_dist(x, y):
     return torch.pow(x - y, 2).sum(2)
 
 
+def batched_euclidean_dist(x, y):
+    # x: E x N x D
+    # y: E x M x D
+    # squared distances as ||x||^2 + ||y||^2 - 2 x.y, without the E x N x M x D difference tensor
+    assert x.size(-1) == y.size(-1)
+    x_norm = x.pow(2).sum(-1).unsqueeze(2)
+    y_norm = y.pow(2).sum(-1).unsqueeze(1)
+
+    return (x_norm + y_norm - 2 * torch.bmm(x, y.transpose(1, 2))).clamp_min(0)
+
+
 class Flatten(nn.Module):
     def __init__(self):
         super(Flatten, self).__init__()
@@ -131,16 +247,6 @@ class ProtoNet(nn.Module):
             n_support = xs.size(1)
             n_query = xq.size(1)
 
-            target_inds = torch.arange(0, n_class).view(n_class, 1, 1).expand(n_class, n_query, 1).long()
-            target_inds = Variable(target_inds, requires_grad=False)
-            # [target_inds] = [n_class, n_query, 1]
-            # e.g. for n_class = 2, n_query = 5,
-            # target_inds = [[[0 0 0 0 0]]
-            #                [[1 1 1 1 1]]]
-
-            if xq.is_cuda:
-                target_inds = target_inds.cuda()
-
             # move all examples for each class in the same dimension (dim 0, i.e., one large batch)
             x = torch.cat([xs.view(n_class * n_support, *xs.size()[2:]),
                            xq.view(n_class * n_query, *xq.size()[2:])], 0)
@@ -153,10 +259,29 @@ class ProtoNet(nn.Module):
             # for densenet backbone, z_dim = 1024
 
 
+        return self.loss_from_embeddings(z[:n_class*n_support].view(n_class, n_support, z_dim),
+                                         z[n_class*n_support:].view(n_class, n_query, z_dim))
+
+    def loss_from_embeddings(self, zs, zq):
+        with torch.no_grad():
+            # [zs] = [n_class, n_support, z_dim], [zq] = [n_class, n_query, z_dim]
+            n_class, n_support, z_dim = zs.size()
+            n_query = zq.size(1)
+
+            target_inds = torch.arange(0, n_class).view(n_class, 1, 1).expand(n_class, n_query, 1).long()
+            target_inds = Variable(target_inds, requires_grad=False)
+            # [target_inds] = [n_class, n_query, 1]
+            # e.g. for n_class = 2, n_query = 5,
+            # target_inds = [[[0 0 0 0 0]]
+            #                [[1 1 1 1 1]]]
+
+            if zq.is_cuda:
+                target_inds = target_inds.cuda()
+
             # compute prototypes for each class from support examples
-            z_proto = z[:n_class*n_support].view(n_class, n_support, z_dim).mean(1)
+            z_proto = zs.mean(1)
             # calculate z embeddings for query examples
-            zq = z[n_class*n_support:]
+            zq = zq.reshape(n_class * n_query, z_dim)
 
             dists = euclidean_dist(zq, z_proto)
 
@@ -169,6 +294,26 @@ class ProtoNet(nn.Module):
 
         return loss_val, acc_val
 
+    def batched_loss_from_embeddings(self, zs, zq):
+        """Loss and accuracy of each of E episodes, [zs] = [E, n_class, n_support, z_dim], [zq] = [E, n_class, n_query, z_dim]"""
+        with torch.no_grad():
+            n_episodes, n_class, n_support, z_dim = zs.size()
+            n_query = zq.size(2)
+
+            # [target_inds] = [E, n_class * n_query]
+            target_inds = torch.arange(n_class, device=zq.device).repeat_interleave(n_query).expand(n_episodes, -1)
+
+            # [z_proto] = [E, n_class, z_dim], [dists] = [E, n_class * n_query, n_class]
+            z_proto = zs.mean(2)
+            dists = batched_euclidean_dist(zq.reshape(n_episodes, n_class * n_query, z_dim), z_proto)
+
+            log_p_y = F.log_softmax(-dists, dim=2)
+
+            loss_val = -log_p_y.gather(2, target_inds.unsqueeze(2)).squeeze(2).mean(1)
+            acc_val = torch.eq(log_p_y.argmax(2), target_inds).float().mean(1)
+
+        return loss_val, acc_val
+
 
 # name: {class, root, num_classes (not necessary here), metric}
 FEW_SHOT_DATASETS = {
@@ -190,65 +335,123 @@ FEW_SHOT_DATASETS = {
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Evaluate pretrained self-supervised model on few-shot recognition.')
-    parser.add_argument('-m', '--model', type=str, default='moco-v2',
-                        help='name of the pretrained model to load and evaluate (moco-v2 | supervised)')
+    parser.add_argument('-m', '--model', type=str, nargs='+', default=['moco-v2'],
+                        help='name(s) of the pretrained model(s) to load and evaluate (moco-v2 | supervised)')
     parser.add_argument('-d', '--dataset', type=str, default='cifar10', help='name of the dataset to evaluate on')
     parser.add_argument('-i', '--image-size', type=int, default=224, help='the size of the input images')
-    parser.add_argument('--n-way', type=int, default=5, help='the number of classes per episode (n-way) in few-shot evaluation')
-    parser.add_argument('--n-support', type=int, default=5, help='the number of images per class for fitting (n-support) in few-shot evaluation')
-    parser.add_argument('--n-query', type=int, default=15, help='the number of images per class for testing (n-query) in few-shot evaluation')
+    parser.add_argument('--n-way', type=int, nargs='+', default=[5], help='the number(s) of classes per episode (n-way) in few-shot evaluation')
+    parser.add_argument('--n-support', type=int, nargs='+', default=[5], help='the number(s) of images per class for fitting (n-support) in few-shot evaluation')
+    parser.add_argument('--n-query', type=int, nargs='+', default=[15], help='the number(s) of images per class for testing (n-query) in few-shot evaluation')
     parser.add_argument('--iter-num', type=int, default=600, help='the number of testing episodes in few-shot evaluation')
     parser.add_argument('-n', '--no-norm', action='store_true', default=False,
                         help='whether to turn off data normalisation (based on ImageNet values)')
+    parser.add_argument('--num-workers', type=int, default=4, help='number of workers decoding the few-shot episodes')
+    parser.add_argument('-b', '--batch-size', type=int, default=64, help='the size of the mini-batches when embedding images')
+    parser.add_argument('--embed-once', action='store_true', default=False,
+                        help='whether to embed every image once and sample the episodes from the embeddings (always on for sweeps)')
+    parser.add_argument('--cache-features', action='store_true', default=False,
+                        help='whether to also store the embeddings on disk and reuse them across runs (implies --embed-once)')
+    parser.add_argument('--episode-batch-size', type=int, default=100,
+                        help='the number of episodes evaluated at once on the embeddings (with --embed-once)')
+    parser.add_argument('--feature-dir', type=str, default='./misc/features', help='directory of the feature store')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the few-shot episodes')
     parser.add_argument('--device', type=str, default='cuda', help='CUDA or CPU training (cuda | cpu)')
     args = parser.parse_args()
     args.norm = not args.no_norm
     pprint(args)
 
-    # histogram normalization
-    hist_norm = False
-    if 'mimic-chexpert' in args.model:
-        hist_norm = True
+    # every (n_way, n_support, n_query) configuration is evaluated for every model
+    configs = list(itertools.product(args.n_way, args.n_support, args.n_query))
+    sweep = len(args.model) > 1 or len(configs) > 1
+    # a sweep evaluates every configuration on the shared embedding matrix of each model
+    embed_once = args.embed_once or args.cache_features or sweep
 
     # set-up logging
+    log_dir = f'./logs/few-shot/{args.model[0]}' if len(args.model) == 1 else './logs/few-shot/sweep'
     log_fname = f'{args.dataset}.log'
-    if not os.path.isdir(f'./logs/few-shot/{args.model}'):
-        os.makedirs(f'./logs/few-shot/{args.model}')
-    log_path = os.path.join(f'./logs/few-shot/{args.model}', log_fname)
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    log_path = os.path.join(log_dir, log_fname)
     logging.basicConfig(filename=log_path, filemode='w', level=logging.INFO)
     logging.info(args)
 
-    # load dataset
     dset, data_dir, num_classes, metric = FEW_SHOT_DATASETS[args.dataset]
-    datamgr = few_shot_dataset.SetDataManager(dset, data_dir, num_classes, args.image_size, n_episode=args.iter_num,
-                                      n_way=args.n_way, n_support=args.n_support, n_query=args.n_query)
-
-    # If performing few-shot on a large dataset, load in premade .pickle file
-    if args.dataset in ['chexpert', 'chestx', 'diabetic_retinopathy', 'stoic']:
-        submeta_path = os.path.join('./misc/few_shot_submeta', f'{args.dataset}.pickle')
-        print(f'Loading sub meta dict from path {submeta_path}')
-        dataloader = datamgr.get_data_loader(aug=False, normalise=args.norm, hist_norm=hist_norm,
-         load_submeta=True, submeta_path=submeta_path)
-    else:
-        dataloader = datamgr.get_data_loader(aug=False, normalise=args.norm, hist_norm=hist_norm)
-
-
-    # load pretrained model
-    if args.model in ['mimic-chexpert_lr_0.1', 'mimic-chexpert_lr_0.01', 'mimic-chexpert_lr_1.0', 'supervised_d121']:
-        model = DenseNetBackbone(args.model)
-    elif 'mimic-cxr' in args.model:
-        if 'r18' in args.model:
-            model = ResNet18Backbone(args.model)
+    n_way, n_support, n_query = configs[0]
+
+    results = []
+    for model_name in args.model:
+        # histogram normalization
+        hist_norm = False
+        if 'mimic-chexpert' in model_name:
+            hist_norm = True
+
+        # load dataset (the episodic loader is only used without --embed-once, i.e. for a single configuration)
+        datamgr = few_shot_dataset.SetDataManager(dset, data_dir, num_classes, args.image_size, n_episode=args.iter_num,
+                                          n_way=n_way, n_support=n_support, n_query=n_query, seed=args.seed)
+
+        # If performing few-shot on a large dataset, load in premade image store (see datasets/prepare_submeta.py)
+        submeta_path = None
+        if args.dataset in ['chexpert', 'chestx', 'diabetic_retinopathy', 'stoic']:
+            submeta_path = os.path.join('./misc/few_shot_submeta', args.dataset)
+            print(f'Loading sub meta store from path {submeta_path}')
+            dataloader = datamgr.get_data_loader(aug=False, normalise=args.norm, hist_norm=hist_norm,
+             load_submeta=True, submeta_path=submeta_path, num_workers=args.num_workers)
         else:
-            model = DenseNetBackbone(args.model)
-    elif args.model == 'supervised_r18':
-        model = ResNet18Backbone(args.model)
-    else:
-        model = ResNetBackbone(args.model)
-
-    model = model.to(args.device)
-
-
-    # evaluate model on dataset by protonet few-shot-learning evaluation
-    tester = FewShotTester(model, dataloader, args.n_way, args.n_support, args.n_query, args.iter_num, args.device)
-    test_acc, test_std = tester.test()
\ No newline at end of file
+            dataloader = datamgr.get_data_loader(aug=False, normalise=args.norm, hist_norm=hist_norm,
+                                                 num_workers=args.num_workers)
+
+        # load pretrained model
+        model, feature_dim = load_backbone(model_name)
+        model = model.to(args.device)
+
+        # embed every image of the dataset once
+        embeddings = None
+        if embed_once:
+            embed_dataset_ = dataloader.dataset.flat_dataset()
+            if args.cache_features:
+                feature_store = FeatureStore(args.feature_dir)
+                transform = datamgr.trans_loader.get_composed_transform(False, args.norm, hist_norm)
+                key = feature_store.key(model_name, args.dataset, 'few_shot', transform,
+                                        source=set_dataset_fingerprint(dataloader.dataset, submeta_path))
+                embeddings = feature_store.load(key)
+                if embeddings is None:
+                    feature_vectors = feature_store.allocate(key, (len(embed_dataset_), feature_dim))
+                    embeddings = embed_dataset(model, embed_dataset_, args.batch_size, args.device, feature_vectors)
+                    feature_store.save(key, *embeddings)
+                else:
+                    print(f'Loaded cached embeddings from {feature_store.path(key)}')
+            else:
+                embeddings = embed_dataset(model, embed_dataset_, args.batch_size, args.device)
+
+        # evaluate model on dataset by protonet few-shot-learning evaluation
+        for n_way, n_support, n_query in configs:
+            print(f'{model_name}: {n_way}-way {n_support}-shot ({n_query} queries)')
+            logging.info(f'{model_name}: {n_way}-way {n_support}-shot ({n_query} queries)')
+            tester = FewShotTester(model, dataloader, n_way, n_support, n_query, args.iter_num, args.device,
+                                   embeddings=embeddings, episode_batch_size=args.episode_batch_size,
+                                   seed=episode_seed(args.seed, n_way, n_support, n_query))
+            test_acc, test_std = tester.test()
+            results.append({
+                'model': model_name,
+                'dataset': args.dataset,
+                'n_way': n_way,
+                'n_support': n_support,
+                'n_query': n_query,
+                'iter_num': args.iter_num,
+                'accuracy': round(float(test_acc), 4),
+                'ci95': round(float(1.96 * test_std / np.sqrt(args.iter_num)), 4),
+            })
+
+    # results table
+    header = f'{"model":<30}{"n_way":>7}{"n_support":>11}{"n_query":>9}{"accuracy":>10}{"ci95":>8}'
+    rows = [f'{r["model"]:<30}{r["n_way"]:>7}{r["n_support"]:>11}{r["n_query"]:>9}{r["accuracy"]:>10.2f}{r["ci95"]:>8.2f}'
+            for r in results]
+    print('\n'.join([header] + rows))
+    logging.info('\n'.join([header] + rows))
+
+    results_path = os.path.join(log_dir, f'{args.dataset}_results.csv')
+    with open(results_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+        writer.writeheader()
+        writer.writerows(results)
+    print(f'Saved results table to {results_path}')
@@ -297,7 +297,10 @@ class FinetuneTester():
 
 # Data classes and functions
 
-def get_dataset(dset, root, split, transform):
+def get_dataset(dset, root, split, transform, image_cache=None):
+    if image_cache is not None:
+        # read the images from the pre-resized image cache (see datasets/image_cache.py)
+        return dset(root, train=(split == 'train'), transform=transform, download=True, cache_size=image_cache)
     return dset(root, train=(split == 'train'), transform=transform, download=True)
 
 
@@ -312,6 +315,7 @@ def get_train_valid_loader(dset,
                            shuffle=True,
                            num_workers=1,
                            pin_memory=True,
+                           image_cache=None,
                            data_augmentation=True):
     """
     Utility function for loading and returning train and valid
@@ -331,6 +335,8 @@ def get_train_valid_loader(dset,
     - num_workers: number of subprocesses to use when loading the dataset.
     - pin_memory: whether to copy tensors into CUDA pinned memory. Set it to
       True if using GPU.
+    - image_cache: short side of the pre-resized image cache to read the images
+      from (None to decode the original files).
     Returns
     -------
     - train_loader: training set iterator.
@@ -383,8 +389,8 @@ def get_train_valid_loader(dset,
 
 
     # select a random subset of the train set to form the validation set
-    dataset = get_dataset(dset, data_dir, 'train', transform_aug)
-    valid_dataset = get_dataset(dset, data_dir, 'train', transform_no_aug)
+    dataset = get_dataset(dset, data_dir, 'train', transform_aug, image_cache)
+    valid_dataset = get_dataset(dset, data_dir, 'train', transform_no_aug, image_cache)
 
     num_train = len(dataset)
     indices = list(range(num_train))
@@ -422,7 +428,8 @@ def get_test_loader(dset,
                     image_size,
                     shuffle=False,
                     num_workers=1,
-                    pin_memory=True):
+                    pin_memory=True,
+                    image_cache=None):
     """
     Utility function for loading and returning a multi-process
     test iterator.
@@ -438,6 +445,8 @@ def get_test_loader(dset,
     - num_workers: number of subprocesses to use when loading the dataset.
     - pin_memory: whether to copy tensors into CUDA pinned memory. Set it to
       True if using GPU.
+    - image_cache: short side of the pre-resized image cache to read the images
+      from (None to decode the original files).
     Returns
     -------
     - data_loader: test set iterator.
@@ -463,7 +472,7 @@ def get_test_loader(dset,
 
     print("Test transform:", transform)
 
-    dataset = get_dataset(dset, data_dir, 'test', transform)
+    dataset = get_dataset(dset, data_dir, 'test', transform, image_cache)
 
     data_loader = DataLoader(
         dataset, batch_size=batch_size, shuffle=shuffle,
@@ -473,7 +482,8 @@ def get_test_loader(dset,
     return data_loader
 
 
-def prepare_data(dset, data_dir, batch_size, image_size, normalisation, hist_norm, num_workers, data_augmentation):
+def prepare_data(dset, data_dir, batch_size, image_size, normalisation, hist_norm, num_workers, data_augmentation,
+                 image_cache=None):
     print(f'Loading {dset} from {data_dir}, with batch size={batch_size}, image size={image_size}, norm={normalisation}')
     logging.info(f'Loading {dset} from {data_dir}, with batch size={batch_size}, image size={image_size}, norm={normalisation}')
     if normalisation:
@@ -482,9 +492,10 @@ def prepare_data(dset, data_dir, batch_size, image_size, normalisation, hist_nor
         normalise_dict = {'mean': [0.0, 0.0, 0.0], 'std': [1.0, 1.0, 1.0]}
     train_loader, val_loader, trainval_loader = get_train_valid_loader(dset, data_dir, normalise_dict, hist_norm,
                                                 batch_size, image_size, random_seed=0, num_workers=num_workers,
-                                                pin_memory=False, data_augmentation=data_augmentation)
+                                                pin_memory=False, data_augmentation=data_augmentation,
+                                                image_cache=image_cache)
     test_loader = get_test_loader(dset, data_dir, normalise_dict, hist_norm, batch_size, image_size, num_workers=num_workers,
-                                                pin_memory=False)
+                                                pin_memory=False, image_cache=image_cache)
     return train_loader, val_loader, trainval_loader, test_loader
 
 
@@ -516,8 +527,13 @@ if __name__ == "__main__":
     parser.add_argument('--no-da', action='store_true', default=False, help='disables data augmentation during training')
     parser.add_argument('-n', '--no-norm', action='store_true', default=False,
                         help='whether to turn off data normalisation (based on ImageNet values)')
+    parser.add_argument('--image-cache', type=int, default=None,
+                        help='short side of the pre-resized image cache to read the images from (224 | 242 | 256), see datasets/image_cache.py')
     parser.add_argument('--device', type=str, default='cuda', help='CUDA or CPU training (cuda | cpu)')
     args = parser.parse_args()
+    if args.image_cache is not None and args.image_cache < args.image_size:
+        parser.error(f'--image-cache {args.image_cache} is smaller than --image-size {args.image_size}, '
+                     f'the cached images would be upsampled')
     args.norm = not args.no_norm
     args.da = not args.no_da
     del args.no_norm
@@ -539,12 +555,18 @@ if __name__ == "__main__":
     logging.basicConfig(filename=log_path, filemode='w', level=logging.INFO)
     logging.info(args)
 
+    if args.image_cache is not None and args.da:
+        message = (f'Warning: with --image-cache, RandomResizedCrop crops from the images resized to a short side of '
+                   f'{args.image_cache} instead of the original images, which changes the training distribution')
+        print(message)
+        logging.warning(message)
+
 
     # load dataset
     dset, data_dir, num_classes, metric = FINETUNE_DATASETS[args.dataset]
     train_loader, val_loader, trainval_loader, test_loader = prepare_data(
         dset, data_dir, args.batch_size, args.image_size, normalisation=args.norm,
-        hist_norm=hist_norm, num_workers=args.workers, data_augmentation=args.da)
+        hist_norm=hist_norm, num_workers=args.workers, data_augmentation=args.da, image_cache=args.image_cache)
 
     # set up learning rate and weight decay ranges
     lr = torch.logspace(-4, -1, args.grid_size).flip(dims=(0,))
@@ -0,0 +1,229 @@
+# Batched tensor versions of the torchvision functional transforms used by ManualTransform.
+# Every function takes a (k, C, H, W) batch of views and per-view parameters (lists of length k),
+# and follows the conventions of the corresponding torchvision.transforms.functional op.
+
+import torch
+import torch.nn.functional as F
+import torchvision.transforms.functional as FT
+
+
+def _view_params(values, device, dtype=torch.float32):
+    return torch.as_tensor(values, dtype=dtype, device=device).view(-1, 1, 1, 1)
+
+
+def _blend(img1, img2, ratio):
+    return (ratio * img1 + (1.0 - ratio) * img2).clamp(0, 1)
+
+
+def _grayscale(img):
+    r, g, b = img.unbind(dim=-3)
+    return (0.2989 * r + 0.587 * g + 0.114 * b).unsqueeze(dim=-3)
+
+
+def _affine_grid(matrices, h, w, device):
+    """Sampling grid for a batch of inverse affine matrices, as torchvision's tensor affine (_gen_affine_grid)."""
+    theta = torch.tensor(matrices, dtype=torch.float32, device=device).view(-1, 2, 3)
+    base_grid = torch.empty(1, h, w, 3, device=device)
+    base_grid[..., 0].copy_(torch.linspace(-w * 0.5 + 0.5, w * 0.5 - 0.5, steps=w, device=device))
+    base_grid[..., 1].copy_(torch.linspace(-h * 0.5 + 0.5, h * 0.5 - 0.5, steps=h, device=device).unsqueeze(-1))
+    base_grid[..., 2].fill_(1)
+    rescaled_theta = theta.transpose(1, 2) / torch.tensor([0.5 * w, 0.5 * h], device=device)
+    grid = torch.matmul(base_grid.view(1, h * w, 3), rescaled_theta)
+    return grid.view(-1, h, w, 2)
+
+
+def _apply_affine(img, matrices):
+    grid = _affine_grid(matrices, img.size(-2), img.size(-1), img.device)
+    return F.grid_sample(img, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+
+
+def rotate(img, angle):
+    # FT.rotate is counter-clockwise, hence the inverted angle
+    matrices = [FT._get_inverse_affine_matrix([0.0, 0.0], -a, [0.0, 0.0], 1.0, [0.0, 0.0]) for a in angle]
+    return _apply_affine(img, matrices)
+
+
+def affine(img, angle, translate, scale, shear):
+    matrices = []
+    for a, t, sc, sh in zip(angle, translate, scale, shear):
+        sh = [float(sh), 0.0] if isinstance(sh, (int, float)) else [float(s) for s in sh]
+        matrices.append(FT._get_inverse_affine_matrix([0.0, 0.0], a, [float(x) for x in t], sc, sh))
+    return _apply_affine(img, matrices)
+
+
+def resized_crop(img, top, left, height, width, size):
+    """Crop box (top, left, height, width) of each view, bilinearly resized to `size`."""
+    h, w = img.size(-2), img.size(-1)
+    out_h, out_w = size[0]
+    steps_y = (torch.arange(out_h, device=img.device) + 0.5).view(1, -1)
+    steps_x = (torch.arange(out_w, device=img.device) + 0.5).view(1, -1)
+    # centres of the output pixels in input pixel coordinates, then normalised to [-1, 1]
+    ys = _view_params(top, img.device).view(-1, 1) + steps_y * _view_params(height, img.device).view(-1, 1) / out_h
+    xs = _view_params(left, img.device).view(-1, 1) + steps_x * _view_params(width, img.device).view(-1, 1) / out_w
+    ys = 2 * ys / h - 1
+    xs = 2 * xs / w - 1
+    grid = torch.stack(torch.broadcast_tensors(xs.unsqueeze(1), ys.unsqueeze(2)), dim=-1)
+    return F.grid_sample(img, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+
+
+def _elastic_grids(sigma, seed, alpha, alpha_affine, h, w, device):
+    """(k, h, w, 2) source pixel coordinates (x, y) of each view: the random affine of albumentations' ElasticTransform,
+    then displacements alpha * (uniform(-1, 1) noise smoothed by a 17x17 gaussian of std sigma), as approximate=True."""
+    k = len(seed)
+    generators = [torch.Generator().manual_seed(s) for s in seed]
+    # random affine moving three points around the centre by up to alpha_affine pixels
+    centre = torch.tensor([w // 2, h // 2], dtype=torch.float32)
+    square_size = min(h, w) // 3
+    src = torch.stack([centre + square_size, centre + torch.tensor([square_size, -square_size]), centre - square_size])
+    dst = torch.stack([src + (torch.rand(3, 2, generator=g) * 2 - 1) * alpha_affine for g in generators])
+    # inverse affine (output to input coordinates), solved from the three point pairs
+    inverse = torch.linalg.solve(torch.cat([dst, torch.ones(k, 3, 1)], dim=2), src.expand(k, -1, -1)).to(device)
+
+    noise = torch.stack([torch.rand(2, h, w, generator=g) * 2 - 1 for g in generators]).to(device)
+    displacements = gaussian_blur(noise, sigma, [17] * k) * alpha
+    xs = torch.arange(w, device=device).view(1, 1, w) + displacements[:, 0]
+    ys = torch.arange(h, device=device).view(1, h, 1) + displacements[:, 1]
+    coords = torch.stack((xs, ys, torch.ones_like(xs)), dim=-1)
+    return torch.matmul(coords.view(k, h * w, 3), inverse).view(k, h, w, 2)
+
+
+def elastic_deform(img, sigma, seed, alpha=1.0, alpha_affine=50.0):
+    """Random elastic deformation of each view as albumentations' ElasticTransform (approximate=True): alpha scales the
+    displacements, sigma is the std of the gaussian smoothing them (both in pixels of `img`, as alpha_affine).
+    Each view is reproducible through its seed (bilinear, reflected borders)."""
+    h, w = img.size(-2), img.size(-1)
+    grid = _elastic_grids(sigma, seed, alpha, alpha_affine, h, w, img.device)
+    grid = 2 * grid / torch.tensor([w - 1, h - 1], dtype=torch.float32, device=img.device) - 1
+    return F.grid_sample(img, grid, mode='bilinear', padding_mode='reflection', align_corners=True)
+
+
+def hflip(img, aug):
+    return torch.where(_view_params(aug, img.device, torch.bool), img.flip(-1), img)
+
+
+def vflip(img, aug):
+    return torch.where(_view_params(aug, img.device, torch.bool), img.flip(-2), img)
+
+
+def rgb_to_grayscale(img, aug, num_output_channels):
+    gray = _grayscale(img).expand(-1, num_output_channels[0], -1, -1)
+    return torch.where(_view_params(aug, img.device, torch.bool), gray, img)
+
+
+def adjust_brightness(img, brightness_factor):
+    return (img * _view_params(brightness_factor, img.device)).clamp(0, 1)
+
+
+def adjust_contrast(img, contrast_factor):
+    mean = _grayscale(img).mean(dim=(-3, -2, -1), keepdim=True)
+    return _blend(img, mean, _view_params(contrast_factor, img.device))
+
+
+def adjust_saturation(img, saturation_factor):
+    return _blend(img, _grayscale(img), _view_params(saturation_factor, img.device))
+
+
+def _rgb2hsv(img):
+    r, g, b = img.unbind(dim=-3)
+    maxc = torch.max(img, dim=-3).values
+    minc = torch.min(img, dim=-3).values
+    eqc = maxc == minc
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    s = cr / torch.where(eqc, ones, maxc)
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+    hr = (maxc == r) * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)) * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)) * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+    return torch.stack((h, s, maxc), dim=-3)
+
+
+def _hsv2rgb(img):
+    h, s, v = img.unbind(dim=-3)
+    i = torch.floor(h * 6.0)
+    f = (h * 6.0) - i
+    i = i.to(dtype=torch.int32) % 6
+    p = torch.clamp(v * (1.0 - s), 0.0, 1.0)
+    q = torch.clamp(v * (1.0 - s * f), 0.0, 1.0)
+    t = torch.clamp(v * (1.0 - s * (1.0 - f)), 0.0, 1.0)
+    mask = i.unsqueeze(dim=-3) == torch.arange(6, device=i.device).view(-1, 1, 1)
+    a1 = torch.stack((v, q, p, p, t, v), dim=-3)
+    a2 = torch.stack((t, v, v, q, p, p), dim=-3)
+    a3 = torch.stack((p, p, t, v, v, q), dim=-3)
+    a4 = torch.stack((a1, a2, a3), dim=-4)
+    return torch.einsum('...ijk, ...xijk -> ...xjk', mask.to(dtype=img.dtype), a4)
+
+
+def adjust_hue(img, hue_factor):
+    hsv = _rgb2hsv(img)
+    h = torch.remainder(hsv[:, 0:1] + _view_params(hue_factor, img.device), 1.0)
+    return _hsv2rgb(torch.cat([h, hsv[:, 1:]], dim=1))
+
+
+def gaussian_blur(img, sigma, kernel_size):
+    """Separable gaussian blur with a different sigma per view (reflect padding, as FT.gaussian_blur)."""
+    k, c, h, w = img.shape
+    ksize = kernel_size[0]
+    x = torch.linspace(-(ksize // 2), ksize // 2, steps=ksize, device=img.device).view(1, -1)
+    kernels = torch.exp(-0.5 * (x / _view_params(sigma, img.device).view(-1, 1)).pow(2))
+    kernels = (kernels / kernels.sum(dim=1, keepdim=True)).repeat_interleave(c, dim=0)
+
+    out = F.pad(img.reshape(1, k * c, h, w), [ksize // 2] * 4, mode='reflect')
+    out = F.conv2d(out, kernels.view(k * c, 1, ksize, 1), groups=k * c)
+    out = F.conv2d(out, kernels.view(k * c, 1, 1, ksize), groups=k * c)
+    return out.view(k, c, h, w)
+
+
+def adjust_sharpness(img, sharpness_factor):
+    c = img.size(1)
+    kernel = torch.ones((3, 3), device=img.device)
+    kernel[1, 1] = 5.0
+    kernel = (kernel / kernel.sum()).expand(c, 1, 3, 3).contiguous()
+    # borders are kept from the original image, as torchvision
+    degenerate = img.clone()
+    degenerate[..., 1:-1, 1:-1] = F.conv2d(img, kernel, groups=c)
+    return _blend(img, degenerate, _view_params(sharpness_factor, img.device))
+
+
+def invert(img, aug):
+    return torch.where(_view_params(aug, img.device, torch.bool), 1.0 - img, img)
+
+
+# The following operate on uint8 images
+
+def posterize(img, bits):
+    masks = [256 - 2 ** (8 - b) for b in bits]
+    return img & _view_params(masks, img.device, torch.uint8)
+
+
+def equalize(img, aug):
+    aug = torch.as_tensor(aug, dtype=torch.bool, device=img.device)
+    img = img.clone()
+    if aug.any():
+        img[aug] = FT.equalize(img[aug])
+    return img
+
+
+# name of the ManualTransform function: (batched function, whether it operates on uint8 images)
+BATCHED_FNS = {
+    'rotate': (rotate, False),
+    'affine': (affine, False),
+    'resized_crop': (resized_crop, False),
+    'deform': (elastic_deform, False),
+    'hflip': (hflip, False),
+    'vflip': (vflip, False),
+    'rgb_to_grayscale': (rgb_to_grayscale, False),
+    'adjust_brightness': (adjust_brightness, False),
+    'adjust_contrast': (adjust_contrast, False),
+    'adjust_saturation': (adjust_saturation, False),
+    'adjust_hue': (adjust_hue, False),
+    'gaussian_blur': (gaussian_blur, False),
+    'adjust_sharpness': (adjust_sharpness, False),
+    'invert': (invert, False),
+    'posterize': (posterize, True),
+    'equalize': (equalize, True),
+}
@@ -0,0 +1,133 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from torch.utils.data.sampler import SubsetRandomSampler
+from tqdm import tqdm
+
+
+class FeatureStatistics(object):
+    """
+    Streaming estimate of the mean and covariance of features, accumulated batch by batch in float64
+    with the parallel form of Welford's algorithm (Chan et al.), so memory does not grow with the number of images.
+    Partial statistics from several processes can be combined with `merge`.
+    Args:
+        dim: dimension of the features.
+    """
+
+    def __init__(self, dim):
+        self.dim = dim
+        self.n = 0
+        self.mean = torch.zeros(dim, dtype=torch.float64)
+        self.M2 = torch.zeros((dim, dim), dtype=torch.float64)
+
+    def update(self, features):
+        """Add a (batch_size, dim) batch of features to the statistics."""
+        features = features.detach().cpu().to(torch.float64)
+        batch_mean = features.mean(dim=0)
+        centred = features - batch_mean
+        self._combine(features.size(0), batch_mean, centred.T @ centred)
+
+    def merge(self, other):
+        """Add the statistics accumulated by `other` (e.g. in another process) to these."""
+        self._combine(other.n, other.mean, other.M2)
+
+    def _combine(self, n_b, mean_b, M2_b):
+        if n_b == 0:
+            return
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        self.mean += delta * (n_b / n)
+        self.M2 += M2_b + torch.outer(delta, delta) * (self.n * n_b / n)
+        self.n = n
+
+    @property
+    def covariance(self):
+        # unbiased estimate, as np.cov
+        return self.M2 / (self.n - 1)
+
+    def state_dict(self):
+        return {'n': self.n, 'mean': self.mean, 'M2': self.M2}
+
+    @classmethod
+    def from_state_dict(cls, state_dict):
+        stats = cls(state_dict['mean'].size(0))
+        stats.n = state_dict['n']
+        stats.mean = state_dict['mean']
+        stats.M2 = state_dict['M2']
+        return stats
+
+
+def accumulate_feature_statistics(model, dataloader, feature_dim, device):
+    """Stream the features of every batch of `dataloader` through a FeatureStatistics accumulator."""
+    stats = FeatureStatistics(feature_dim)
+    with torch.no_grad():
+        for data, _ in tqdm(dataloader):
+            stats.update(model(data.to(device)))
+    return stats
+
+
+def merge_shard_statistics(shard_paths):
+    """Merge the partial statistics saved at `shard_paths`, or return None if some shards are not finished yet."""
+    if not all(os.path.exists(path) for path in shard_paths):
+        return None
+    stats = None
+    for path in shard_paths:
+        shard_stats = FeatureStatistics.from_state_dict(torch.load(path))
+        if stats is None:
+            stats = shard_stats
+        else:
+            stats.merge(shard_stats)
+    return stats
+
+
+def estimate_feature_statistics(model, dataset, feature_dim, batch_size, device, fraction=0.1,
+                                shard=0, num_shards=1, shard_prefix=None, shard_settings=None):
+    """ Estimate the mean and covariance of the features of `dataset`.
+
+    Uses max(1000, fraction * len(dataset)) sampled images (the full dataset if fraction >= 1 or it contains
+    < 1000 images). With num_shards > 1, this process only handles every num_shards-th sampled image, saves its
+    partial statistics to `<shard_prefix>_stats_<hash>_shard<shard>of<num_shards>.pth` and merges all shards once they
+    exist. The hash covers `shard_settings` (e.g. the model checkpoint and the transform), the fraction and the dataset
+    size, so shards computed with other settings are never merged.
+
+    Returns:
+        FeatureStatistics : the statistics, or None if some shards have not been computed yet
+    """
+    if fraction >= 1 or len(dataset) < 1000:
+        indices = np.arange(len(dataset))
+    else:
+        indices = np.random.choice(np.arange(len(dataset)), max(1000, int(fraction * len(dataset))))
+    indices = indices[shard::num_shards]
+    dataloader = DataLoader(dataset, batch_size=batch_size, sampler=SubsetRandomSampler(indices))
+
+    stats = accumulate_feature_statistics(model, dataloader, feature_dim, device)
+    if num_shards == 1:
+        return stats
+
+    settings = dict(shard_settings or {}, fraction=fraction, num_shards=num_shards, num_images=len(dataset))
+    settings_hash = hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:12]
+    shard_paths = [f'{shard_prefix}_stats_{settings_hash}_shard{i}of{num_shards}.pth' for i in range(num_shards)]
+    # written to a temporary file first, so a half-written shard is never merged
+    torch.save(stats.state_dict(), shard_paths[shard] + '.tmp')
+    os.replace(shard_paths[shard] + '.tmp', shard_paths[shard])
+    return merge_shard_statistics(shard_paths)
+
+
+def covariance_cholesky(cov_matrix, epsilon=1e-6):
+    """Lower Cholesky factor C of the (regularised) covariance matrix, C C^T = cov_matrix + epsilon * I."""
+    cov_matrix = torch.as_tensor(cov_matrix, dtype=torch.float64)
+    return torch.linalg.cholesky(cov_matrix + epsilon * torch.eye(cov_matrix.size(0), dtype=torch.float64))
+
+
+def whiten(x, cholesky_matrix):
+    """Map the rows of x to C^-1 x, so that inner products become x^T cov^-1 y (no explicit inverse needed)."""
+    return torch.linalg.solve_triangular(cholesky_matrix.T, x.to(torch.float64), upper=True, left=False)
+
+
+def mahalanobis(x, y, cholesky_matrix):
+    """Mahalanobis distance between the rows of x and y (broadcast) under the covariance factored as C C^T."""
+    return whiten(x.to(torch.float64) - y.to(torch.float64), cholesky_matrix).norm(dim=-1)
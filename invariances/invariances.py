@@ -3,13 +3,12 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.data import DataLoader, ConcatDataset
-from torch.utils.data.sampler import SubsetRandomSampler
+from torch.utils.data import ConcatDataset
 from torchvision import datasets, models, transforms
 import torchvision.transforms.functional as FT
 
 import os
-import PIL
+import sys
 import pickle
 import argparse
 import logging
@@ -19,8 +18,6 @@ from pathlib import Path
 from itertools import product
 
 import numpy as np
-import albumentations 
-from scipy.spatial.distance import mahalanobis
 
 from datasets.transforms import HistogramNormalize
 from datasets.custom_chexpert_dataset import CustomChexpertDataset
@@ -34,6 +31,9 @@ from datasets.custom_stoic_dataset import CustomStoicDataset
 from datasets.custom_chestx_dataset import CustomChestXDataset
 
 from models.backbones import ResNetBackbone, ResNet18Backbone, DenseNetBackbone
+from invariances.batched_transforms import BATCHED_FNS, elastic_deform
+from datasets.feature_store import checkpoint_hash
+from invariances.feature_statistics import estimate_feature_statistics, covariance_cholesky, whiten, mahalanobis
 
 
 
@@ -41,13 +41,13 @@ from models.backbones import ResNetBackbone, ResNet18Backbone, DenseNetBackbone
 
 # Image transformations
 
-def deform(img, points, sigma):
-    # convert to numpy
-    img = np.array(img)
-    # apply deformation
-    img = albumentations.geometric.transforms.ElasticTransform(sigma=sigma, always_apply=True, approximate=True)(image=img)['image']
+def deform(img, sigma, seed):
+    # convert to a batch of one tensor image
+    img = FT.pil_to_tensor(img).unsqueeze(0).to(torch.float32) / 255.
+    # apply deformation (albumentations' ElasticTransform with its default alpha=1, alpha_affine=50)
+    img = elastic_deform(img, [sigma], [seed])
     # return PIL image
-    return PIL.Image.fromarray(img)
+    return FT.to_pil_image(img[0])
 
 FT.deform = deform
 
@@ -134,12 +134,11 @@ class ManualTransform(object):
         elif name == 'deform':
             torch.manual_seed(0)
             np.random.seed(0)
-            self.param_keys = ['points', 'sigma'] # 10, 50, 3, 9
-            points = torch.repeat_interleave(torch.arange(2, 10), 32).tolist()
+            self.param_keys = ['sigma', 'seed'] # 10, 50
             sigma = torch.linspace(10, 50, 8).to(int).repeat(32).tolist()
             self.param_vals = [
-                points,
-                sigma
+                sigma,
+                list(range(len(sigma)))  # one fixed displacement field per view
             ]
             self.original_idx = 0
         elif name == 'grayscale':
@@ -187,14 +186,15 @@ class ManualTransform(object):
             if params['aug']:
                 del params['aug']
                 image = eval(f'FT.{self.fn}(image, **params)')
-        elif self.fn == 'translation':
+        elif self.fn in ['translation', 'deform']:
+            # applied after resizing, so that displacements are in pixels of the resized image (as BatchedManualTransform)
             pass
         else:
             image = eval(f'FT.{self.fn}(image, **params)')
 
         if self.fn != 'resized_crop':
             image = FT.resize(image, self.resize)
-            if self.fn == 'translation':
+            if self.fn in ['translation', 'deform']:
                 image = eval(f'FT.{self.fn}(image, **params)')
             image = FT.center_crop(image, self.crop_size)
         image = FT.pil_to_tensor(image).to(torch.float32)
@@ -209,6 +209,33 @@ class ManualTransform(object):
         return tuple(xs)
 
 
+class BatchedManualTransform(ManualTransform):
+    """
+    Builds all k views of ManualTransform as one (k, C, H, W) tensor: the image is resized once and the
+    transformation is applied to the whole batch of views with the tensor ops of invariances.batched_transforms.
+    Unlike ManualTransform, the transformation is applied after resizing, so pixel-valued parameters
+    (translations, crop boxes, blur sigmas) are relative to the resized image. Elastic deformations are applied after
+    resizing in both, so their parameters mean the same in both.
+    Transformations without a batched implementation fall back to ManualTransform.
+    """
+    def __call__(self, x):
+        if self.fn not in BATCHED_FNS:
+            return torch.stack(super().__call__(x))
+        fn, on_uint8 = BATCHED_FNS[self.fn]
+        params = dict([(k, v[:self.k]) for k, v in zip(self.param_keys, self.param_vals)])
+
+        image = FT.pil_to_tensor(FT.resize(x, self.resize))
+        images = image.unsqueeze(0).expand(self.k, -1, -1, -1)
+        if on_uint8:
+            images = fn(images, **params).to(torch.float32) / 255.
+        else:
+            images = fn(images.to(torch.float32) / 255., **params)
+
+        if self.fn != 'resized_crop':
+            images = FT.center_crop(images, self.crop_size)
+        return FT.normalize(images, *self.norm)
+
+
 def D(a, b): # cosine similarity
     return F.cosine_similarity(a, b, dim=-1).mean()
 
@@ -294,9 +321,17 @@ if __name__ == "__main__":
     parser.add_argument('--device', default='cuda', type=str, help='GPU device')
     parser.add_argument('--num-images', default=100, type=int, help='number of images to evaluate invariance on')
     parser.add_argument('--batch-size', default=256, type=int, help='mini-batch size')
+    parser.add_argument('--stats-fraction', default=0.1, type=float,
+                        help='fraction of the dataset to estimate the feature mean and covariance from (1 for all images)')
+    parser.add_argument('--stats-shard', default=0, type=int,
+                        help='index of the shard of images this process computes the feature statistics for')
+    parser.add_argument('--num-stats-shards', default=1, type=int,
+                        help='number of processes the feature statistics are split across (merged once all are done)')
     parser.add_argument('--resize', default=256, type=int, help='resize')
     parser.add_argument('--crop-size', default=224, type=int, help='crop size')
     parser.add_argument('--k', default=None, type=int, help='number of transformations')
+    parser.add_argument('--batched-views', action='store_true', default=False,
+                        help='whether to build all k views of an image as one batch with tensor ops (transforms applied after resizing)')
     parser.add_argument('-n', '--no-norm', action='store_true', default=False,
                         help='whether to turn off data normalisation (based on ImageNet values)')
     args = parser.parse_args()
@@ -356,7 +391,10 @@ if __name__ == "__main__":
         mean_std = [[0.0, 0.0, 0.0], [1.0, 1.0, 1.0]]
         normalise_dict = {'mean': [0.0, 0.0, 0.0], 'std': [1.0, 1.0, 1.0]}
 
-    transform = ManualTransform(args.transform, k, norm=mean_std, resize=args.resize, crop_size=args.crop_size)
+    if args.batched_views:
+        transform = BatchedManualTransform(args.transform, k, norm=mean_std, resize=args.resize, crop_size=args.crop_size)
+    else:
+        transform = ManualTransform(args.transform, k, norm=mean_std, resize=args.resize, crop_size=args.crop_size)
     
     # load datasets
     dset, data_dir = DATASETS[args.dataset]
@@ -376,30 +414,22 @@ if __name__ == "__main__":
         print(f'Computing covariance matrix for {args.model} on dataset {args.dataset}')
         logging.info(f'Computing covariance matrix for {args.model} on dataset {args.dataset}')
 
-        # Calculate (approx.) mean and covariance matrix, 
-        # from > 1000 sampled images (10% of full dataset, or full dataset if contains < 1000 images)
-        if len(clean_dataset) < 1000:
-            clean_dataloader = DataLoader(clean_dataset, batch_size=args.batch_size)
-        else:
-            random_idx = np.random.choice(np.arange(len(clean_dataset)), max(1000, int(0.1*len(clean_dataset))))
-            sub_sampler = SubsetRandomSampler(random_idx)
-            clean_dataloader = DataLoader(clean_dataset, batch_size=args.batch_size, sampler=sub_sampler)
-
-
-        all_features = []
-        with torch.no_grad():
-            progress = tqdm(clean_dataloader)
-            for data, _ in progress:
-                data = data.to(args.device)
-                features = model(data).detach().cpu()
-                all_features.append(features)
-        all_features = torch.cat(all_features)
-
-        mean_feature = all_features.mean(dim=0)
-        cov_matrix = np.cov(all_features, rowvar=False)
-
-        torch.save(mean_feature, f'./misc/invariances/covmatrices/{args.model}_{args.dataset}_mean_feature.pth')
-        torch.save(cov_matrix, f'./misc/invariances/covmatrices/{args.model}_{args.dataset}_feature_cov_matrix.pth')
+        # Calculate (approx.) mean and covariance matrix, streamed over
+        # > 1000 sampled images (10% of full dataset by default, or full dataset if contains < 1000 images)
+        stats = estimate_feature_statistics(model, clean_dataset, feature_dim, args.batch_size, args.device,
+                                            fraction=args.stats_fraction, shard=args.stats_shard,
+                                            num_shards=args.num_stats_shards,
+                                            shard_prefix=f'./misc/invariances/covmatrices/{args.model}_{args.dataset}',
+                                            shard_settings={'checkpoint': checkpoint_hash(args.model),
+                                                            'resize': args.resize, 'crop_size': args.crop_size,
+                                                            'norm': args.norm, 'hist_norm': hist_norm})
+        if stats is None:
+            print(f'Saved feature statistics of shard {args.stats_shard}, waiting for the remaining shards')
+            logging.info(f'Saved feature statistics of shard {args.stats_shard}, waiting for the remaining shards')
+            sys.exit(0)
+
+        torch.save(stats.mean.to(torch.float32), f'./misc/invariances/covmatrices/{args.model}_{args.dataset}_mean_feature.pth')
+        torch.save(stats.covariance.numpy(), f'./misc/invariances/covmatrices/{args.model}_{args.dataset}_feature_cov_matrix.pth')
 
     # Calculate invariances
     L = torch.zeros((args.num_images, k))
@@ -408,17 +438,16 @@ if __name__ == "__main__":
     mean_feature = torch.load(f'./misc/invariances/covmatrices/{args.model}_{args.dataset}_mean_feature.pth')
     cov_matrix = torch.load(f'./misc/invariances/covmatrices/{args.model}_{args.dataset}_feature_cov_matrix.pth')
     
-    epsilon = 1e-6
-    cov_matrix = cov_matrix + epsilon * np.eye(cov_matrix.shape[0])
-    inv_cov_matrix = np.linalg.inv(cov_matrix)
-    cholesky_matrix = torch.linalg.cholesky(torch.from_numpy(inv_cov_matrix).to(torch.float32))
+    # factor the covariance matrix C C^T = cov + epsilon * I, instead of inverting it
+    cholesky_matrix = covariance_cholesky(cov_matrix, epsilon=1e-6)
 
 
     def get_same_batch(sampler, d1, d2):
         for i in sampler:
             img1, _ = d1[i]
             img2, _ = d2[i]
-            yield (torch.stack(img1), img2.unsqueeze(0))
+            # ManualTransform returns a tuple of views, BatchedManualTransform an already stacked tensor
+            yield (img1 if torch.is_tensor(img1) else torch.stack(img1), img2.unsqueeze(0))
 
     sampler = np.random.choice(np.arange(len(dataset)), args.num_images)
     batch_generator = get_same_batch(sampler, dataset, clean_dataset)    
@@ -428,12 +457,11 @@ if __name__ == "__main__":
             clean_feature = model(clean_data.to(args.device)).detach().cpu()
             features = model(data.to(args.device)).detach().cpu()
 
-            a = (mean_feature - clean_feature) @ cholesky_matrix
-
-            for j in range(features.shape[0]):
-                b = (mean_feature - features[j]) @ cholesky_matrix
-                S[i, j] = D(a, b) # cosine similarity
-                L[i, j] = mahalanobis(clean_feature, features[j], inv_cov_matrix) # mahalanobis distance
+            # whiten the clean feature and all k view features at once
+            a = whiten(mean_feature - clean_feature, cholesky_matrix)
+            b = whiten(mean_feature - features, cholesky_matrix)
+            S[i] = F.cosine_similarity(a, b, dim=-1) # cosine similarity
+            L[i] = mahalanobis(clean_feature, features, cholesky_matrix) # mahalanobis distance
 
 
     L = torch.from_numpy(np.nanmean(L, axis=0))
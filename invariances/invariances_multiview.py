@@ -8,6 +8,7 @@ from torch.utils.data.sampler import SubsetRandomSampler
 from torchvision import datasets, models, transforms
 
 import os
+import sys
 import PIL
 from PIL import Image
 import pickle
@@ -19,13 +20,13 @@ from pathlib import Path
 from itertools import product
 
 import numpy as np
-from scipy.spatial.distance import mahalanobis
 
 from datasets.transforms import HistogramNormalize
 from datasets.custom_chexpert_dataset import CustomChexpertDataset
 from datasets.custom_diabetic_retinopathy_dataset import CustomDiabeticRetinopathyDataset 
 
 from models.backbones import ResNetBackbone, ResNet18Backbone, DenseNetBackbone
+from invariances.feature_statistics import estimate_feature_statistics, covariance_cholesky, whiten, mahalanobis
 
 
 def D(a, b): # cosine similarity
@@ -100,6 +101,12 @@ if __name__ == "__main__":
     parser.add_argument('--device', default='cuda', type=str, help='GPU device')
     parser.add_argument('--num-images', default=100, type=int, help='number of images to evaluate invariance on')
     parser.add_argument('--batch-size', default=256, type=int, help='mini-batch size')
+    parser.add_argument('--stats-fraction', default=0.1, type=float,
+                        help='fraction of the dataset to estimate the feature mean and covariance from (1 for all images)')
+    parser.add_argument('--stats-shard', default=0, type=int,
+                        help='index of the shard of images this process computes the feature statistics for')
+    parser.add_argument('--num-stats-shards', default=1, type=int,
+                        help='number of processes the feature statistics are split across (merged once all are done)')
     parser.add_argument('--image-size', default=224, type=int, help='image size')
     parser.add_argument('-n', '--no-norm', action='store_true', default=False,
                         help='whether to turn off data normalisation (based on ImageNet values)')
@@ -168,30 +175,19 @@ if __name__ == "__main__":
         print(f'Computing covariance matrix for {args.model} on dataset {args.dataset}')
         logging.info(f'Computing covariance matrix for {args.model} on dataset {args.dataset}')
 
-        # Calculate (approx.) mean and covariance matrix, 
-        # from > 1000 sampled images (10% of full dataset, or full dataset if contains < 1000 images)
-        if len(clean_dataset) < 1000:
-            clean_dataloader = DataLoader(clean_dataset, batch_size=args.batch_size)
-        else:
-            random_idx = np.random.choice(np.arange(len(clean_dataset)), max(1000, int(0.1*len(clean_dataset))))
-            sub_sampler = SubsetRandomSampler(random_idx)
-            clean_dataloader = DataLoader(clean_dataset, batch_size=args.batch_size, sampler=sub_sampler)
-
-
-        all_features = []
-        with torch.no_grad():
-            progress = tqdm(clean_dataloader)
-            for data, _ in progress:
-                data = data.to(args.device)
-                features = model(data).detach().cpu()
-                all_features.append(features)
-        all_features = torch.cat(all_features)
-
-        mean_feature = all_features.mean(dim=0)
-        cov_matrix = np.cov(all_features, rowvar=False)
+        # Calculate (approx.) mean and covariance matrix, streamed over
+        # > 1000 sampled images (10% of full dataset by default, or full dataset if contains < 1000 images)
+        stats = estimate_feature_statistics(model, clean_dataset, feature_dim, args.batch_size, args.device,
+                                            fraction=args.stats_fraction, shard=args.stats_shard,
+                                            num_shards=args.num_stats_shards,
+                                            shard_prefix=f'./misc/invariances/{args.model}_{args.dataset}')
+        if stats is None:
+            print(f'Saved feature statistics of shard {args.stats_shard}, waiting for the remaining shards')
+            logging.info(f'Saved feature statistics of shard {args.stats_shard}, waiting for the remaining shards')
+            sys.exit(0)
 
-        torch.save(mean_feature, f'./misc/invariances/{args.model}_{args.dataset}_mean_feature.pth')
-        torch.save(cov_matrix, f'./misc/invariances/{args.model}_{args.dataset}_feature_cov_matrix.pth')
+        torch.save(stats.mean.to(torch.float32), f'./misc/invariances/{args.model}_{args.dataset}_mean_feature.pth')
+        torch.save(stats.covariance.numpy(), f'./misc/invariances/{args.model}_{args.dataset}_feature_cov_matrix.pth')
 
 
     # Calculate invariances
@@ -201,10 +197,8 @@ if __name__ == "__main__":
     mean_feature = torch.load(f'./misc/invariances/{args.model}_{args.dataset}_mean_feature.pth')
     cov_matrix = torch.load(f'./misc/invariances/{args.model}_{args.dataset}_feature_cov_matrix.pth')
     
-    epsilon = 1e-6
-    cov_matrix = cov_matrix + epsilon * np.eye(cov_matrix.shape[0])
-    inv_cov_matrix = np.linalg.inv(cov_matrix)
-    cholesky_matrix = torch.linalg.cholesky(torch.from_numpy(inv_cov_matrix).to(torch.float32))
+    # factor the covariance matrix C C^T = cov + epsilon * I, instead of inverting it
+    cholesky_matrix = covariance_cholesky(cov_matrix, epsilon=1e-6)
 
 
     dataloader = DataLoader(multi_views_dataset, batch_size=1, shuffle=True) 
@@ -214,10 +208,10 @@ if __name__ == "__main__":
             feature_1 = model(view_1.to(args.device)).detach().cpu()
             feature_2 = model(view_2.to(args.device)).detach().cpu()
 
-            a = (mean_feature - feature_1) @ cholesky_matrix
-            b = (mean_feature - feature_2) @ cholesky_matrix
+            a = whiten(mean_feature - feature_1, cholesky_matrix)
+            b = whiten(mean_feature - feature_2, cholesky_matrix)
             S[i] = D(a, b) # cosine similarity
-            L[i] = mahalanobis(feature_1, feature_2, inv_cov_matrix) # mahalanobis distance
+            L[i] = mahalanobis(feature_1, feature_2, cholesky_matrix) # mahalanobis distance
 
     L = np.nanmean(L)
     S = np.nanmean(S)
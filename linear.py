@@ -30,7 +30,8 @@ from datasets.custom_montgomery_cxr_dataset import CustomMontgomeryCXRDataset
 from datasets.custom_shenzhen_cxr_dataset import CustomShenzhenCXRDataset
 from datasets.custom_stoic_dataset import CustomStoicDataset
 from datasets.transforms import HistogramNormalize
-from models.backbones import ResNetBackbone, ResNet18Backbone, DenseNetBackbone
+from datasets.feature_store import FeatureStore
+from models.backbones import load_backbone
 
 
 # Lostic Regression class
@@ -72,10 +73,119 @@ class LogisticRegression(nn.Module):
             raise Exception(f'Metric {self.metric} not implemented')
 
 
+# Logistic regression fitted for a whole path of C values in PyTorch
+class PathLogisticRegression():
+    """
+    Multinomial logistic regression solved with L-BFGS in PyTorch for a path of C values.
+    For each C, minimises the same objective as sklearn (C * sum of cross-entropies + 0.5 * ||W||^2, bias not
+    penalised), scaled by 1 / (C * n). Every C is fitted as its own problem (own line search, iteration budget and
+    stopping criterion), warm-started from the solution of the previous C, and the C values whose gradient is still
+    above `tol` after `max_iter` iterations are logged as not converged.
+    The torch thread count is set to `num_threads` (default: all available cores) while fitting, then restored.
+    """
+    def __init__(self, input_dim, num_classes, metric, device='cpu', max_iter=100, tol=1e-4, num_threads=None):
+        self.input_dim = input_dim
+        self.num_classes = num_classes
+        self.metric = metric
+        self.device = device
+        self.max_iter = max_iter
+        self.tol = tol
+        if num_threads is None:
+            num_threads = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        self.num_threads = num_threads
+        self.C = 1.
+
+        if self.metric not in ['accuracy', 'mean per-class accuracy']:
+            raise Exception(f'Metric {self.metric} not implemented')
+
+        print('Logistic regression:')
+        print(f'\t solver = L-BFGS (torch)')
+        print(f"\t classes = {self.num_classes}")
+        print(f"\t metric = {self.metric}")
+
+    def set_params(self, d):
+        self.C = d['C']
+
+    def fit_logistic_regression(self, X_train, y_train, X_test, y_test):
+        return self.fit_logistic_regression_path([self.C], X_train, y_train, X_test, y_test)[0]
+
+    def fit_logistic_regression_path(self, Cs, X_train, y_train, X_test, y_test):
+        """Fit one classifier per value in `Cs` and return their scores on the test set."""
+        num_threads = torch.get_num_threads()
+        if self.device == 'cpu':
+            torch.set_num_threads(self.num_threads)
+        try:
+            return self._fit_path(Cs, X_train, y_train, X_test, y_test)
+        finally:
+            torch.set_num_threads(num_threads)
+
+    def _fit_path(self, Cs, X_train, y_train, X_test, y_test):
+        classes, y_train = np.unique(y_train, return_inverse=True)
+        X_train = torch.as_tensor(np.asarray(X_train, dtype=np.float32), device=self.device)
+        X_test = torch.as_tensor(np.asarray(X_test, dtype=np.float32), device=self.device)
+        y_train = torch.as_tensor(y_train, device=self.device)
+        y_test = torch.as_tensor(np.asarray(y_test), device=self.device)
+        classes = torch.as_tensor(classes, device=self.device)
+
+        W = torch.zeros((X_train.size(1), len(classes)), device=self.device)
+        b = torch.zeros(len(classes), device=self.device)
+
+        test_scores = []
+        for C in tqdm(Cs, desc='Fitting regularisation path'):
+            # warm start from the solution of the previous C
+            W, b, converged = self._fit(X_train, y_train, float(C), W, b)
+            if not converged:
+                message = f'Logistic regression with C={C} did not converge in {self.max_iter} iterations'
+                print(message)
+                logging.warning(message)
+
+            with torch.no_grad():
+                pred_test = classes[(torch.matmul(X_test, W) + b).argmax(dim=-1)]
+            test_scores.append(self._score(pred_test.unsqueeze(0), y_test)[0])
+
+        return test_scores
+
+    def _fit(self, X, y, C, W_init, b_init):
+        n = X.size(0)
+        W = W_init.clone().requires_grad_(True)
+        b = b_init.clone().requires_grad_(True)
+        reg = 1. / (2. * C * n)
+
+        optimizer = torch.optim.LBFGS([W, b], lr=1, max_iter=self.max_iter, tolerance_grad=self.tol,
+                                      line_search_fn='strong_wolfe')
+
+        def closure():
+            optimizer.zero_grad()
+            # [logits] = [n, num_classes]
+            logits = torch.matmul(X, W) + b
+            loss = F.cross_entropy(logits, y) + reg * W.pow(2).sum()
+            loss.backward()
+            return loss
+
+        optimizer.step(closure)
+        # converged if the largest gradient entry is below tol (as L-BFGS's own stopping criterion)
+        closure()
+        converged = max(W.grad.abs().max().item(), b.grad.abs().max().item()) <= self.tol
+        return W.detach(), b.detach(), converged
+
+    def _score(self, pred_test, y_test):
+        # [pred_test] = [number of classifiers, number of test samples]
+        correct = (pred_test == y_test).float()
+        if self.metric == 'accuracy':
+            test_scores = 100. * correct.mean(dim=1)
+        else:
+            # per-class recall (the diagonal of the normalised confusion matrix), averaged over classes
+            present = torch.unique(y_test)
+            one_hot = (y_test.unsqueeze(1) == present.unsqueeze(0)).float()
+            test_scores = 100. * (torch.matmul(correct, one_hot) / one_hot.sum(dim=0)).mean(dim=1)
+        return test_scores.tolist()
+
+
 # Class to extract frozen features from pretrained backbone and then fit logistic regression
 class LinearTester():
     def __init__(self, model, train_loader, val_loader, trainval_loader, test_loader, batch_size, metric,
-                 device, num_classes, feature_dim=2048, wd_range=None):
+                 device, num_classes, feature_dim=2048, wd_range=None, feature_store=None, dataset=None,
+                 single_pass=False, solver='sklearn', feature_dtype='float32'):
         self.model = model
         self.train_loader = train_loader
         self.val_loader = val_loader
@@ -86,6 +196,11 @@ class LinearTester():
         self.device = device
         self.num_classes = num_classes
         self.feature_dim = feature_dim
+        self.feature_dtype = feature_dtype
+        self.feature_store = feature_store
+        self.dataset = dataset
+        self.single_pass = single_pass
+        self.train_set_features = None
         self.best_params = {}
 
         if wd_range is None:
@@ -93,28 +208,74 @@ class LinearTester():
         else:
             self.wd_range = wd_range
 
-        self.classifier = LogisticRegression(self.feature_dim, self.num_classes, self.metric).to(self.device)
+        self.solver = solver
+        if self.solver == 'torch':
+            self.classifier = PathLogisticRegression(self.feature_dim, self.num_classes, self.metric, device=self.device)
+        else:
+            self.classifier = LogisticRegression(self.feature_dim, self.num_classes, self.metric).to(self.device)
 
     def get_features(self, train_loader, test_loader, model, test=True):
         """Extract features from pretrained backbone."""
-        X_train_feature, y_train = self._inference(train_loader, model, 'train')
-        X_test_feature, y_test = self._inference(test_loader, model, 'test' if test else 'val')
+        X_train_feature, y_train = self._split_features(train_loader, model, 'trainval' if test else 'train')
+        X_test_feature, y_test = self._split_features(test_loader, model, 'test' if test else 'val')
         return X_train_feature, y_train, X_test_feature, y_test
 
+    def _split_features(self, loader, model, split):
+        if self.single_pass and split in ['train', 'val', 'trainval']:
+            return self._train_set_inference(loader, model, split)
+        return self._inference(loader, model, split)
+
+    def _train_set_inference(self, loader, model, split):
+        """Select the features of a train / val / trainval split from a single in-order pass over the training set."""
+        if self.train_set_features is None:
+            # train, val and trainval loaders all iterate over the same (deterministically transformed) training set
+            full_loader = DataLoader(loader.dataset, batch_size=self.batch_size, shuffle=False,
+                                     num_workers=loader.num_workers, pin_memory=loader.pin_memory)
+            self.train_set_features = self._inference(full_loader, model, 'train_full')
+        X_feature, y = self.train_set_features
+
+        indices = getattr(loader.sampler, 'indices', None)
+        if indices is None:
+            return X_feature, y
+        indices = np.asarray(indices)
+        print(f'Selected {len(indices)} features for {split} set from the training set features')
+        return X_feature[indices], y[indices]
+
     def _inference(self, loader, model, split):
+        if self.feature_store is not None:
+            # samplers over a subset of the dataset (train / val) expose their indices
+            # features of images read from the pre-resized image cache are stored apart from the original ones
+            image_cache = getattr(loader.dataset, 'image_cache', None)
+            key = self.feature_store.key(model.model_name, self.dataset, split, loader.dataset.transform,
+                                         indices=getattr(loader.sampler, 'indices', None), dtype=self.feature_dtype,
+                                         image_cache=image_cache.size if image_cache is not None else None)
+            cached = self.feature_store.load(key)
+            if cached is not None:
+                print(f'Loaded cached features for {split} set from {self.feature_store.path(key)}')
+                return cached
+
+        # write each batch straight into preallocated arrays (memory-mapped when using the feature store)
+        num_samples = len(loader.sampler)
+        if self.feature_store is not None:
+            feature_vector = self.feature_store.allocate(key, (num_samples, self.feature_dim))
+        else:
+            feature_vector = np.empty((num_samples, self.feature_dim), dtype=self.feature_dtype)
+        labels_vector = np.empty(num_samples, dtype=int)
+
         model.eval()
-        feature_vector = []
-        labels_vector = []
-        for data in tqdm(loader, desc=f'Computing features for {split} set'):
-            batch_x, batch_y = data
-            batch_x = batch_x.to(self.device)
-            labels_vector.extend(np.array(batch_y))
+        offset = 0
+        with torch.no_grad():
+            for data in tqdm(loader, desc=f'Computing features for {split} set'):
+                batch_x, batch_y = data
+                batch_x = batch_x.to(self.device)
 
-            features = model(batch_x)
-            feature_vector.extend(features.cpu().detach().numpy())
+                features = model(batch_x)
+                feature_vector[offset:offset + len(features)] = features.cpu().numpy()
+                labels_vector[offset:offset + len(features)] = np.asarray(batch_y)
+                offset += len(features)
 
-        feature_vector = np.array(feature_vector)
-        labels_vector = np.array(labels_vector, dtype=int)
+        if self.feature_store is not None:
+            self.feature_store.save(key, feature_vector, labels_vector)
 
         return feature_vector, labels_vector
 
@@ -123,11 +284,20 @@ class LinearTester():
         X_train_feature, y_train, X_val_feature, y_val = self.get_features(
             self.train_loader, self.val_loader, self.model, test=False
         )
+        if self.solver == 'torch':
+            # fit the whole path of C values as one batched problem
+            test_scores = self.classifier.fit_logistic_regression_path(
+                [1. / wd.item() for wd in self.wd_range], X_train_feature, y_train, X_val_feature, y_val
+            )
+
         best_score = 0
-        for wd in tqdm(self.wd_range, desc='Selecting best hyperparameters'):
+        for i, wd in enumerate(tqdm(self.wd_range, desc='Selecting best hyperparameters')):
             C = 1. / wd.item()
-            self.classifier.set_params({'C': C})
-            test_score = self.classifier.fit_logistic_regression(X_train_feature, y_train, X_val_feature, y_val)
+            if self.solver == 'torch':
+                test_score = test_scores[i]
+            else:
+                self.classifier.set_params({'C': C})
+                test_score = self.classifier.fit_logistic_regression(X_train_feature, y_train, X_val_feature, y_val)
             print(f'Accuracy on val set: {test_score:.2f}% using hyperparameter C: {C:.3f}')
             logging.info(f'Accuracy on val set: {test_score:.2f}% using hyperparameter C: {C:.3f}')
 
@@ -149,10 +319,28 @@ class LinearTester():
 
 # Data classes and functions
 
-def get_dataset(dset, root, split, transform):
+def get_dataset(dset, root, split, transform, image_cache=None):
+    if image_cache is not None:
+        # read the images from the pre-resized image cache (see datasets/image_cache.py)
+        return dset(root, train=(split == 'train'), transform=transform, download=True, cache_size=image_cache)
     return dset(root, train=(split == 'train'), transform=transform, download=True)
 
 
+def get_transform(normalise_dict, hist_norm, image_size):
+    """Deterministic evaluation transform: resize, centre crop and normalisation (histogram or mean/std)."""
+    if hist_norm:
+        normalize = HistogramNormalize()
+    else:
+        normalize = transforms.Normalize(**normalise_dict)
+
+    return transforms.Compose([
+        transforms.Resize(image_size, interpolation=PIL.Image.BICUBIC),
+        transforms.CenterCrop(image_size),
+        transforms.ToTensor(),
+        normalize,
+    ])
+
+
 def get_train_valid_loader(dset,
                            data_dir,
                            normalise_dict,
@@ -163,7 +351,8 @@ def get_train_valid_loader(dset,
                            valid_size=0.2,
                            shuffle=True,
                            num_workers=1,
-                           pin_memory=True):
+                           pin_memory=True,
+                           image_cache=None):
     """
     Utility function for loading and returning train and valid
     multi-process iterators.
@@ -182,6 +371,8 @@ def get_train_valid_loader(dset,
     - num_workers: number of subprocesses to use when loading the dataset.
     - pin_memory: whether to copy tensors into CUDA pinned memory. Set it to
       True if using GPU.
+    - image_cache: short side of the pre-resized image cache to read the images
+      from (None to decode the original files).
     Returns
     -------
     - train_loader: training set iterator.
@@ -191,29 +382,15 @@ def get_train_valid_loader(dset,
     error_msg = "[!] valid_size should be in the range [0, 1]."
     assert ((valid_size >= 0) and (valid_size <= 1)), error_msg
 
-    normalize = transforms.Normalize(**normalise_dict)
-
     # define transforms
-    if hist_norm:
-        transform = transforms.Compose([
-            transforms.Resize(image_size, interpolation=PIL.Image.BICUBIC),
-            transforms.CenterCrop(image_size),
-            transforms.ToTensor(),
-            HistogramNormalize(),
-        ])
-    else:
-        transform = transforms.Compose([
-            transforms.Resize(image_size, interpolation=PIL.Image.BICUBIC),
-            transforms.CenterCrop(image_size),
-            transforms.ToTensor(),
-            normalize,
-        ])
+    transform = get_transform(normalise_dict, hist_norm, image_size)
 
     # Assume no predefined train-valid split
     # Select a random subset of the train set to form the validation set
-    train_dataset = get_dataset(dset, data_dir, 'train', transform)
-    valid_dataset = get_dataset(dset, data_dir, 'train', transform)
-    trainval_dataset = get_dataset(dset, data_dir, 'train', transform)
+    # (the transform is deterministic, so the three loaders can share one dataset object)
+    train_dataset = get_dataset(dset, data_dir, 'train', transform, image_cache)
+    valid_dataset = train_dataset
+    trainval_dataset = train_dataset
 
     num_train = len(train_dataset)
     indices = list(range(num_train))
@@ -250,7 +427,8 @@ def get_test_loader(dset,
                     image_size,
                     shuffle=False,
                     num_workers=1,
-                    pin_memory=True):
+                    pin_memory=True,
+                    image_cache=None):
     """
     Utility function for loading and returning a multi-process
     test iterator.
@@ -266,30 +444,17 @@ def get_test_loader(dset,
     - num_workers: number of subprocesses to use when loading the dataset.
     - pin_memory: whether to copy tensors into CUDA pinned memory. Set it to
       True if using GPU.
+    - image_cache: short side of the pre-resized image cache to read the images
+      from (None to decode the original files).
     Returns
     -------
     - data_loader: test set iterator.
     """
 
-    normalize = transforms.Normalize(**normalise_dict)
-
     # define transforms
-    if hist_norm:
-        transform = transforms.Compose([
-            transforms.Resize(image_size, interpolation=PIL.Image.BICUBIC),
-            transforms.CenterCrop(image_size),
-            transforms.ToTensor(),
-            HistogramNormalize(),
-        ])
-    else:
-        transform = transforms.Compose([
-            transforms.Resize(image_size, interpolation=PIL.Image.BICUBIC),
-            transforms.CenterCrop(image_size),
-            transforms.ToTensor(),
-            normalize,
-        ])
+    transform = get_transform(normalise_dict, hist_norm, image_size)
 
-    dataset = get_dataset(dset, data_dir, 'test', transform)
+    dataset = get_dataset(dset, data_dir, 'test', transform, image_cache)
 
     data_loader = DataLoader(
         dataset, batch_size=batch_size, shuffle=shuffle,
@@ -300,14 +465,16 @@ def get_test_loader(dset,
 
 
 
-def prepare_data(dset, data_dir, batch_size, image_size, normalisation, hist_norm):
+def prepare_data(dset, data_dir, batch_size, image_size, normalisation, hist_norm, image_cache=None):
     if normalisation:
         normalise_dict = {'mean': [0.485, 0.456, 0.406], 'std': [0.229, 0.224, 0.225]}
     else:
         normalise_dict = {'mean': [0.0, 0.0, 0.0], 'std': [1.0, 1.0, 1.0]}
     train_loader, val_loader, trainval_loader = get_train_valid_loader(dset, data_dir, normalise_dict,
-                                                hist_norm, batch_size, image_size, random_seed=0)
-    test_loader = get_test_loader(dset, data_dir, normalise_dict, hist_norm, batch_size, image_size)
+                                                hist_norm, batch_size, image_size, random_seed=0,
+                                                image_cache=image_cache)
+    test_loader = get_test_loader(dset, data_dir, normalise_dict, hist_norm, batch_size, image_size,
+                                  image_cache=image_cache)
 
     return train_loader, val_loader, trainval_loader, test_loader
 
@@ -340,8 +507,22 @@ if __name__ == "__main__":
     parser.add_argument('-c', '--C', type=float, default=None, help='sklearn C value (1 / weight_decay), if not tuning on validation set')
     parser.add_argument('-n', '--no-norm', action='store_true', default=False,
                         help='whether to turn off data normalisation (based on ImageNet values)')
+    parser.add_argument('-s', '--solver', type=str, default='sklearn',
+                        help='logistic regression solver (sklearn | torch), torch fits the whole C path in PyTorch')
+    parser.add_argument('--single-pass', action='store_true', default=False,
+                        help='whether to extract the training set features once and select train/val/trainval from them')
+    parser.add_argument('--feature-dtype', type=str, default='float32',
+                        help='dtype to store the extracted features in (float32 | float16)')
+    parser.add_argument('--cache-features', action='store_true', default=False,
+                        help='whether to store extracted features on disk and reuse them in later runs')
+    parser.add_argument('--feature-dir', type=str, default='./misc/features', help='directory of the feature store')
+    parser.add_argument('--image-cache', type=int, default=None,
+                        help='short side of the pre-resized image cache to read the images from (224 | 242 | 256), see datasets/image_cache.py')
     parser.add_argument('--device', type=str, default='cuda', help='CUDA or CPU training (cuda | cpu)')
     args = parser.parse_args()
+    if args.image_cache is not None and args.image_cache < args.image_size:
+        parser.error(f'--image-cache {args.image_cache} is smaller than --image-size {args.image_size}, '
+                     f'the cached images would be upsampled')
     args.norm = not args.no_norm
     print(args)
 
@@ -364,33 +545,21 @@ if __name__ == "__main__":
     # prepare data loaders
     train_loader, val_loader, trainval_loader, test_loader = prepare_data(
         dset, data_dir, args.batch_size, args.image_size, normalisation=args.norm,
-        hist_norm=hist_norm)
+        hist_norm=hist_norm, image_cache=args.image_cache)
 
 
     # load pretrained model
-    if args.model in ['mimic-chexpert_lr_0.1', 'mimic-chexpert_lr_0.01', 'mimic-chexpert_lr_1.0', 'supervised_d121']:
-        model = DenseNetBackbone(args.model)
-        feature_dim = 1024
-    elif 'mimic-cxr' in args.model:
-        if 'r18' in args.model:
-            model = ResNet18Backbone(args.model)
-            feature_dim = 512
-        else:
-            model = DenseNetBackbone(args.model)
-            feature_dim = 1024
-    elif args.model == 'supervised_r18':
-        model = ResNet18Backbone(args.model)
-        feature_dim = 512
-    else:
-        model = ResNetBackbone(args.model)
-        feature_dim = 2048
-
+    model, feature_dim = load_backbone(args.model)
     model = model.to(args.device)
 
 
+    feature_store = FeatureStore(args.feature_dir) if args.cache_features else None
+
     # evaluate model on dataset by fitting logistic regression
     tester = LinearTester(model, train_loader, val_loader, trainval_loader, test_loader, args.batch_size,
-                          metric, args.device, num_classes, feature_dim, wd_range=torch.logspace(-6, 5, args.wd_values))
+                          metric, args.device, num_classes, feature_dim, wd_range=torch.logspace(-6, 5, args.wd_values),
+                          feature_store=feature_store, dataset=args.dataset, single_pass=args.single_pass,
+                          solver=args.solver, feature_dtype=args.feature_dtype)
 
     if args.C is None:
         # tune hyperparameters
@@ -1,9 +1,28 @@
 import os
+from collections import defaultdict
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torchvision import datasets, transforms, models
 
+def _resnet_stages(model):
+    stages = [
+        (lambda x: model.relu(model.bn1(model.conv1(x))), 7, 2, 3),
+        (model.maxpool, 3, 2, 1),
+    ]
+    for layer in [model.layer1, model.layer2, model.layer3, model.layer4]:
+        for block in layer:
+            if isinstance(block, models.resnet.BasicBlock):
+                # two 3x3 convolutions, the first one strided
+                stride = block.conv1.stride[0]
+                stages.append((block, 2 * stride + 3, stride, stride + 1))
+            else:
+                # 1x1, strided 3x3, 1x1 convolutions
+                stages.append((block, 3, block.conv2.stride[0], 1))
+    return stages
+
+
 class ResNet18Backbone(nn.Module):
     def __init__(self, model_name):
         super().__init__()
@@ -34,6 +53,9 @@ class ResNet18Backbone(nn.Module):
 
         return x
 
+    def stages(self):
+        return _resnet_stages(self.model)
+
 
 class ResNetBackbone(nn.Module):
     def __init__(self, model_name):
@@ -65,6 +87,9 @@ class ResNetBackbone(nn.Module):
 
         return x
 
+    def stages(self):
+        return _resnet_stages(self.model)
+
 
 class DenseNetBackbone(nn.Module):
     def __init__(self, model_name):
@@ -85,4 +110,119 @@ class DenseNetBackbone(nn.Module):
         out = F.relu(features, inplace=True)
         out = F.adaptive_avg_pool2d(out, (1, 1))
         out = torch.flatten(out, 1)
-        return out
\ No newline at end of file
+        return out
+
+    def stages(self):
+        features = self.model.features
+        stages = [
+            (lambda x: features.relu0(features.norm0(features.conv0(x))), 7, 2, 3),
+            (features.pool0, 3, 2, 1),
+        ]
+        for i in range(1, 5):
+            for layer in getattr(features, f'denseblock{i}').values():
+                stages.append((lambda x, layer=layer: torch.cat([x, layer(x)], 1), 3, 1, 1))
+            if i < 4:
+                stages.append((getattr(features, f'transition{i}'), 2, 2, 0))
+        stages.append((lambda x: F.relu(features.norm5(x)), 1, 1, 0))
+        return stages
+
+
+def load_backbone(model_name):
+    """Load the pretrained backbone `model_name` and return it together with the dimension of its features."""
+    if model_name in ['mimic-chexpert_lr_0.1', 'mimic-chexpert_lr_0.01', 'mimic-chexpert_lr_1.0', 'supervised_d121']:
+        return DenseNetBackbone(model_name), 1024
+    elif 'mimic-cxr' in model_name:
+        if 'r18' in model_name:
+            return ResNet18Backbone(model_name), 512
+        else:
+            return DenseNetBackbone(model_name), 1024
+    elif model_name == 'supervised_r18':
+        return ResNet18Backbone(model_name), 512
+    else:
+        return ResNetBackbone(model_name), 2048
+
+
+def _affected_range(start, stop, kernel_size, stride, padding, out_size):
+    """Range of the outputs of a (kernel_size, stride, padding) layer whose receptive field intersects inputs [start, stop)."""
+    first = max(0, (start + padding - kernel_size) // stride + 1)
+    last = min(out_size, -(-(stop + padding) // stride))
+    return first, last
+
+
+def _input_range(first, last, kernel_size, stride, padding, in_size):
+    """Range of inputs needed to compute the outputs [first, last), starting on the stride so the crop stays aligned."""
+    start = max(0, first * stride - padding)
+    start -= start % stride
+    return start, min(in_size, (last - 1) * stride - padding + kernel_size)
+
+
+# Class to compute the features of patched (e.g. occluded) copies of an image by reusing the activations of the original one
+class IncrementalInference():
+    """
+    Caches the activations of `img` at the input of every stage of `backbone` (see its `stages` method). The features of
+    an image differing from `img` only by a patch are then computed by rerunning each stage only on the region whose
+    receptive field covers the changed region of its input, up to the global average pool.
+    The backbone is put in evaluation mode, as batch normalisation has to act pointwise.
+    Args:
+        backbone: ResNetBackbone, ResNet18Backbone or DenseNetBackbone
+        img: (C, H, W) image
+    """
+
+    def __init__(self, backbone, img):
+        backbone.eval()
+        self.stages = backbone.stages()
+        with torch.no_grad():
+            x = img.unsqueeze(0)
+            self.activations = [x[0]]
+            for fn, _, _, _ in self.stages:
+                x = fn(x)
+                self.activations.append(x[0])
+        self.feature_sum = self.activations[-1].sum(dim=(1, 2))
+
+    def forward_patches(self, patches, rows, cols):
+        """ Features of the copies of the image in which the (n, C, h, w) patches are pasted at (rows, cols).
+
+        Samples whose regions have the same geometry at a given stage are run through it as one batch.
+
+        Returns:
+            torch.Tensor : (n, feature_dim) features
+        """
+        h, w = patches.shape[-2:]
+        regions = [(r, r + h, c, c + w) for r, c in zip(rows.tolist(), cols.tolist())]
+        patches = list(patches)
+
+        with torch.no_grad():
+            for (fn, k, s, p), x, y in zip(self.stages, self.activations[:-1], self.activations[1:]):
+                groups = defaultdict(list)
+                for idx, (r0, r1, c0, c1) in enumerate(regions):
+                    out_r0, out_r1 = _affected_range(r0, r1, k, s, p, y.size(1))
+                    out_c0, out_c1 = _affected_range(c0, c1, k, s, p, y.size(2))
+                    in_r0, in_r1 = _input_range(out_r0, out_r1, k, s, p, x.size(1))
+                    in_c0, in_c1 = _input_range(out_c0, out_c1, k, s, p, x.size(2))
+                    geometry = (in_r1 - in_r0, in_c1 - in_c0, out_r0 - in_r0 // s, out_c0 - in_c0 // s,
+                                out_r1 - out_r0, out_c1 - out_c0)
+                    groups[geometry].append((idx, in_r0, in_c0, out_r0, out_c0))
+
+                new_regions, new_patches = [None] * len(regions), [None] * len(regions)
+                for (crop_h, crop_w, off_r, off_c, out_h, out_w), members in groups.items():
+                    crops = []
+                    for idx, in_r0, in_c0, _, _ in members:
+                        crop = x[:, in_r0:in_r0 + crop_h, in_c0:in_c0 + crop_w].clone()
+                        r0, r1, c0, c1 = regions[idx]
+                        # inputs past the end of the crop are not read by any output
+                        r1, c1 = min(r1, in_r0 + crop_h), min(c1, in_c0 + crop_w)
+                        crop[:, r0 - in_r0:r1 - in_r0, c0 - in_c0:c1 - in_c0] = patches[idx][:, :r1 - r0, :c1 - c0]
+                        crops.append(crop)
+                    out = fn(torch.stack(crops))[:, :, off_r:off_r + out_h, off_c:off_c + out_w]
+                    for (idx, _, _, out_r0, out_c0), patch in zip(members, out):
+                        new_regions[idx] = (out_r0, out_r0 + out_h, out_c0, out_c0 + out_w)
+                        new_patches[idx] = patch
+                regions, patches = new_regions, new_patches
+
+            # global average pool: swap the contribution of the changed region
+            y = self.activations[-1]
+            features = []
+            for (r0, r1, c0, c1), patch in zip(regions, patches):
+                old = y[:, r0:r1, c0:c1].sum(dim=(1, 2))
+                features.append((self.feature_sum - old + patch.sum(dim=(1, 2))) / (y.size(1) * y.size(2)))
+        return torch.stack(features)
@@ -1,9 +1,13 @@
+import os
+import json
+import hashlib
 import argparse
 from pprint import pprint
 import csv
 from collections import defaultdict
 
 import lpips   
+import torch
 from torchvision import transforms
 
 import PIL
@@ -42,20 +46,37 @@ def open_and_convert_image(impath, image_size):
 # We use the Perceptual Similarity Metric library, 
 # from the paper "The Unreasonable Effectiveness of Deep Features as a Perceptual Metric" (Zhang et al., 2018)
     
-def perceptual_distance(im1, im2, device):
+# Class to compute the LPIPS distances with the AlexNet, VGG and SqueezeNet networks, each loaded once
+class PerceptualScorer():
+    def __init__(self, device, nets=('alex', 'vgg', 'squeeze')):
+        self.device = device
+        self.loss_fns = {net: lpips.LPIPS(net=net).to(device).eval() for net in nets}
 
-    im1 = im1.to(device)
-    im2 = im2.to(device)
+    def distances(self, original, reconstructions):
+        """ LPIPS distances between one original image and a batch of reconstructions of it.
 
-    loss_fn_alex = lpips.LPIPS(net='alex').to(device)
-    loss_fn_vgg = lpips.LPIPS(net='vgg').to(device)
-    loss_fn_squeeze = lpips.LPIPS(net='squeeze').to(device)
+        Args:
+            original (torch.Tensor) : [1, C, H, W] image, in [-1, 1]
+            reconstructions (torch.Tensor) : [n, C, H, W] images, in [-1, 1]
 
-    d_alex = loss_fn_alex.forward(im1, im2)
-    d_vgg = loss_fn_vgg.forward(im1, im2)
-    d_squeeze = loss_fn_squeeze.forward(im1, im2)
+        Returns:
+            dict : {net: (n,) np.ndarray of distances}
+        """
+        original = original.to(self.device)
+        reconstructions = reconstructions.to(self.device)
+        originals = original.expand(len(reconstructions), -1, -1, -1)
+        with torch.no_grad():
+            return {net: loss_fn(originals, reconstructions).flatten().cpu().numpy()
+                    for net, loss_fn in self.loss_fns.items()}
 
-    return d_alex.cpu().detach().numpy().item(), d_vgg.cpu().detach().numpy().item(), d_squeeze.cpu().detach().numpy().item()
+
+def perceptual_distance(im1, im2, device, scorer=None):
+
+    if scorer is None:
+        scorer = PerceptualScorer(device)
+    d = scorer.distances(im1, im2)
+
+    return d['alex'].item(), d['vgg'].item(), d['squeeze'].item()
 
 original_images = {
     'bach' : ['iv001.tif', './sample_images/bach/iv001.tif'],
@@ -70,148 +91,64 @@ original_images = {
     'imagenet' : ['goldfish.jpeg', 'sample_images/imagenet/goldfish.jpeg']
 }
 
-reconstructed_images = {
-    'bach' : {'simclr-v1' : './reconstructed_images/simclr-v1/simclr-v1_True_iv001.tif',
-                'swav': './reconstructed_images/swav/swav_True_iv001.tif',
-                'byol': './reconstructed_images/byol/byol_True_iv001.tif',
-                'pirl': './reconstructed_images/pirl/pirl_True_iv001.tif',
-                'moco-v2': './reconstructed_images/moco-v2/moco-v2_True_iv001.tif',
-                'mimic-chexpert_lr_0.01': './reconstructed_images/mimic-chexpert_lr_0.01/mimic-chexpert_lr_0.01_True_iv001.tif',
-                'mimic-chexpert_lr_0.1': './reconstructed_images/mimic-chexpert_lr_0.1/mimic-chexpert_lr_0.1_True_iv001.tif',
-                'mimic-chexpert_lr_1.0': './reconstructed_images/mimic-chexpert_lr_1.0/mimic-chexpert_lr_1.0_True_iv001.tif',
-                'mimic-cxr_r18_lr_1e-4': './reconstructed_images/mimic-cxr_r18_lr_1e-4/mimic-cxr_r18_lr_1e-4_True_iv001.tif',
-                'mimic-cxr_d121_lr_1e-4': './reconstructed_images/mimic-cxr_d121_lr_1e-4/mimic-cxr_d121_lr_1e-4_True_iv001.tif',
-                'supervised_r50': './reconstructed_images/supervised_r50/supervised_r50_True_iv001.tif',
-                'supervised_r18': './reconstructed_images/supervised_r18/supervised_r18_True_iv001.tif',
-                'supervised_d121': './reconstructed_images/supervised_d121/supervised_d121_True_iv001.tif'
-                },
-    'chestx' : {'simclr-v1' : './reconstructed_images/simclr-v1/simclr-v1_True_00000001_000.png',
-                'swav': './reconstructed_images/swav/swav_True_00000001_000.png',
-                'byol': './reconstructed_images/byol/byol_True_00000001_000.png',
-                'pirl': './reconstructed_images/pirl/pirl_True_00000001_000.png',
-                'moco-v2': './reconstructed_images/moco-v2/moco-v2_True_00000001_000.png',
-                'mimic-chexpert_lr_0.01': './reconstructed_images/mimic-chexpert_lr_0.01/mimic-chexpert_lr_0.01_True_00000001_000.png',
-                'mimic-chexpert_lr_0.1': './reconstructed_images/mimic-chexpert_lr_0.1/mimic-chexpert_lr_0.1_True_00000001_000.png',
-                'mimic-chexpert_lr_1.0': './reconstructed_images/mimic-chexpert_lr_1.0/mimic-chexpert_lr_1.0_True_00000001_000.png',
-                'mimic-cxr_r18_lr_1e-4': './reconstructed_images/mimic-cxr_r18_lr_1e-4/mimic-cxr_r18_lr_1e-4_True_00000001_000.png',
-                'mimic-cxr_d121_lr_1e-4': './reconstructed_images/mimic-cxr_d121_lr_1e-4/mimic-cxr_d121_lr_1e-4_True_00000001_000.png',
-                'supervised_r50': './reconstructed_images/supervised_r50/supervised_r50_True_00000001_000.png',
-                'supervised_r18': './reconstructed_images/supervised_r18/supervised_r18_True_00000001_000.png',
-                'supervised_d121': './reconstructed_images/supervised_d121/supervised_d121_True_00000001_000.png'
-                },
-    'chexpert' : {'simclr-v1' : './reconstructed_images/simclr-v1/simclr-v1_True_patient00001_view1_frontal.jpg',
-                'swav': './reconstructed_images/swav/swav_True_patient00001_view1_frontal.jpg',
-                'byol': './reconstructed_images/byol/byol_True_patient00001_view1_frontal.jpg',
-                'pirl': './reconstructed_images/pirl/pirl_True_patient00001_view1_frontal.jpg',
-                'moco-v2': './reconstructed_images/moco-v2/moco-v2_True_patient00001_view1_frontal.jpg',
-                'mimic-chexpert_lr_0.01': './reconstructed_images/mimic-chexpert_lr_0.01/mimic-chexpert_lr_0.01_True_patient00001_view1_frontal.jpg',
-                'mimic-chexpert_lr_0.1': './reconstructed_images/mimic-chexpert_lr_0.1/mimic-chexpert_lr_0.1_True_patient00001_view1_frontal.jpg',
-                'mimic-chexpert_lr_1.0': './reconstructed_images/mimic-chexpert_lr_1.0/mimic-chexpert_lr_1.0_True_patient00001_view1_frontal.jpg',
-                'mimic-cxr_r18_lr_1e-4': './reconstructed_images/mimic-cxr_r18_lr_1e-4/mimic-cxr_r18_lr_1e-4_True_patient00001_view1_frontal.jpg',
-                'mimic-cxr_d121_lr_1e-4': './reconstructed_images/mimic-cxr_d121_lr_1e-4/mimic-cxr_d121_lr_1e-4_True_patient00001_view1_frontal.jpg',
-                'supervised_r50': './reconstructed_images/supervised_r50/supervised_r50_True_patient00001_view1_frontal.jpg',
-                'supervised_r18': './reconstructed_images/supervised_r18/supervised_r18_True_patient00001_view1_frontal.jpg',
-                'supervised_d121': './reconstructed_images/supervised_d121/supervised_d121_True_patient00001_view1_frontal.jpg'
-                },
-    'diabetic_retinopathy' : {'simclr-v1' : './reconstructed_images/simclr-v1/simclr-v1_True_34680_left.jpeg',
-                'swav': './reconstructed_images/swav/swav_True_34680_left.jpeg',
-                'byol': './reconstructed_images/byol/byol_True_34680_left.jpeg',
-                'pirl': './reconstructed_images/pirl/pirl_True_34680_left.jpeg',
-                'moco-v2': './reconstructed_images/moco-v2/moco-v2_True_34680_left.jpeg',
-                'mimic-chexpert_lr_0.01': './reconstructed_images/mimic-chexpert_lr_0.01/mimic-chexpert_lr_0.01_True_34680_left.jpeg',
-                'mimic-chexpert_lr_0.1': './reconstructed_images/mimic-chexpert_lr_0.1/mimic-chexpert_lr_0.1_True_34680_left.jpeg',
-                'mimic-chexpert_lr_1.0': './reconstructed_images/mimic-chexpert_lr_1.0/mimic-chexpert_lr_1.0_True_34680_left.jpeg',
-                'mimic-cxr_r18_lr_1e-4': './reconstructed_images/mimic-cxr_r18_lr_1e-4/mimic-cxr_r18_lr_1e-4_True_34680_left.jpeg',
-                'mimic-cxr_d121_lr_1e-4': './reconstructed_images/mimic-cxr_d121_lr_1e-4/mimic-cxr_d121_lr_1e-4_True_34680_left.jpeg',
-                'supervised_r50': './reconstructed_images/supervised_r50/supervised_r50_True_34680_left.jpeg',
-                'supervised_r18': './reconstructed_images/supervised_r18/supervised_r18_True_34680_left.jpeg',
-                'supervised_d121': './reconstructed_images/supervised_d121/supervised_d121_True_34680_left.jpeg'
-                },
-    'ichallenge_amd' : {'simclr-v1' : './reconstructed_images/simclr-v1/simclr-v1_True_AMD_A0001.jpg',
-                'swav': './reconstructed_images/swav/swav_True_AMD_A0001.jpg',
-                'byol': './reconstructed_images/byol/byol_True_AMD_A0001.jpg',
-                'pirl': './reconstructed_images/pirl/pirl_True_AMD_A0001.jpg',
-                'moco-v2': './reconstructed_images/moco-v2/moco-v2_True_AMD_A0001.jpg',
-                'mimic-chexpert_lr_0.01': './reconstructed_images/mimic-chexpert_lr_0.01/mimic-chexpert_lr_0.01_True_AMD_A0001.jpg',
-                'mimic-chexpert_lr_0.1': './reconstructed_images/mimic-chexpert_lr_0.1/mimic-chexpert_lr_0.1_True_AMD_A0001.jpg',
-                'mimic-chexpert_lr_1.0': './reconstructed_images/mimic-chexpert_lr_1.0/mimic-chexpert_lr_1.0_True_AMD_A0001.jpg',
-                'mimic-cxr_r18_lr_1e-4': './reconstructed_images/mimic-cxr_r18_lr_1e-4/mimic-cxr_r18_lr_1e-4_True_AMD_A0001.jpg',
-                'mimic-cxr_d121_lr_1e-4': './reconstructed_images/mimic-cxr_d121_lr_1e-4/mimic-cxr_d121_lr_1e-4_True_AMD_A0001.jpg',
-                'supervised_r50': './reconstructed_images/supervised_r50/supervised_r50_True_AMD_A0001.jpg',
-                'supervised_r18': './reconstructed_images/supervised_r18/supervised_r18_True_AMD_A0001.jpg',
-                'supervised_d121': './reconstructed_images/supervised_d121/supervised_d121_True_AMD_A0001.jpg'
-                },
-    'ichallenge_pm' :{'simclr-v1' : './reconstructed_images/simclr-v1/simclr-v1_True_H0009.jpg',
-                'swav': './reconstructed_images/swav/swav_True_H0009.jpg',
-                'byol': './reconstructed_images/byol/byol_True_H0009.jpg',
-                'pirl': './reconstructed_images/pirl/pirl_True_H0009.jpg',
-                'moco-v2': './reconstructed_images/moco-v2/moco-v2_True_H0009.jpg',
-                'mimic-chexpert_lr_0.01': './reconstructed_images/mimic-chexpert_lr_0.01/mimic-chexpert_lr_0.01_True_H0009.jpg',
-                'mimic-chexpert_lr_0.1': './reconstructed_images/mimic-chexpert_lr_0.1/mimic-chexpert_lr_0.1_True_H0009.jpg',
-                'mimic-chexpert_lr_1.0': './reconstructed_images/mimic-chexpert_lr_1.0/mimic-chexpert_lr_1.0_True_H0009.jpg',
-                'mimic-cxr_r18_lr_1e-4': './reconstructed_images/mimic-cxr_r18_lr_1e-4/mimic-cxr_r18_lr_1e-4_True_H0009.jpg',
-                'mimic-cxr_d121_lr_1e-4': './reconstructed_images/mimic-cxr_d121_lr_1e-4/mimic-cxr_d121_lr_1e-4_True_H0009.jpg',
-                'supervised_r50': './reconstructed_images/supervised_r50/supervised_r50_True_H0009.jpg',
-                'supervised_r18': './reconstructed_images/supervised_r18/supervised_r18_True_H0009.jpg',
-                'supervised_d121': './reconstructed_images/supervised_d121/supervised_d121_True_H0009.jpg'
-                },
-    'montgomerycxr' :{'simclr-v1' : './reconstructed_images/simclr-v1/simclr-v1_True_MCUCXR_0001_0.png',
-                'swav': './reconstructed_images/swav/swav_True_MCUCXR_0001_0.png',
-                'byol': './reconstructed_images/byol/byol_True_MCUCXR_0001_0.png',
-                'pirl': './reconstructed_images/pirl/pirl_True_MCUCXR_0001_0.png',
-                'moco-v2': './reconstructed_images/moco-v2/moco-v2_True_MCUCXR_0001_0.png',
-                'mimic-chexpert_lr_0.01': './reconstructed_images/mimic-chexpert_lr_0.01/mimic-chexpert_lr_0.01_True_MCUCXR_0001_0.png',
-                'mimic-chexpert_lr_0.1': './reconstructed_images/mimic-chexpert_lr_0.1/mimic-chexpert_lr_0.1_True_MCUCXR_0001_0.png',
-                'mimic-chexpert_lr_1.0': './reconstructed_images/mimic-chexpert_lr_1.0/mimic-chexpert_lr_1.0_True_MCUCXR_0001_0.png',
-                'mimic-cxr_r18_lr_1e-4': './reconstructed_images/mimic-cxr_r18_lr_1e-4/mimic-cxr_r18_lr_1e-4_True_MCUCXR_0001_0.png',
-                'mimic-cxr_d121_lr_1e-4': './reconstructed_images/mimic-cxr_d121_lr_1e-4/mimic-cxr_d121_lr_1e-4_True_MCUCXR_0001_0.png',
-                'supervised_r50': './reconstructed_images/supervised_r50/supervised_r50_True_MCUCXR_0001_0.png',
-                'supervised_r18': './reconstructed_images/supervised_r18/supervised_r18_True_MCUCXR_0001_0.png',
-                'supervised_d121': './reconstructed_images/supervised_d121/supervised_d121_True_MCUCXR_0001_0.png'
-                },
-    'shenzhencxr' : {'simclr-v1' : './reconstructed_images/simclr-v1/simclr-v1_True_CHNCXR_0076_0.png',
-                'swav': './reconstructed_images/swav/swav_True_CHNCXR_0076_0.png',
-                'byol': './reconstructed_images/byol/byol_True_CHNCXR_0076_0.png',
-                'pirl': './reconstructed_images/pirl/pirl_True_CHNCXR_0076_0.png',
-                'moco-v2': './reconstructed_images/moco-v2/moco-v2_True_CHNCXR_0076_0.png',
-                'mimic-chexpert_lr_0.01': './reconstructed_images/mimic-chexpert_lr_0.01/mimic-chexpert_lr_0.01_True_CHNCXR_0076_0.png',
-                'mimic-chexpert_lr_0.1': './reconstructed_images/mimic-chexpert_lr_0.1/mimic-chexpert_lr_0.1_True_CHNCXR_0076_0.png',
-                'mimic-chexpert_lr_1.0': './reconstructed_images/mimic-chexpert_lr_1.0/mimic-chexpert_lr_1.0_True_CHNCXR_0076_0.png',
-                'mimic-cxr_r18_lr_1e-4': './reconstructed_images/mimic-cxr_r18_lr_1e-4/mimic-cxr_r18_lr_1e-4_True_CHNCXR_0076_0.png',
-                'mimic-cxr_d121_lr_1e-4': './reconstructed_images/mimic-cxr_d121_lr_1e-4/mimic-cxr_d121_lr_1e-4_True_CHNCXR_0076_0.png',
-                'supervised_r50': './reconstructed_images/supervised_r50/supervised_r50_True_CHNCXR_0076_0.png',
-                'supervised_r18': './reconstructed_images/supervised_r18/supervised_r18_True_CHNCXR_0076_0.png',
-                'supervised_d121': './reconstructed_images/supervised_d121/supervised_d121_True_CHNCXR_0076_0.png'
-                },
-    'stoic' : {'simclr-v1' : './reconstructed_images/simclr-v1/simclr-v1_True_8622.jpeg',
-                'swav': './reconstructed_images/swav/swav_True_8622.jpeg',
-                'byol': './reconstructed_images/byol/byol_True_8622.jpeg',
-                'pirl': './reconstructed_images/pirl/pirl_True_8622.jpeg',
-                'moco-v2': './reconstructed_images/moco-v2/moco-v2_True_8622.jpeg',
-                'mimic-chexpert_lr_0.01': './reconstructed_images/mimic-chexpert_lr_0.01/mimic-chexpert_lr_0.01_True_8622.jpeg',
-                'mimic-chexpert_lr_0.1': './reconstructed_images/mimic-chexpert_lr_0.1/mimic-chexpert_lr_0.1_True_8622.jpeg',
-                'mimic-chexpert_lr_1.0': './reconstructed_images/mimic-chexpert_lr_1.0/mimic-chexpert_lr_1.0_True_8622.jpeg',
-                'mimic-cxr_r18_lr_1e-4': './reconstructed_images/mimic-cxr_r18_lr_1e-4/mimic-cxr_r18_lr_1e-4_True_8622.jpeg',
-                'mimic-cxr_d121_lr_1e-4': './reconstructed_images/mimic-cxr_d121_lr_1e-4/mimic-cxr_d121_lr_1e-4_True_8622.jpeg',
-                'supervised_r50': './reconstructed_images/supervised_r50/supervised_r50_True_8622.jpeg',
-                'supervised_r18': './reconstructed_images/supervised_r18/supervised_r18_True_8622.jpeg',
-                'supervised_d121': './reconstructed_images/supervised_d121/supervised_d121_True_8622.jpeg'
-                },
-    'imagenet' : {'simclr-v1' : './reconstructed_images/simclr-v1/simclr-v1_True_goldfish.jpeg',
-                'swav': './reconstructed_images/swav/swav_True_goldfish.jpeg',
-                'byol': './reconstructed_images/byol/byol_True_goldfish.jpeg',
-                'pirl': './reconstructed_images/pirl/pirl_True_goldfish.jpeg',
-                'moco-v2': './reconstructed_images/moco-v2/moco-v2_True_goldfish.jpeg',
-                'mimic-chexpert_lr_0.01': './reconstructed_images/mimic-chexpert_lr_0.01/mimic-chexpert_lr_0.01_True_goldfish.jpeg',
-                'mimic-chexpert_lr_0.1': './reconstructed_images/mimic-chexpert_lr_0.1/mimic-chexpert_lr_0.1_True_goldfish.jpeg',
-                'mimic-chexpert_lr_1.0': './reconstructed_images/mimic-chexpert_lr_1.0/mimic-chexpert_lr_1.0_True_goldfish.jpeg',
-                'mimic-cxr_r18_lr_1e-4': './reconstructed_images/mimic-cxr_r18_lr_1e-4/mimic-cxr_r18_lr_1e-4_True_goldfish.jpeg',
-                'mimic-cxr_d121_lr_1e-4': './reconstructed_images/mimic-cxr_d121_lr_1e-4/mimic-cxr_d121_lr_1e-4_True_goldfish.jpeg',
-                'supervised_r50': './reconstructed_images/supervised_r50/supervised_r50_True_goldfish.jpeg',
-                'supervised_r18': './reconstructed_images/supervised_r18/supervised_r18_True_goldfish.jpeg',
-                'supervised_d121': './reconstructed_images/supervised_d121/supervised_d121_True_goldfish.jpeg'
-                },
-}
+def file_hash(path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def scan_reconstructed_images(reconstruction_dir, clip='True'):
+    """ Find the reconstructions of the original images, saved by reconstruction.py as <model>/<model>_<clip>_<image name>.
+
+    Reconstructions are matched to the original images by file name, ignoring the extension (e.g. 8622.mha -> 8622.jpeg).
+
+    Returns:
+        dict : {dataset: {model: path}}
+    """
+    datasets_by_stem = {os.path.splitext(name)[0]: dataset for dataset, (name, _) in original_images.items()}
+    reconstructed_images = defaultdict(dict)
+    for model in sorted(os.listdir(reconstruction_dir)):
+        model_dir = os.path.join(reconstruction_dir, model)
+        if not os.path.isdir(model_dir):
+            continue
+        prefix = f'{model}_{clip}_'
+        for filename in sorted(os.listdir(model_dir)):
+            if not filename.startswith(prefix):
+                continue
+            dataset = datasets_by_stem.get(os.path.splitext(filename[len(prefix):])[0])
+            if dataset is not None:
+                reconstructed_images[dataset][model] = os.path.join(model_dir, filename)
+    return dict(reconstructed_images)
+
+
+# Class to store the perceptual distances computed so far, keyed by the contents of the two images
+class DistanceCache():
+    def __init__(self, path):
+        self.path = path
+        self.distances = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.distances = json.load(f)
+
+    @staticmethod
+    def key(original_hash, reconstruction_hash, net, image_size):
+        return f'{original_hash}:{reconstruction_hash}:{net}:{image_size}'
+
+    def get(self, original_hash, reconstruction_hash, net, image_size):
+        return self.distances.get(self.key(original_hash, reconstruction_hash, net, image_size))
+
+    def set(self, original_hash, reconstruction_hash, net, image_size, distance):
+        self.distances[self.key(original_hash, reconstruction_hash, net, image_size)] = distance
+
+    def save(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        # write to a temporary file first so an interrupted run does not corrupt the cache
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.distances, f, indent=4, sort_keys=True)
+        os.replace(self.path + '.tmp', self.path)
 
 
 if __name__ == "__main__":
@@ -221,6 +158,11 @@ if __name__ == "__main__":
     # parser.add_argument('-im2', '--image-2', type=str, default='', help='path for image 2')
     parser.add_argument('-i', '--image-size', type=int, default=224, help='the size of the input images')
     parser.add_argument('--device', type=str, default='cpu', help='CUDA or CPU (cuda | cpu)')
+    parser.add_argument('--reconstruction-dir', type=str, default='./reconstructed_images',
+                        help='directory of the reconstructed images')
+    parser.add_argument('--clip', type=str, default='True', help='clip setting of the reconstructions to compare (True | False)')
+    parser.add_argument('--cache-path', type=str, default='./misc/perceptual-distance/cache.json',
+                        help='path of the cache of computed distances')
     args = parser.parse_args()
     pprint(args)
     
@@ -229,34 +171,46 @@ if __name__ == "__main__":
     results_dict_squeezenet = {}
     csv_columns = ['model']
 
+    # the LPIPS networks are only loaded if some pair is not in the cache
+    scorer = None
+    cache = DistanceCache(args.cache_path)
+    reconstructed_images = scan_reconstructed_images(args.reconstruction_dir, args.clip)
+    nets = ['alex', 'vgg', 'squeeze']
+
     for dataset in original_images:
+        if dataset not in reconstructed_images:
+            continue
         #im1_name = original_images[dataset][0]
         im1_path = original_images[dataset][1]
-        im1 = open_and_convert_image(im1_path, args.image_size)
+        im1_hash = file_hash(im1_path)
         results_dict_alex[dataset] = {}
         results_dict_vgg[dataset] = {}
         results_dict_squeezenet[dataset] = {}
 
         csv_columns.append(dataset)
-        
-        for model in reconstructed_images[dataset]:
-            im2_path = reconstructed_images[dataset][model]
-            im2 = open_and_convert_image(im2_path, args.image_size)
-
-            d_alex, d_vgg, d_squeeze = perceptual_distance(im1, im2, args.device)
-            
-            # results_dict[dataset][model] = {
-            #     'AlexNet' : d_alex,
-            #     'VGG' : d_vgg,
-            #     'SqueezeNet' : d_squeeze,
-            # }
-            # print(f'Perceptual distance between images {im1_name} and {im2_path}:')
-            
-            # pprint(results_dict[dataset][model])
-
-            results_dict_alex[dataset][model] = d_alex
-            results_dict_vgg[dataset][model] = d_vgg
-            results_dict_squeezenet[dataset][model] = d_squeeze
+
+        hashes = {model: file_hash(path) for model, path in reconstructed_images[dataset].items()}
+        new_models = [model for model in hashes
+                      if any(cache.get(im1_hash, hashes[model], net, args.image_size) is None for net in nets)]
+
+        # compare all the new or changed reconstructions of the dataset image in one batch
+        if new_models:
+            print(f'Computing perceptual distances for {dataset}: {", ".join(new_models)}')
+            if scorer is None:
+                scorer = PerceptualScorer(args.device, nets)
+            im1 = open_and_convert_image(im1_path, args.image_size)
+            im2 = torch.cat([open_and_convert_image(reconstructed_images[dataset][model], args.image_size)
+                             for model in new_models])
+            distances = scorer.distances(im1, im2)
+            for i, model in enumerate(new_models):
+                for net in nets:
+                    cache.set(im1_hash, hashes[model], net, args.image_size, distances[net][i].item())
+            cache.save()
+
+        for model in hashes:
+            results_dict_alex[dataset][model] = cache.get(im1_hash, hashes[model], 'alex', args.image_size)
+            results_dict_vgg[dataset][model] = cache.get(im1_hash, hashes[model], 'vgg', args.image_size)
+            results_dict_squeezenet[dataset][model] = cache.get(im1_hash, hashes[model], 'squeeze', args.image_size)
     
     # Flip the nested structure on the results for csv saving
     flipped = defaultdict(dict)
@@ -6,9 +6,13 @@
 import argparse
 import os
 import time
+import copy
+import json
+import hashlib
 
 import torch
 from torch import optim
+from torch.func import stack_module_state, functional_call, vmap, replace_all_batch_norm_modules_
 import torch.nn as nn
 import torchvision.transforms as transforms
 
@@ -26,12 +30,21 @@ parser.add_argument('-m', '--model', type=str, default='supervised_d121',
 parser.add_argument('-d', '--datasets', nargs='+', type=str, default='', help='datasets to calculate reconstructions for', required=True)
 parser.add_argument('--clip', default = True, help = 'clip output image between 1 and 0')
 parser.add_argument('--output_dir', default='reconstructed_images/')
-parser.add_argument('--which_layer', default='layer4')
+parser.add_argument('--which_layer', nargs='+', default=['layer4'],
+                    help='layer(s) whose features to invert (the forward pass stops at the deepest one)')
 parser.add_argument('--lr', default=0.001, type=float)
 parser.add_argument('--initial_size', default=256, type=int)
 parser.add_argument('--img_size', default=224, type=int)
 parser.add_argument('--max_iter', default=1000, type=int)
 parser.add_argument('--device', type=str, default='cuda', help='CUDA or CPU training (cuda | cpu)')
+parser.add_argument('--early_stop_patience', default=0, type=int,
+                    help='stop once the loss has not improved for this many iterations (0: always run max_iter iterations)')
+parser.add_argument('--early_stop_tol', default=1e-3, type=float,
+                    help='relative decrease of the loss counted as an improvement for early stopping')
+parser.add_argument('--checkpoint_every', default=100, type=int,
+                    help='save a checkpoint to resume from every this many iterations (0: never)')
+parser.add_argument('--batched', action='store_true', default=False,
+                    help='reconstruct all the images together, with one generator per image vectorised in a single batch')
 
 def checkdir(dir):
     if not os.path.exists(dir):
@@ -90,6 +103,12 @@ def postp(tensor, clip):
     img = postpb(tensor)
     return img
 
+def feature_loss(criterion, out, target):
+    '''Loss between the features of one or several layers (dicts {layer: features}).'''
+    if isinstance(target, dict):
+        return sum(criterion(out[name], target[name]) for name in target)
+    return criterion(out, target)
+
 def get_params(opt_over, net, net_input, downsampler=None):
     '''Returns parameters that we want to optimize over.
     Args:
@@ -115,6 +134,181 @@ def get_params(opt_over, net, net_input, downsampler=None):
 
     return params
 
+class ConvergenceMonitor():
+    '''Detects a plateau of the loss: no relative improvement of more than `tol` over the best loss
+    for `patience` iterations (never, if patience is 0).
+    '''
+    def __init__(self, patience=0, tol=1e-3):
+        self.patience = patience
+        self.tol = tol
+        self.best = float('inf')
+        self.num_bad_iters = 0
+
+    def update(self, loss):
+        '''Records the loss of an iteration and returns whether the optimisation has converged.'''
+        if loss < self.best * (1 - self.tol):
+            self.best = loss
+            self.num_bad_iters = 0
+        else:
+            self.num_bad_iters += 1
+        return self.patience > 0 and self.num_bad_iters >= self.patience
+
+    def state_dict(self):
+        return {'best': self.best, 'num_bad_iters': self.num_bad_iters}
+
+    def load_state_dict(self, state_dict):
+        self.best = state_dict['best']
+        self.num_bad_iters = state_dict['num_bad_iters']
+
+def save_loss_trace(trace, path):
+    '''Saves the loss of every iteration as a .csv file.'''
+    checkdir(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write('iteration,loss\n')
+        for i, loss in enumerate(trace):
+            f.write('%d,%f\n' % (i + 1, loss))
+
+def settings_hash(args, *names):
+    '''Short hash of the reconstruction settings (and of `names`, e.g. the reconstructed images), used to name the
+    checkpoints so that runs with different settings never resume from each other.'''
+    settings = {'names': names, 'which_layer': args.which_layer, 'lr': args.lr, 'max_iter': args.max_iter,
+                'img_size': args.img_size, 'clip': args.clip, 'early_stop_patience': args.early_stop_patience,
+                'early_stop_tol': args.early_stop_tol}
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:12]
+
+def get_net(input_depth):
+    '''Encoder-decoder generator of the deep image prior.'''
+    return skip(input_depth, 3, num_channels_down=[16, 32, 64, 128, 128, 128],
+                num_channels_up=[16, 32, 64, 128, 128, 128],
+                num_channels_skip=[4, 4, 4, 4, 4, 4],
+                filter_size_down=[7, 7, 5, 5, 3, 3], filter_size_up=[7, 7, 5, 5, 3, 3],
+                upsample_mode='nearest', downsample_mode='avg',
+                need_sigmoid=False, pad='zero', act_fun='LeakyReLU')
+
+def reconstruct_batch(model, imgs, targets, layers, args, input_depth=32, imsize_net=256, checkpoint_path=None):
+    '''Reconstructs several images at once, optimising one generator per image.
+
+    The parameters of the generators are stacked and their forward passes vectorised with torch.func, and the
+    generated images go through the backbone as a single batch. As each generator only receives the gradient
+    of the loss of its own image (and Adam is elementwise), this is equivalent to optimising them one by one.
+    Once a generator has converged, it is dropped from the batch and its image from that iteration is kept.
+    Args:
+        imgs: list of [1 x C x H x W] images
+        targets: list of the features of the images (tensors, or dicts {layer: features})
+        checkpoint_path: file the stacked generators and optimizer state are saved to every args.checkpoint_every
+            iterations, and resumed from if it exists
+    Returns:
+        list of the reconstructed PIL images, list of the loss traces
+    '''
+    if isinstance(targets[0], dict):
+        target = {name: torch.cat([t[name] for t in targets]) for name in targets[0]}
+    else:
+        target = torch.cat(targets)
+
+    nets = []
+    for _ in imgs:
+        net = get_net(input_depth).type(imgs[0].type())
+        # generators are always in training mode, running statistics are not needed (and cannot be vmapped)
+        replace_all_batch_norm_modules_(net)
+        nets.append(net.to(args.device))
+    params, buffers = stack_module_state(nets)
+    base_net = copy.deepcopy(nets[0]).to('meta')
+    net_inputs = torch.stack([get_noise(input_depth, imsize_net).type(imgs[0].type()).detach() for _ in imgs])
+
+    # generators still being optimised (the stacked state only holds their rows), in the order of imgs
+    active = list(range(len(imgs)))
+
+    def generate():
+        out = vmap(lambda p, b, z: functional_call(base_net, (p, b), (z,)))(params, buffers, net_inputs)
+        return out.squeeze(1)[:, :, :args.img_size, :args.img_size]
+
+    def image_losses(out):
+        # mean squared error of each image, as nn.MSELoss on its own
+        if isinstance(target, dict):
+            return sum(((out[name] - target[name][active])**2).flatten(1).mean(1) for name in target)
+        return ((out - target[active])**2).flatten(1).mean(1)
+
+    optimizer = optim.Adam(list(params.values()), lr=args.lr)
+    show_iter = 50
+    monitors = [ConvergenceMonitor(args.early_stop_patience, args.early_stop_tol) for _ in imgs]
+    traces = [[] for _ in imgs]
+    # images of the generators that have converged, generated at the iteration where they converged
+    converged = [None] * len(imgs)
+    start_iter = 0
+
+    # resume an interrupted reconstruction
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        checkpoint = torch.load(checkpoint_path, map_location=args.device)
+        params = {name: p.detach().requires_grad_() for name, p in checkpoint['params'].items()}
+        buffers = checkpoint['buffers']
+        net_inputs = checkpoint['net_inputs']
+        optimizer = optim.Adam(list(params.values()), lr=args.lr)
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        start_iter = checkpoint['n_iter']
+        for monitor, state_dict in zip(monitors, checkpoint['monitors']):
+            monitor.load_state_dict(state_dict)
+        traces = checkpoint['traces']
+        converged = checkpoint['converged']
+        active = checkpoint['active']
+        print(f"Resuming from iteration {start_iter}")
+
+    for i in range(start_iter, args.max_iter + 1):
+        if not active:
+            break
+        optimizer.zero_grad()
+        generated = generate()
+        losses = image_losses(model.forward(generated, name=layers))
+        losses.sum().backward()
+        optimizer.step()
+
+        for k, (j, loss) in enumerate(zip(active, losses.tolist())):
+            traces[j].append(loss)
+            if monitors[j].update(loss):
+                print('Image %d converged after %d iterations, loss: %f' % (j, i + 1, loss))
+                converged[j] = generated[k].detach()
+
+        # freeze the converged generators by dropping their rows from the stacked state (and the optimizer state)
+        keep = [k for k, j in enumerate(active) if converged[j] is None]
+        if len(keep) < len(active):
+            index = torch.tensor(keep, dtype=torch.long, device=net_inputs.device)
+            kept_params = {name: p.detach()[index].clone().requires_grad_() for name, p in params.items()}
+            kept_state = [optimizer.state[p] for p in params.values()]
+            optimizer = optim.Adam(list(kept_params.values()), lr=args.lr)
+            for p, state in zip(kept_params.values(), kept_state):
+                if state:
+                    optimizer.state[p] = {'step': state['step'], 'exp_avg': state['exp_avg'][index],
+                                          'exp_avg_sq': state['exp_avg_sq'][index]}
+            params = kept_params
+            buffers = {name: b[index] for name, b in buffers.items()}
+            net_inputs = net_inputs[index]
+            active = [active[k] for k in keep]
+            if not active:
+                break
+
+        if checkpoint_path is not None and args.checkpoint_every > 0 and (i + 1) % args.checkpoint_every == 0:
+            checkdir(os.path.dirname(checkpoint_path))
+            torch.save({
+                'params': params,
+                'buffers': buffers,
+                'net_inputs': net_inputs,
+                'optimizer': optimizer.state_dict(),
+                'n_iter': i + 1,
+                'monitors': [monitor.state_dict() for monitor in monitors],
+                'traces': traces,
+                'converged': converged,
+                'active': active,
+            }, checkpoint_path)
+
+        if i % show_iter == (show_iter - 2):
+            print('Iteration: %d, losses: %s' % (i + 2, ', '.join('%f' % l for l in losses.tolist())))
+
+    out = list(converged)
+    if active:
+        with torch.no_grad():
+            for j, o in zip(active, generate()):
+                out[j] = o
+    return [postp(o.cpu(), args.clip) for o in out], traces
+
 IMAGES = {
     'bach' : ['iv001.tif', './sample_images/bach/iv001.tif'],
     'chestx' : ['00000001_000.png', './sample_images/chestx/00000001_000.png'],
@@ -150,12 +344,15 @@ def main():
     # print(f"Loaded pretrained model {model}")
     model = model.to(args.device)
     model = model.eval()
+    layers = args.which_layer[0] if len(args.which_layer) == 1 else args.which_layer
 
     checkdir(args.output_dir)
 
     if args.datasets == '':
         print('No datasets specified!')
     else:
+        # images left for the batched reconstruction
+        pending = []
         for dataset in args.datasets:
 
             image_name, image_path = IMAGES[dataset]
@@ -188,9 +385,13 @@ def main():
             input_depth = 32
             imsize_net = 256
 
-            target = model.forward(img, name = args.which_layer).detach()
+            with torch.no_grad():
+                target = model.forward(img, name = layers)
 
-            print("Target shape", target.shape)
+            if isinstance(target, dict):
+                print("Target shapes", {name: t.shape for name, t in target.items()})
+            else:
+                print("Target shape", target.shape)
 
             if dataset == "stoic":
                 filename_edited = str(args.model) + "_" + "True_8622.jpeg"
@@ -199,20 +400,17 @@ def main():
                 out_path = os.path.join(args.output_dir, args.model, filename)
             print("out_path is: ", out_path)
 
+            if args.batched and not os.path.exists(out_path):
+                pending.append((filename, img, target, out_path))
+                continue
+
             if not os.path.exists(out_path):
                 print(f"Reconstructing Image {filename}")
 
                 start=time.time()
 
-                pad = 'zero'  # 'reflection'
-
                 # Encoder-decoder architecture
-                net = skip(input_depth, 3, num_channels_down=[16, 32, 64, 128, 128, 128],
-                            num_channels_up=[16, 32, 64, 128, 128, 128],
-                            num_channels_skip=[4, 4, 4, 4, 4, 4],
-                            filter_size_down=[7, 7, 5, 5, 3, 3], filter_size_up=[7, 7, 5, 5, 3, 3],
-                            upsample_mode='nearest', downsample_mode='avg',
-                            need_sigmoid=False, pad=pad, act_fun='LeakyReLU').type(img.type())
+                net = get_net(input_depth).type(img.type())
 
                 net = net.to(args.device)
 
@@ -229,6 +427,22 @@ def main():
                 show_iter = 50
                 optimizer = optim.Adam(get_params('net', net, net_input), lr=args.lr)
                 n_iter = [0]
+                monitor = ConvergenceMonitor(args.early_stop_patience, args.early_stop_tol)
+                trace = []
+
+                # resume an interrupted reconstruction
+                checkpoint_path = os.path.join(args.output_dir, args.model, 'checkpoints',
+                                               filename + '_' + settings_hash(args) + '.pth')
+                trace_path = os.path.join(args.output_dir, args.model, 'loss_traces', filename + '.csv')
+                if os.path.exists(checkpoint_path):
+                    checkpoint = torch.load(checkpoint_path, map_location=args.device)
+                    net.load_state_dict(checkpoint['net'])
+                    optimizer.load_state_dict(checkpoint['optimizer'])
+                    net_input = checkpoint['net_input']
+                    n_iter[0] = checkpoint['n_iter']
+                    monitor.load_state_dict(checkpoint['monitor'])
+                    trace = checkpoint['trace']
+                    print(f"Resuming from iteration {n_iter[0]}")
 
                 while n_iter[0] <= max_iter:
 
@@ -237,18 +451,36 @@ def main():
                         # out is features from pretrained network when input is noise fed through encoder-decoder network
                         out = model.forward(
                             net(net_input)[:, :, :args.img_size, :args.img_size],
-                            name=args.which_layer)
+                            name=layers)
 
                         # target is features from pretrained network when input is original image
-                        loss = criterion(out, target)
+                        loss = feature_loss(criterion, out, target)
                         loss.backward()
                         n_iter[0] += 1
+                        trace.append(loss.item())
 
                         if n_iter[0] % show_iter == (show_iter - 1):
                             print('Iteration: %d, loss: %f' % (n_iter[0] + 1, loss.item()))
                         return loss
 
                     optimizer.step(closure)
+                    converged = monitor.update(trace[-1])
+
+                    if args.checkpoint_every > 0 and n_iter[0] % args.checkpoint_every == 0:
+                        checkdir(os.path.dirname(checkpoint_path))
+                        torch.save({
+                            'net': net.state_dict(),
+                            'optimizer': optimizer.state_dict(),
+                            'net_input': net_input,
+                            'n_iter': n_iter[0],
+                            'monitor': monitor.state_dict(),
+                            'trace': trace,
+                        }, checkpoint_path)
+                        save_loss_trace(trace, trace_path)
+
+                    if converged:
+                        print('Converged after %d iterations, loss: %f' % (n_iter[0], trace[-1]))
+                        break
 
                 out_img = postp(net(net_input)[:, :, :args.img_size, :args.img_size].data[0].cpu().squeeze(), args.clip)
 
@@ -257,10 +489,32 @@ def main():
 
                 checkdir(os.path.dirname(out_path))
                 out_img.save(out_path)
+                save_loss_trace(trace, trace_path)
+                if os.path.exists(checkpoint_path):
+                    os.remove(checkpoint_path)
 
             else:
                 print("Reconstructed image already exists. Exiting.")
 
+        if pending:
+            filenames, imgs, targets, out_paths = zip(*pending)
+            print(f"Reconstructing Images {', '.join(filenames)} in one batch")
+            start = time.time()
+
+            checkpoint_path = os.path.join(args.output_dir, args.model, 'checkpoints',
+                                           'batch_' + settings_hash(args, *filenames) + '.pth')
+            out_imgs, traces = reconstruct_batch(model, imgs, targets, layers, args, checkpoint_path=checkpoint_path)
+
+            end = time.time()
+            print('Time:'+str(end-start))
+
+            for filename, out_img, out_path, trace in zip(filenames, out_imgs, out_paths, traces):
+                checkdir(os.path.dirname(out_path))
+                out_img.save(out_path)
+                save_loss_trace(trace, os.path.join(args.output_dir, args.model, 'loss_traces', filename + '.csv'))
+            if os.path.exists(checkpoint_path):
+                os.remove(checkpoint_path)
+
 
 if __name__ == "__main__":
     main()
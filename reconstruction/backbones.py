@@ -4,6 +4,50 @@ import torch.nn as nn
 import torch.nn.functional as F
 import os
 
+
+def _truncated_forward(x, layers, name):
+    """ Run the (name, module) `layers` in order, stopping after the last requested one.
+
+    Args:
+        name (str or list) : name of the layer whose output to return, or list of names
+
+    Returns:
+        the output of layer `name`, or a dict {name: output} if `name` is a list
+    """
+    names = [name] if isinstance(name, str) else list(name)
+    unknown = set(names) - set(layer_name for layer_name, _ in layers)
+    if unknown:
+        raise ValueError(f'Unknown layers {sorted(unknown)}')
+
+    remaining = set(names)
+    results = {}
+    for layer_name, layer in layers:
+        x = layer(x)
+        if layer_name in remaining:
+            results[layer_name] = x
+            remaining.remove(layer_name)
+            if not remaining:
+                break
+
+    return results[name] if isinstance(name, str) else results
+
+
+def _resnet_layers(model):
+    return [
+        ('conv1', model.conv1),
+        # the ReLU was applied in place on the output of bn1, so bn1 returns the activations after it (as relu1)
+        ('bn1', lambda x: model.relu(model.bn1(x))),
+        ('relu1', lambda x: x),
+        ('maxpool', model.maxpool),
+        ('layer1', model.layer1),
+        ('layer2', model.layer2),
+        ('layer3', model.layer3),
+        ('layer4', model.layer4),
+        ('avgpool', model.avgpool),
+        ('fc', lambda x: torch.flatten(x, 1)),
+    ]
+
+
 class ResNet18Backbone(nn.Module):
     def __init__(self, model_name):
         super().__init__()
@@ -19,30 +63,7 @@ class ResNet18Backbone(nn.Module):
         print("Number of model parameters:", sum(p.numel() for p in self.model.parameters()))
 
     def _forward_impl(self, x, name='fc'):
-        results = {}
-        x = self.model.conv1(x)
-        results['conv1'] = x
-        x = self.model.bn1(x)
-        results['bn1'] = x
-        x = self.model.relu(x)
-        results['relu1'] = x
-        x = self.model.maxpool(x)
-        results['maxpool'] = x
-        x = self.model.layer1(x)
-        results['layer1'] = x
-        x = self.model.layer2(x)
-        results['layer2'] = x
-        x = self.model.layer3(x)
-        results['layer3'] = x
-        x = self.model.layer4(x)
-        results['layer4'] = x
-
-        x = self.model.avgpool(x)
-        results['avgpool'] = x
-        x = torch.flatten(x, 1)
-        results['fc'] = x
-
-        return results[name]
+        return _truncated_forward(x, _resnet_layers(self.model), name)
 
     def forward(self, x, name='fc'):
         return self._forward_impl(x, name=name)
@@ -63,30 +84,7 @@ class ResNetBackbone(nn.Module):
         print("Number of model parameters:", sum(p.numel() for p in self.model.parameters()))
 
     def _forward_impl(self, x, name='fc'):
-        results = {}
-        x = self.model.conv1(x)
-        results['conv1'] = x
-        x = self.model.bn1(x)
-        results['bn1'] = x
-        x = self.model.relu(x)
-        results['relu1'] = x
-        x = self.model.maxpool(x)
-        results['maxpool'] = x
-        x = self.model.layer1(x)
-        results['layer1'] = x
-        x = self.model.layer2(x)
-        results['layer2'] = x
-        x = self.model.layer3(x)
-        results['layer3'] = x
-        x = self.model.layer4(x)
-        results['layer4'] = x
-
-        x = self.model.avgpool(x)
-        results['avgpool'] = x
-        x = torch.flatten(x, 1)
-        results['fc'] = x
-
-        return results[name]
+        return _truncated_forward(x, _resnet_layers(self.model), name)
 
     def forward(self, x, name = 'fc'):
         return self._forward_impl(x, name=name)
@@ -110,45 +108,25 @@ class DenseNetBackbone(nn.Module):
         return self._forward_impl(x, name=name)
 
     def _forward_impl(self, x, name='fc'):
-        results = {}
-
-        x = self.model.features.conv0(x)
-        results["conv0"] = x
-        x = self.model.features.norm0(x)
-        results["norm0"] = x
-        x = self.model.features.relu0(x)
-        results["relu0"] = x
-        x = self.model.features.pool0(x)
-        results["pool0"] = x
-
-        x = self.model.features.denseblock1(x)
-        results["layer1"] = x
-        x = self.model.features.transition1(x)
-        results["transition1"] = x
-
-        x = self.model.features.denseblock2(x)
-        results["layer2"] = x
-        x = self.model.features.transition2(x)
-        results["transition2"] = x
-
-        x = self.model.features.denseblock3(x)
-        results["layer3"] = x
-        x = self.model.features.transition3(x)
-        results["transition3"] = x
-
-        x = self.model.features.denseblock4(x)
-        results["layer4"] = x
-        x = self.model.features.norm5(x)
-        results["norm5"] = x
-
-        x = F.relu(x, inplace = True)
-        results['relu1'] = x
-
-        x = F.adaptive_avg_pool2d(x, (1, 1))
-        results['avgpool'] = x
-
-        x = torch.flatten(x, 1)
-        results['fc'] = x
-
-        return results[name]
+        features = self.model.features
+        layers = [
+            ('conv0', features.conv0),
+            # the ReLU was applied in place on the output of norm0, so norm0 returns the activations after it (as relu0)
+            ('norm0', lambda x: features.relu0(features.norm0(x))),
+            ('relu0', lambda x: x),
+            ('pool0', features.pool0),
+            ('layer1', features.denseblock1),
+            ('transition1', features.transition1),
+            ('layer2', features.denseblock2),
+            ('transition2', features.transition2),
+            ('layer3', features.denseblock3),
+            ('transition3', features.transition3),
+            ('layer4', features.denseblock4),
+            # same for norm5 and its (functional, in place) ReLU
+            ('norm5', lambda x: F.relu(features.norm5(x), inplace=True)),
+            ('relu1', lambda x: x),
+            ('avgpool', lambda x: F.adaptive_avg_pool2d(x, (1, 1))),
+            ('fc', lambda x: torch.flatten(x, 1)),
+        ]
+        return _truncated_forward(x, layers, name)
 
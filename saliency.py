@@ -2,11 +2,16 @@
 # coding: utf-8
 
 import os
+import json
+import hashlib
 import argparse
 from pprint import pprint
 import logging
 import copy
 import math
+import time
+import contextlib
+import functools
 
 import medpy.io as medpy
 
@@ -20,53 +25,397 @@ import PIL
 from PIL import Image
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
+from scipy.stats import spearmanr
 
 
 from torchvision import datasets, transforms, models
 from torchvision.io import read_image
 from torch.utils.data import DataLoader
 from torch.utils.data.sampler import RandomSampler
+import torch.multiprocessing as mp
 
-from models.backbones import ResNetBackbone, ResNet18Backbone, DenseNetBackbone
+from models.backbones import IncrementalInference, load_backbone
 
 from datasets.transforms import HistogramNormalize
+from datasets.custom_chexpert_dataset import CustomChexpertDataset
+from datasets.custom_diabetic_retinopathy_dataset import CustomDiabeticRetinopathyDataset
+from datasets.custom_montgomery_cxr_dataset import CustomMontgomeryCXRDataset
+from datasets.custom_shenzhen_cxr_dataset import CustomShenzhenCXRDataset
+from datasets.custom_bach_dataset import CustomBachDataset
+from datasets.custom_ichallenge_amd_dataset import CustomiChallengeAMDDataset
+from datasets.custom_ichallenge_pm_dataset import CustomiChallengePMDataset
+from datasets.custom_stoic_dataset import CustomStoicDataset
+from datasets.custom_chestx_dataset import CustomChestXDataset
 
 
 
-# Compute an occlusion-based saliency map for a given image and model
-def compute_saliency_map(img, model, device, size=10, value=0):
-    img = img.to(device)
+def activation_bytes(model, img):
+    """Upper bound on the memory (in bytes) of the activations of one forward pass of a single image."""
+    total = [img.numel() * img.element_size()]
+
+    def hook(module, inputs, output):
+        if torch.is_tensor(output):
+            total[0] += output.numel() * output.element_size()
 
-    occlusion_window = torch.zeros((img.size(0), size, size)).to(device)
-    occlusion_window.fill_(value)
+    handles = [m.register_forward_hook(hook) for m in model.modules() if len(list(m.children())) == 0]
+    with torch.no_grad():
+        model(img.unsqueeze(0))
+    for handle in handles:
+        handle.remove()
+    return total[0]
+
+
+def _per_image_batch_norm(module, x):
+    """Training-mode batch norm of each image of the batch on its own, as a forward pass of a single image."""
+    n, c = x.shape[:2]
+    out = F.batch_norm(x.reshape(1, n * c, *x.shape[2:]), None, None, training=True, eps=module.eps).view_as(x)
+    if module.affine:
+        shape = (1, c) + (1,) * (x.dim() - 2)
+        out = out * module.weight.view(shape) + module.bias.view(shape)
+    return out
+
+
+@contextlib.contextmanager
+def batch_norm_mode(model, eval_bn=False):
+    """ Batch norm behaviour of the saliency forward passes.
+
+    The backbones are in training mode, so batch norm normalises each image with its own statistics (as when the
+    occluded images were run one at a time): the training-mode batch norm layers are patched for the duration so that
+    the images of a batch do not interact. With `eval_bn`, the model is put in evaluation mode (running statistics)
+    instead, as IncrementalInference requires; this changes the saliency maps.
+    """
+    if eval_bn:
+        training = model.training
+        model.eval()
+        try:
+            yield
+        finally:
+            model.train(training)
+        return
+
+    patched = [m for m in model.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.training]
+    for module in patched:
+        module.forward = functools.partial(_per_image_batch_norm, module)
+    try:
+        yield
+    finally:
+        for module in patched:
+            del module.forward
+
+
+def occlusion_positions(height, width, size, stride):
+    """Top-left corners of the occlusion windows, the last row / column always reaching the image border."""
+    rows = list(range(0, height - size + 1, stride))
+    cols = list(range(0, width - size + 1, stride))
+    if rows[-1] != height - size:
+        rows.append(height - size)
+    if cols[-1] != width - size:
+        cols.append(width - size)
+    rows, cols = torch.meshgrid(torch.tensor(rows), torch.tensor(cols), indexing='ij')
+    return rows.flatten(), cols.flatten()
+
+
+def window_indices(rows, cols, size, width):
+    """Flat pixel indices (len(rows), size * size) covered by the windows with top-left corners (rows, cols)."""
+    offsets = torch.arange(size, device=rows.device)
+    pixel_rows = rows.view(-1, 1, 1) + offsets.view(1, -1, 1)
+    pixel_cols = cols.view(-1, 1, 1) + offsets.view(1, 1, -1)
+    return (pixel_rows * width + pixel_cols).flatten(1)
+
+
+def occlusion_window_scores(img, model, device, rows, cols, size=10, value=0, batch_size=None, memory_budget=1024,
+                            incremental=False, eval_bn=False):
+    """ Relative feature change ||f(x) - f(x_occluded)|| / ||f(x)|| for the windows with top-left corners (rows, cols).
+
+    The occluded images are built on the fly and run through the model in chunks of `batch_size` images
+    (by default, as many as fit in `memory_budget` MB of activations). With `incremental`, only the part of each layer
+    within the receptive field of the window is recomputed from the cached activations of the clean image.
+
+    Args:
+        img (torch.Tensor) : normalised (C, H, W) image
+        model (nn.Module) : backbone returning a feature vector per image
+        rows, cols (torch.Tensor) : top-left corners of the occlusion windows
+        size (int) : side of the square occlusion window
+        value (float) : value the occluded pixels are set to
+        batch_size (int) : number of occluded images per forward pass
+        memory_budget (float) : memory (MB) available for the activations of a forward pass, if batch_size is None
+        incremental (bool) : whether to use IncrementalInference (ResNet and DenseNet backbones, requires eval_bn)
+        eval_bn (bool) : whether batch norm uses its running statistics, see batch_norm_mode
+
+    Returns:
+        torch.Tensor : (len(rows),) occlusion scores
+    """
+    if incremental and not eval_bn:
+        raise ValueError('Incremental inference requires batch norm in evaluation mode (eval_bn=True)')
+    with batch_norm_mode(model, eval_bn):
+        return _occlusion_window_scores(img, model, device, rows, cols, size, value, batch_size, memory_budget,
+                                        incremental)
+
+
+def _occlusion_window_scores(img, model, device, rows, cols, size, value, batch_size, memory_budget, incremental):
+    img = img.to(device)
+    channels, height, width = img.shape
 
-    occlusion_scores = np.zeros((img.size(1), img.size(2)))
+    if batch_size is None:
+        batch_size = max(1, int(memory_budget * 2**20 // activation_bytes(model, img)))
 
     with torch.no_grad():
-        orig_feature = model.forward(img.unsqueeze(0)).squeeze(0).cpu().detach().numpy()
-    orig_feature_mag = np.sqrt((orig_feature**2).sum())
-
-    pbar = tqdm(range((1+img.size(1)-size)*(1+img.size(2)-size)), desc='Computing features for occluded images')
-    for i in range(1 + img.size(1) - size):
-        for j in range(1 + img.size(2) - size):
-            img_occluded = img.clone()
-            img_occluded[:, i:i+size, j:j+size] = occlusion_window
+        orig_feature = model(img.unsqueeze(0))
+    orig_feature_mag = orig_feature.norm()
+    if incremental:
+        engine = IncrementalInference(model, img)
+
+    rows, cols = rows.to(device), cols.to(device)
+    scores = torch.zeros(len(rows), dtype=torch.float64, device=device)
+
+    pbar = tqdm(total=len(rows), desc='Computing features for occluded images')
+    for start in range(0, len(rows), batch_size):
+        indices = window_indices(rows[start:start + batch_size], cols[start:start + batch_size], size, width)
+        n = len(indices)
+
+        if incremental:
+            occlusion_windows = torch.full((n, channels, size, size), value, dtype=img.dtype, device=device)
+            occluded_features = engine.forward_patches(occlusion_windows, rows[start:start + n], cols[start:start + n])
+        else:
+            img_occluded = img.unsqueeze(0).repeat(n, 1, 1, 1).view(n, channels, height * width)
+            img_occluded.scatter_(2, indices.unsqueeze(1).expand(-1, channels, -1), value)
             with torch.no_grad():
-                occluded_feature = model.forward(img_occluded.unsqueeze(0)).squeeze(0).cpu().detach().numpy()
+                occluded_features = model(img_occluded.view(n, channels, height, width))
 
-            occlusion_score = np.sqrt(((orig_feature - occluded_feature)**2).sum()) / orig_feature_mag
-            occlusion_scores[i:i+size, j:j+size] += occlusion_score
+        scores[start:start + n] = (orig_feature - occluded_features).norm(dim=1) / orig_feature_mag
 
-            pbar.update(1)
+        pbar.update(n)
 
     pbar.close()
 
-    occlusion_scores /= size**2
+    return scores
+
+
+def window_scores_to_map(scores, rows, cols, size, height, width):
+    """Average the scores of the windows covering each pixel (size**2 of them with stride 1) and crop the borders."""
+    indices = window_indices(rows.to(scores.device), cols.to(scores.device), size, width).flatten()
+    occlusion_scores = torch.zeros(height * width, dtype=torch.float64, device=scores.device)
+    coverage = torch.zeros(height * width, dtype=torch.float64, device=scores.device)
+    occlusion_scores.index_add_(0, indices, scores.to(torch.float64).repeat_interleave(size**2))
+    coverage.index_add_(0, indices, torch.ones(len(indices), dtype=torch.float64, device=scores.device))
+    occlusion_scores = (occlusion_scores / coverage.clamp(min=1)).view(height, width).cpu().numpy()
 
     # apply crop
-    occlusion_scores = occlusion_scores[size-1:img.size(1)-size+1, size-1:img.size(2)-size+1]
+    return occlusion_scores[size-1:height-size+1, size-1:width-size+1]
+
+
+# Compute an occlusion-based saliency map for a given image and model
+def compute_saliency_map(img, model, device, size=10, value=0, stride=1, batch_size=None, memory_budget=1024,
+                         incremental=False, eval_bn=False):
+    """ Occlusion saliency: each pixel is scored with the mean relative feature change caused by the windows covering it.
+
+    Windows are placed every `stride` pixels, see `occlusion_window_scores` for the other arguments.
+
+    Returns:
+        np.ndarray : saliency map, cropped by size - 1 pixels on each side
+    """
+    height, width = img.shape[1:]
+    rows, cols = occlusion_positions(height, width, size, stride)
+    scores = occlusion_window_scores(img, model, device, rows, cols, size, value, batch_size, memory_budget, incremental,
+                                     eval_bn)
+    return window_scores_to_map(scores, rows, cols, size, height, width)
+
+
+def _split_cells(cells):
+    """Split each (r0, r1, c0, c1) cell of window positions in (up to) 4 at its midpoints, returns the new corners too."""
+    sub_cells, corners = [], []
+    for r0, r1, c0, c1 in cells:
+        r_mid, c_mid = (r0 + r1) // 2, (c0 + c1) // 2
+        row_splits = [(r0, r_mid), (r_mid, r1)] if r1 - r0 > 1 else [(r0, r1)]
+        col_splits = [(c0, c_mid), (c_mid, c1)] if c1 - c0 > 1 else [(c0, c1)]
+        for ra, rb in row_splits:
+            for ca, cb in col_splits:
+                sub_cells.append((ra, rb, ca, cb))
+                corners.extend([(ra, ca), (ra, cb), (rb, ca), (rb, cb)])
+    return sub_cells, corners
+
+
+def compute_adaptive_saliency_map(img, model, device, size=10, value=0, coarse_stride=8, refine_quantile=0.75,
+                                  refine_by='score', num_validation=64, seed=0, batch_size=None, memory_budget=1024,
+                                  incremental=False, eval_bn=False):
+    """ Coarse-to-fine approximation of the exhaustive (stride 1) occlusion saliency map.
+
+    Windows are first scored every `coarse_stride` pixels, which splits the window positions into cells with scored
+    corners. The cells are then refined hierarchically: at each level, the cells whose criterion is above the
+    `refine_quantile` quantile of the cells refined at the previous level are split in 4 (halving the stride) and the new
+    corners are scored. The criterion of a cell is its largest corner score (refine_by='score') or the range of its corner
+    scores (refine_by='gradient'). The scores of the windows inside the final cells are bilinearly interpolated.
+
+    The error of the map is estimated on `num_validation` windows sampled at random (with `seed`) among all the positions
+    and scored exactly, these are not used to build the map.
+
+    Returns:
+        np.ndarray : saliency map, cropped by size - 1 pixels on each side
+        dict : number of windows scored for the map ('evaluated'), for the error estimate ('validation') and in total
+               ('forwards'), out of 'exhaustive' for the exhaustive map ('forward_fraction' = forwards / exhaustive), and
+               the relative L2 error of the window scores on the held-out windows ('estimated_error')
+    """
+    height, width = img.shape[1:]
+    n_rows, n_cols = height - size + 1, width - size + 1
+
+    def score(positions):
+        positions = torch.tensor(sorted(positions), dtype=torch.long).view(-1, 2)
+        scores = occlusion_window_scores(img, model, device, positions[:, 0], positions[:, 1], size, value, batch_size,
+                                         memory_budget, incremental, eval_bn).cpu().numpy()
+        return dict(zip(map(tuple, positions.tolist()), scores))
+
+    # coarse grid
+    rows, cols = occlusion_positions(height, width, size, coarse_stride)
+    coarse_rows, coarse_cols = rows.unique().tolist(), cols.unique().tolist()
+    known = score(zip(rows.tolist(), cols.tolist()))
+    cells = [(r0, r1, c0, c1) for r0, r1 in zip(coarse_rows[:-1], coarse_rows[1:])
+             for c0, c1 in zip(coarse_cols[:-1], coarse_cols[1:])]
+
+    # hierarchical refinement
+    leaves = []
+    while cells:
+        splittable = [cell for cell in cells if cell[1] - cell[0] > 1 or cell[3] - cell[2] > 1]
+        leaves.extend(cell for cell in cells if cell[1] - cell[0] <= 1 and cell[3] - cell[2] <= 1)
+        if not splittable:
+            break
+        corner_scores = np.array([[known[(r0, c0)], known[(r0, c1)], known[(r1, c0)], known[(r1, c1)]]
+                                  for r0, r1, c0, c1 in splittable])
+        if refine_by == 'gradient':
+            criterion = corner_scores.max(axis=1) - corner_scores.min(axis=1)
+        else:
+            criterion = corner_scores.max(axis=1)
+        selected = criterion >= np.quantile(criterion, refine_quantile)
+        leaves.extend(cell for cell, refine in zip(splittable, selected) if not refine)
+
+        cells, corners = _split_cells([cell for cell, refine in zip(splittable, selected) if refine])
+        new_positions = set(corners) - set(known)
+        if new_positions:
+            known.update(score(new_positions))
+
+    # bilinear interpolation of the window scores inside each final cell
+    window_scores = np.zeros((n_rows, n_cols))
+    for r0, r1, c0, c1 in leaves:
+        ty = ((np.arange(r0, r1 + 1) - r0) / max(r1 - r0, 1)).reshape(-1, 1)
+        tx = ((np.arange(c0, c1 + 1) - c0) / max(c1 - c0, 1)).reshape(1, -1)
+        window_scores[r0:r1 + 1, c0:c1 + 1] = ((1 - ty) * (1 - tx) * known[(r0, c0)] + (1 - ty) * tx * known[(r0, c1)]
+                                               + ty * (1 - tx) * known[(r1, c0)] + ty * tx * known[(r1, c1)])
+    for (r, c), window_score in known.items():
+        window_scores[r, c] = window_score
+
+    all_rows, all_cols = torch.meshgrid(torch.arange(n_rows), torch.arange(n_cols), indexing='ij')
+    saliency_map = window_scores_to_map(torch.from_numpy(window_scores).flatten(), all_rows.flatten(), all_cols.flatten(),
+                                        size, height, width)
+
+    # error on held-out windows sampled among all the positions (exact where the windows were scored for the map)
+    estimated_error = None
+    validation = {}
+    if num_validation > 0:
+        rng = np.random.default_rng(seed)
+        flat = rng.choice(n_rows * n_cols, min(num_validation, n_rows * n_cols), replace=False)
+        held_out = [(int(i) // n_cols, int(i) % n_cols) for i in flat]
+        validation = score(set(held_out) - set(known))
+        exact = np.array([known.get(position, validation.get(position)) for position in held_out])
+        approx = np.array([window_scores[position] for position in held_out])
+        estimated_error = np.linalg.norm(approx - exact) / np.linalg.norm(exact)
+
+    info = {
+        'evaluated': len(known),
+        'validation': len(validation),
+        'forwards': len(known) + len(validation),
+        'exhaustive': n_rows * n_cols,
+        'forward_fraction': (len(known) + len(validation)) / (n_rows * n_cols),
+        'estimated_error': estimated_error,
+    }
+    return saliency_map, info
+
+
+def feature_norm_gradients(model, inputs, batch_size=16):
+    """Gradients of the feature norm ||f(x)|| with respect to each of the (n, C, H, W) inputs, in batches."""
+    grads = []
+    for start in range(0, len(inputs), batch_size):
+        x = inputs[start:start + batch_size].clone().requires_grad_(True)
+        # batch norm normalises each sample on its own (see batch_norm_mode), so the gradient of the sum gives
+        # per-sample gradients
+        grads.append(torch.autograd.grad(model(x).norm(dim=1).sum(), x)[0])
+    return torch.cat(grads)
+
+
+# Compute a gradient-based saliency map for a given image and model
+def compute_gradient_saliency_map(img, model, device, method='grad_input', size=10, value=0, steps=32, noise_level=0.15,
+                                  batch_size=16, eval_bn=False):
+    """ Gradient-based approximation of the occlusion saliency map, attributing the feature norm to the input pixels.
+
+    The attributions (summed over channels) are aggregated over size x size windows, as the occlusion scores, so the
+    map is directly comparable to (and has the shape of) the one of compute_saliency_map.
+
+    Args:
+        method (str) : 'grad_input' (gradient x input), 'integrated_gradients' (from the occlusion value, with `steps`
+                       interpolation steps) or 'smoothgrad' (gradient x input averaged over `steps` noisy copies with
+                       noise std `noise_level` times the range of the image)
+        batch_size (int) : number of interpolated / noisy images per forward and backward pass
+        eval_bn (bool) : whether batch norm uses its running statistics, see batch_norm_mode
+
+    Returns:
+        np.ndarray : saliency map, cropped by size - 1 pixels on each side
+    """
+    with batch_norm_mode(model, eval_bn):
+        return _gradient_saliency_map(img, model, device, method, size, value, steps, noise_level, batch_size)
+
+
+def _gradient_saliency_map(img, model, device, method, size, value, steps, noise_level, batch_size):
+    img = img.to(device)
+    height, width = img.shape[1:]
+
+    if method == 'grad_input':
+        attributions = img * feature_norm_gradients(model, img.unsqueeze(0))[0]
+    elif method == 'integrated_gradients':
+        baseline = torch.full_like(img, value)
+        alphas = (torch.arange(steps, device=device, dtype=img.dtype) + 0.5) / steps
+        inputs = baseline + alphas.view(-1, 1, 1, 1) * (img - baseline)
+        attributions = (img - baseline) * feature_norm_gradients(model, inputs, batch_size).mean(dim=0)
+    elif method == 'smoothgrad':
+        sigma = noise_level * (img.max() - img.min())
+        inputs = img + sigma * torch.randn((steps,) + img.shape, device=device, dtype=img.dtype)
+        attributions = (inputs * feature_norm_gradients(model, inputs, batch_size)).mean(dim=0)
+    else:
+        raise ValueError(f'Unknown gradient saliency method {method}')
+
+    # score each window with its summed absolute attribution, then average the windows covering each pixel
+    window_scores = F.avg_pool2d(attributions.abs().sum(dim=0, keepdim=True), size, stride=1).flatten().detach()
+    rows, cols = torch.meshgrid(torch.arange(height - size + 1), torch.arange(width - size + 1), indexing='ij')
+    return window_scores_to_map(window_scores, rows.flatten(), cols.flatten(), size, height, width)
+
+
+def benchmark_gradient_saliency(normalized_img, model, device, methods, occlusion_kwargs, gradient_kwargs):
+    """ Wall time of the occlusion and gradient-based saliency maps, and Spearman rank correlation with the occlusion map.
 
-    return occlusion_scores
+    Returns:
+        dict : {method: {'time': seconds, 'rank_correlation': rho, 'attentive_diffusion': %}}
+    """
+    start = time.perf_counter()
+    occlusion_map = compute_saliency_map(normalized_img, model, device, **occlusion_kwargs)
+    results = {'occlusion': {'time': time.perf_counter() - start, 'rank_correlation': 1.0,
+                             'attentive_diffusion': attentive_diffusion(occlusion_map)}}
+    for method in methods:
+        start = time.perf_counter()
+        saliency_map = compute_gradient_saliency_map(normalized_img, model, device, method=method, **gradient_kwargs)
+        results[method] = {
+            'time': time.perf_counter() - start,
+            'rank_correlation': spearmanr(saliency_map.flatten(), occlusion_map.flatten())[0],
+            'attentive_diffusion': attentive_diffusion(saliency_map),
+        }
+    return results
+
+
+def relative_error(saliency_map, reference_map):
+    """Relative L2 error of a saliency map with respect to a reference (e.g. exhaustive) map."""
+    return np.linalg.norm(saliency_map - reference_map) / np.linalg.norm(reference_map)
+
+
+def attentive_diffusion(saliency_map):
+    """Percentage of the saliency map with values above its mean."""
+    mean_attention = np.mean(saliency_map)
+    return 100 * (saliency_map > mean_attention).sum() / np.prod(saliency_map.size)
 
 
 def get_dataset(dset, root, split, transform):
@@ -114,6 +463,163 @@ def obtain_and_pre_process_img(img_path, img_size, normalisation, hist_norm, sto
     return img, normalized_img
 
 
+# Class to keep running statistics of the attentive diffusion of a stream of saliency maps
+class RunningDiffusion():
+    def __init__(self, num_bins=20):
+        self.n = 0
+        self.mean = 0.0
+        self.M2 = 0.0
+        self.bin_edges = np.linspace(0, 100, num_bins + 1)
+        self.histogram = np.zeros(num_bins, dtype=int)
+
+    def update(self, diffusion):
+        # Welford's online mean and variance
+        self.n += 1
+        delta = diffusion - self.mean
+        self.mean += delta / self.n
+        self.M2 += delta * (diffusion - self.mean)
+        self.histogram[min(np.searchsorted(self.bin_edges, diffusion, side='right') - 1, len(self.histogram) - 1)] += 1
+
+    @property
+    def std(self):
+        return np.sqrt(self.M2 / (self.n - 1)) if self.n > 1 else 0.0
+
+    def confidence_interval(self, z=1.96):
+        half_width = z * self.std / np.sqrt(max(self.n, 1))
+        return self.mean - half_width, self.mean + half_width
+
+    def summary(self):
+        return {
+            'n': self.n,
+            'mean': self.mean,
+            'std': self.std,
+            'ci95': self.confidence_interval(),
+            'bin_edges': self.bin_edges.tolist(),
+            'histogram': self.histogram.tolist(),
+        }
+
+
+_WORKER = {}
+
+
+def _init_worker(model_name, dset, data_dir, split, img_size, normalisation, hist_norm, device, threads,
+                 saliency_kwargs, heatmap_dir):
+    """Load the model and the dataset once per process."""
+    torch.set_num_threads(threads)
+    if normalisation:
+        normalise_dict = {'mean': [0.485, 0.456, 0.406], 'std': [0.229, 0.224, 0.225]}
+    else:
+        normalise_dict = {'mean': [0.0, 0.0, 0.0], 'std': [1.0, 1.0, 1.0]}
+    transform = transforms.Compose([
+        transforms.Resize(img_size, interpolation=PIL.Image.BICUBIC),
+        transforms.CenterCrop(img_size),
+        transforms.ToTensor(),
+        HistogramNormalize() if hist_norm else transforms.Normalize(**normalise_dict),
+    ])
+    model, _ = load_backbone(model_name)
+    _WORKER.update({
+        'model': model.to(device),
+        'dataset': dset(data_dir, train=(split == 'train'), transform=transform, download=True),
+        'device': device,
+        'saliency_kwargs': saliency_kwargs,
+        'heatmap_dir': heatmap_dir,
+    })
+
+
+def _diffusion_worker(index):
+    """Compute the saliency map of one dataset image and return its attentive diffusion."""
+    normalized_img, _ = _WORKER['dataset'][index]
+    saliency_kwargs = dict(_WORKER['saliency_kwargs'])
+    method = saliency_kwargs.pop('method', 'occlusion')
+    adaptive = saliency_kwargs.pop('adaptive', False)
+    if method != 'occlusion':
+        saliency_map = compute_gradient_saliency_map(normalized_img, _WORKER['model'], _WORKER['device'], method=method,
+                                                     **saliency_kwargs)
+    elif adaptive:
+        saliency_map, _ = compute_adaptive_saliency_map(normalized_img, _WORKER['model'], _WORKER['device'], **saliency_kwargs)
+    else:
+        saliency_map = compute_saliency_map(normalized_img, _WORKER['model'], _WORKER['device'], **saliency_kwargs)
+    if _WORKER['heatmap_dir'] is not None:
+        np.savez_compressed(os.path.join(_WORKER['heatmap_dir'], f'{index}.npz'), saliency_map=saliency_map.astype(np.float32))
+    return index, attentive_diffusion(saliency_map)
+
+
+def dataset_attentive_diffusion(model_name, dataset, num_images, split='test', img_size=242, normalisation=True,
+                                hist_norm=False, device='cpu', num_processes=1, threads_per_process=1,
+                                save_heatmaps=False, seed=0, saliency_kwargs=None):
+    """ Attentive diffusion of the saliency maps of `num_images` images sampled from `split` of `dataset`.
+
+    The images are spread across `num_processes` processes (each limited to `threads_per_process` threads).
+    `saliency_kwargs` selects the saliency method ('method', 'occlusion' by default, and 'adaptive') and holds the
+    arguments of the corresponding saliency map function.
+    The diffusion of each map is appended to `saliency_maps/<model>/<dataset>/diffusion_<split>_<settings>.jsonl` as it
+    is computed, so an interrupted run with the same settings resumes from the images already done, and streamed into a
+    RunningDiffusion aggregate. <settings> is a hash of the saliency settings (also saved in
+    `diffusion_<split>_<settings>_settings.json`), so runs with different settings are never mixed.
+    With `save_heatmaps`, the maps are saved as compressed .npz files next to it.
+
+    Returns:
+        dict : summary of the aggregate (mean, std, 95% confidence interval, histogram)
+    """
+    dset, data_dir = SALIENCY_DATASETS[dataset]
+    saliency_kwargs = saliency_kwargs or {'method': 'occlusion', 'adaptive': False}
+
+    # identify the run by everything that changes the maps (the batch size and memory budget only change the speed)
+    settings = {k: v for k, v in saliency_kwargs.items() if k not in ['batch_size', 'memory_budget']}
+    settings.update({'img_size': img_size, 'normalisation': normalisation, 'hist_norm': hist_norm})
+    settings_hash = hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:12]
+    run_name = f'{split}_{settings_hash}'
+
+    outpath_base = f'saliency_maps/{model_name}/{dataset}'
+    heatmap_dir = os.path.join(outpath_base, f'heatmaps_{run_name}') if save_heatmaps else None
+    if not os.path.isdir(heatmap_dir or outpath_base):
+        os.makedirs(heatmap_dir or outpath_base)
+    results_path = os.path.join(outpath_base, f'diffusion_{run_name}.jsonl')
+    with open(os.path.join(outpath_base, f'diffusion_{run_name}_settings.json'), 'w') as f:
+        json.dump(settings, f, indent=4)
+
+    dataset_size = len(dset(data_dir, train=(split == 'train'), transform=None, download=True))
+    rng = np.random.default_rng(seed)
+    indices = rng.choice(dataset_size, min(num_images, dataset_size), replace=False).tolist()
+
+    # resume from the images already done
+    aggregate = RunningDiffusion()
+    done = set()
+    if os.path.exists(results_path):
+        with open(results_path) as f:
+            for line in f:
+                result = json.loads(line)
+                if result['index'] in indices and result['index'] not in done:
+                    done.add(result['index'])
+                    aggregate.update(result['diffusion'])
+    todo = [i for i in indices if i not in done]
+    print(f'{len(done)} images already done, computing saliency maps of {len(todo)} images')
+
+    init_args = (model_name, dset, data_dir, split, img_size, normalisation, hist_norm, device, threads_per_process,
+                 saliency_kwargs, heatmap_dir)
+    if num_processes > 1:
+        pool = mp.get_context('spawn').Pool(num_processes, initializer=_init_worker, initargs=init_args)
+        results = pool.imap_unordered(_diffusion_worker, todo)
+    else:
+        pool = None
+        _init_worker(*init_args)
+        results = map(_diffusion_worker, todo)
+
+    with open(results_path, 'a') as f:
+        for index, diffusion in tqdm(results, total=len(todo), desc=f'Saliency maps of {dataset}'):
+            f.write(json.dumps({'index': index, 'diffusion': float(diffusion)}) + '\n')
+            f.flush()
+            aggregate.update(diffusion)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    summary = aggregate.summary()
+    with open(os.path.join(outpath_base, f'diffusion_{run_name}_summary.json'), 'w') as f:
+        json.dump(summary, f, indent=4)
+    return summary
+
+
 def crop(img, img_size):
     """ Apply center crop."""
     crop = transforms.CenterCrop(img_size)
@@ -122,6 +628,19 @@ def crop(img, img_size):
 
 
 
+SALIENCY_DATASETS = {
+    'shenzhencxr': [CustomShenzhenCXRDataset, './data/shenzhencxr'],
+    'montgomerycxr': [CustomMontgomeryCXRDataset, './data/montgomerycxr'],
+    'diabetic_retinopathy' : [CustomDiabeticRetinopathyDataset, './data/diabetic_retinopathy'],
+    'chexpert' : [CustomChexpertDataset, './data/chexpert'],
+    'bach' : [CustomBachDataset, './data/bach'],
+    'ichallenge_amd' : [CustomiChallengeAMDDataset, './data/ichallenge_amd'],
+    'ichallenge_pm' : [CustomiChallengePMDataset, './data/ichallenge_pm'],
+    'stoic': [CustomStoicDataset, './data/stoic'],
+    'chestx' : [CustomChestXDataset, './data/chestx'],
+}
+
+
 # dataset: {image_name, image_path}
 IMAGES = {
     'bach' : ['iv001.tif', './sample_images/bach/iv001.tif'],
@@ -147,7 +666,49 @@ if __name__ == "__main__":
     parser.add_argument('-n', '--no-norm', action='store_true', default=False,
                         help='whether to turn off data normalisation (based on ImageNet values)')
     parser.add_argument('--device', type=str, default='cuda', help='CUDA or CPU training (cuda | cpu)')
+    parser.add_argument('--window-size', type=int, default=10, help='the size of the occlusion window')
+    parser.add_argument('--stride', type=int, default=1, help='the step between two occlusion windows')
+    parser.add_argument('-b', '--batch-size', type=int, default=None,
+                        help='number of occluded images per forward pass (default: set from the memory budget)')
+    parser.add_argument('--memory-budget', type=float, default=1024,
+                        help='memory (MB) available for the activations of a forward pass of occluded images')
+    parser.add_argument('--incremental', action='store_true', default=False,
+                        help='whether to only recompute the receptive field of each occlusion window from cached activations')
+    parser.add_argument('--eval-bn', action='store_true', default=False,
+                        help='whether batch norm uses its running statistics (required by --incremental) instead of '
+                             'normalising each image with its own statistics as the training-mode backbones do')
+    parser.add_argument('--adaptive', action='store_true', default=False,
+                        help='whether to score a coarse grid of windows and only refine the salient regions')
+    parser.add_argument('--coarse-stride', type=int, default=8, help='the step between two windows of the coarse grid')
+    parser.add_argument('--refine-quantile', type=float, default=0.75,
+                        help='quantile of the coarse scores (or gradients) above which regions are refined')
+    parser.add_argument('--refine-by', type=str, default='score', help='criterion for refinement (score | gradient)')
+    parser.add_argument('--num-validation', type=int, default=64,
+                        help='number of held-out windows scored exactly to estimate the error of the adaptive map')
+    parser.add_argument('--validate-adaptive', action='store_true', default=False,
+                        help='whether to also compute the exhaustive map and report the error of the adaptive one')
+    parser.add_argument('--method', type=str, default='occlusion',
+                        help='saliency method (occlusion | grad_input | integrated_gradients | smoothgrad)')
+    parser.add_argument('--steps', type=int, default=32,
+                        help='number of interpolation steps (integrated_gradients) or noisy samples (smoothgrad)')
+    parser.add_argument('--noise-level', type=float, default=0.15, help='noise std relative to the image range (smoothgrad)')
+    parser.add_argument('--benchmark', action='store_true', default=False,
+                        help='whether to report the wall time and rank correlation with the occlusion map of the gradient methods')
+    parser.add_argument('--num-images', type=int, default=None,
+                        help='number of dataset images to compute the attentive diffusion distribution over (default: the sample image only)')
+    parser.add_argument('--split', type=str, default='test', help='dataset split to sample images from (train | test)')
+    parser.add_argument('--num-processes', type=int, default=1, help='number of processes computing saliency maps')
+    parser.add_argument('--threads-per-process', type=int, default=1, help='number of threads of each process')
+    parser.add_argument('--save-heatmaps', action='store_true', default=False,
+                        help='whether to save the saliency maps of the dataset images (compressed .npz)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for sampling the dataset images')
     args = parser.parse_args()
+    if args.num_images is not None:
+        unknown = [dataset for dataset in args.datasets if dataset not in SALIENCY_DATASETS]
+        if unknown:
+            parser.error(f'--num-images is not available for {", ".join(unknown)} (no dataset loader, only a sample image)')
+    if args.incremental and not args.eval_bn:
+        parser.error('--incremental requires --eval-bn (batch norm with running statistics)')
     args.norm = not args.no_norm
     pprint(args)
 
@@ -157,25 +718,10 @@ if __name__ == "__main__":
         hist_norm = True
 
 
-    # load pretrained model
-    if args.model in ['mimic-chexpert_lr_0.1', 'mimic-chexpert_lr_0.01', 'mimic-chexpert_lr_1.0', 'supervised_d121']:
-        model = DenseNetBackbone(args.model)
-        feature_dim = 1024
-    elif 'mimic-cxr' in args.model:
-        if 'r18' in args.model:
-            model = ResNet18Backbone(args.model)
-            feature_dim = 512
-        else:
-            model = DenseNetBackbone(args.model)
-            feature_dim = 1024
-    elif args.model == 'supervised_r18':
-        model = ResNet18Backbone(args.model)
-        feature_dim = 512
-    else:
-        model = ResNetBackbone(args.model)
-        feature_dim = 2048
-    
-    model = model.to(args.device)
+    # load pretrained model (loaded by each worker process for dataset-level runs)
+    if args.num_images is None:
+        model, feature_dim = load_backbone(args.model)
+        model = model.to(args.device)
 
 
     # set-up logging
@@ -195,6 +741,35 @@ if __name__ == "__main__":
 
             stoic = dataset == 'stoic'
 
+            if args.num_images is not None:
+                if args.method != 'occlusion':
+                    saliency_kwargs = {'method': args.method, 'size': args.window_size, 'steps': args.steps,
+                                       'noise_level': args.noise_level, 'batch_size': args.batch_size or 16,
+                                       'eval_bn': args.eval_bn}
+                else:
+                    saliency_kwargs = {'method': 'occlusion', 'size': args.window_size, 'batch_size': args.batch_size,
+                                       'memory_budget': args.memory_budget, 'incremental': args.incremental,
+                                       'eval_bn': args.eval_bn, 'adaptive': args.adaptive}
+                    if args.adaptive:
+                        # no held-out windows, the error estimate is not reported in dataset mode
+                        saliency_kwargs.update({'coarse_stride': args.coarse_stride,
+                                                'refine_quantile': args.refine_quantile, 'refine_by': args.refine_by,
+                                                'num_validation': 0})
+                    else:
+                        saliency_kwargs['stride'] = args.stride
+                summary = dataset_attentive_diffusion(
+                    args.model, dataset, args.num_images, split=args.split, img_size=args.image_size,
+                    normalisation=args.norm, hist_norm=hist_norm, device=args.device,
+                    num_processes=args.num_processes, threads_per_process=args.threads_per_process,
+                    save_heatmaps=args.save_heatmaps, seed=args.seed, saliency_kwargs=saliency_kwargs)
+                low, high = summary['ci95']
+                print(f'Attentive diffusion on dataset {dataset} with model {args.model} over {summary["n"]} images: '
+                      f'{summary["mean"]:.2f}% (95% CI {low:.2f}-{high:.2f}%)')
+                logging.info(f'Attentive diffusion on dataset {dataset} with model {args.model} over {summary["n"]} images: '
+                             f'{summary["mean"]:.2f}% (95% CI {low:.2f}-{high:.2f}%)')
+                logging.info(f'Histogram (bin edges {summary["bin_edges"]}): {summary["histogram"]}')
+                continue
+
             image_name, image_path = IMAGES[dataset]
 
 
@@ -206,7 +781,48 @@ if __name__ == "__main__":
             out_super = os.path.join(outpath_base, 'superimposed.png')
 
             img, normalized_img = obtain_and_pre_process_img(image_path, args.image_size, args.norm, hist_norm, stoic)
-            saliency_map = compute_saliency_map(normalized_img, model, args.device)
+            saliency_kwargs = {'size': args.window_size, 'batch_size': args.batch_size,
+                               'memory_budget': args.memory_budget, 'incremental': args.incremental,
+                               'eval_bn': args.eval_bn}
+            gradient_kwargs = {'size': args.window_size, 'steps': args.steps, 'noise_level': args.noise_level,
+                               'batch_size': args.batch_size or 16, 'eval_bn': args.eval_bn}
+            if args.benchmark:
+                results = benchmark_gradient_saliency(normalized_img, model, args.device,
+                                                      ['grad_input', 'integrated_gradients', 'smoothgrad'],
+                                                      dict(saliency_kwargs, stride=args.stride), gradient_kwargs)
+                with open(os.path.join(outpath_base, 'benchmark.json'), 'w') as f:
+                    json.dump(results, f, indent=4)
+                for method, result in results.items():
+                    print(f'Benchmark on dataset {dataset} with model {args.model}, {method}: {result["time"]:.1f}s, '
+                          f'rank correlation {result["rank_correlation"]:.3f}, '
+                          f'attentive diffusion {result["attentive_diffusion"]:.2f}%')
+                    logging.info(f'Benchmark on dataset {dataset} with model {args.model}, {method}: {result["time"]:.1f}s, '
+                                 f'rank correlation {result["rank_correlation"]:.3f}, '
+                                 f'attentive diffusion {result["attentive_diffusion"]:.2f}%')
+
+            if args.method != 'occlusion':
+                saliency_map = compute_gradient_saliency_map(normalized_img, model, args.device, method=args.method,
+                                                             **gradient_kwargs)
+            elif args.adaptive:
+                saliency_map, info = compute_adaptive_saliency_map(
+                    normalized_img, model, args.device, coarse_stride=args.coarse_stride,
+                    refine_quantile=args.refine_quantile, refine_by=args.refine_by,
+                    num_validation=args.num_validation, seed=args.seed, **saliency_kwargs)
+                message = (f'Adaptive saliency on dataset {dataset}: {info["forwards"]}/{info["exhaustive"]} forwards '
+                           f'({info["evaluated"]} for the map, {info["validation"]} held out, '
+                           f'{1 / info["forward_fraction"]:.1f}x fewer than exhaustive)')
+                if info['estimated_error'] is not None:
+                    message += f', estimated relative error {info["estimated_error"]:.4f}'
+                print(message)
+                logging.info(message)
+                if args.validate_adaptive:
+                    exhaustive_map = compute_saliency_map(normalized_img, model, args.device, **saliency_kwargs)
+                    error = relative_error(saliency_map, exhaustive_map)
+                    diffusion_error = attentive_diffusion(saliency_map) - attentive_diffusion(exhaustive_map)
+                    print(f'Relative error against the exhaustive map: {error:.4f}, attentive diffusion error: {diffusion_error:.2f}%')
+                    logging.info(f'Relative error against the exhaustive map: {error:.4f}, attentive diffusion error: {diffusion_error:.2f}%')
+            else:
+                saliency_map = compute_saliency_map(normalized_img, model, args.device, stride=args.stride, **saliency_kwargs)
             
             cropped_img = crop(img, args.crop_size)
             permuted_img = cropped_img.permute((1, 2, 0))
@@ -219,10 +835,9 @@ if __name__ == "__main__":
             plt.imsave(out_heat, saliency_map, cmap='jet')
 
             # calculate attentative diffusion (percentage of attention map with values about its mean)
-            mean_attention = np.mean(saliency_map)
-            attentive_diffusion = 100 * (saliency_map > mean_attention).sum() / np.prod(saliency_map.size)
-            print(f'Attentive diffusion on dataset {dataset} with model {args.model}: {attentive_diffusion:.2f}%')
-            logging.info(f'Attentive diffusion on dataset {dataset} with model {args.model}: {attentive_diffusion:.2f}%')
+            diffusion = attentive_diffusion(saliency_map)
+            print(f'Attentive diffusion on dataset {dataset} with model {args.model}: {diffusion:.2f}%')
+            logging.info(f'Attentive diffusion on dataset {dataset} with model {args.model}: {diffusion:.2f}%')
 
     
     
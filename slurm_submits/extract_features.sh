@@ -0,0 +1,16 @@
+#!/bin/bash
+#SBATCH --gres=gpu:1
+#SBATCH --output=/vol/bitbucket/g21mscprj03/SSL/out/extract_features/%j.out
+
+
+export PATH=/vol/bitbucket/g21mscprj03/sslvenv/bin/:$PATH
+source activate
+source /vol/cuda/11.0.3-cudnn8.0.5.39/setup.sh
+TERM=vt100  # TERM=xterm
+/usr/bin/nvidia-smi
+uptime
+
+cd /vol/bitbucket/g21mscprj03/SSL
+
+dset=chexpert
+python extract_features.py -d $dset --no-norm --batch-size 16 -m simclr-v1 moco-v2 swav byol pirl supervised_r50 supervised_r18 supervised_d121 mimic-chexpert_lr_0.01 mimic-chexpert_lr_0.1 mimic-chexpert_lr_1.0 mimic-cxr_r18_lr_1e-4 mimic-cxr_d121_lr_1e-4
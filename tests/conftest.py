@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+import torch
+from torchvision import models
+
+# the tests import the scripts of the repository root (linear.py, saliency.py, ...)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def model_dir(tmp_path, monkeypatch):
+    """Empty ./models directory (the backbones and the feature store read ./models/<model_name>.pth)."""
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('models')
+    return tmp_path / 'models'
+
+
+@pytest.fixture
+def resnet18_backbone(model_dir):
+    """ResNet18Backbone with random weights (in training mode, as loaded by the scripts)."""
+    from models.backbones import ResNet18Backbone
+
+    torch.manual_seed(0)
+    model = models.resnet18()
+    del model.fc
+    torch.save(model.state_dict(), model_dir / 'random_r18.pth')
+    return ResNet18Backbone('random_r18')
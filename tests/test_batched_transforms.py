@@ -0,0 +1,112 @@
+import pytest
+import torch
+import torchvision.transforms.functional as FT
+from torchvision.transforms import InterpolationMode
+
+import invariances.batched_transforms as BT
+
+
+K = 4
+
+
+def _views(dtype=torch.float32, size=32):
+    torch.manual_seed(0)
+    img = torch.rand(3, size, size)
+    if dtype == torch.uint8:
+        img = (img * 255).to(torch.uint8)
+    return img, img.unsqueeze(0).expand(K, -1, -1, -1)
+
+
+def _reference(img, fn, params):
+    """Apply the torchvision functional op to the image once per view."""
+    return torch.stack([fn(img, **{name: values[i] for name, values in params.items()}) for i in range(K)])
+
+
+@pytest.mark.parametrize('name, fn, params', [
+    ('adjust_brightness', FT.adjust_brightness, {'brightness_factor': [0.25, 0.8, 1.5, 5.]}),
+    ('adjust_contrast', FT.adjust_contrast, {'contrast_factor': [0.25, 0.8, 1.5, 5.]}),
+    ('adjust_saturation', FT.adjust_saturation, {'saturation_factor': [0.25, 0.8, 1.5, 5.]}),
+    ('adjust_hue', FT.adjust_hue, {'hue_factor': [-0.5, -0.1, 0.2, 0.5]}),
+    ('adjust_sharpness', FT.adjust_sharpness, {'sharpness_factor': [1., 2., 10., 30.]}),
+])
+def test_colour_ops_match_torchvision(name, fn, params):
+    img, views = _views()
+    expected = _reference(img, fn, params)
+    torch.testing.assert_close(getattr(BT, name)(views, **params), expected, rtol=1e-5, atol=1e-5)
+
+
+def test_gaussian_blur_matches_torchvision():
+    img, views = _views()
+    sigma, kernel_size = [1e-5, 1., 3., 20.], [7] * K
+    expected = torch.stack([FT.gaussian_blur(img, [k, k], [s, s]) for s, k in zip(sigma, kernel_size)])
+    torch.testing.assert_close(BT.gaussian_blur(views, sigma, kernel_size), expected, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('name, fn', [
+    ('hflip', FT.hflip), ('vflip', FT.vflip), ('invert', FT.invert),
+    ('rgb_to_grayscale', lambda img: FT.rgb_to_grayscale(img, num_output_channels=3)),
+])
+def test_optional_ops_match_torchvision(name, fn):
+    img, views = _views()
+    aug = [False, True, False, True]
+    kwargs = {'num_output_channels': [3] * K} if name == 'rgb_to_grayscale' else {}
+    expected = torch.stack([fn(img) if a else img for a in aug])
+    torch.testing.assert_close(getattr(BT, name)(views, aug, **kwargs), expected, rtol=1e-6, atol=1e-6)
+
+
+def test_uint8_ops_match_torchvision():
+    img, views = _views(torch.uint8)
+    bits = [1, 3, 5, 7]
+    assert torch.equal(BT.posterize(views, bits), torch.stack([FT.posterize(img, b) for b in bits]))
+    aug = [False, True, True, False]
+    assert torch.equal(BT.equalize(views, aug), torch.stack([FT.equalize(img) if a else img for a in aug]))
+
+
+def _mismatch_fraction(a, b, tol=1e-6):
+    return ((a - b).abs() > tol).float().mean().item()
+
+
+def test_rotate_matches_torchvision():
+    img, views = _views()
+    angle = [0., 30., 90., 200.]
+    expected = torch.stack([FT.rotate(img, a, interpolation=InterpolationMode.NEAREST) for a in angle])
+    # nearest neighbour sampling may round a few pixels on the other side
+    assert _mismatch_fraction(BT.rotate(views, angle), expected) < 0.01
+
+
+def test_affine_matches_torchvision():
+    img, views = _views()
+    angle, translate, scale = [0., 10., 0., 0.], [(0., 0.), (0., 0.), (3., -5.), (0., 0.)], [1., 1., 1., 0.5]
+    shear = [0., 0., 0., (20., -10.)]
+    expected = torch.stack([
+        FT.affine(img, a, list(t), s, list(sh) if isinstance(sh, tuple) else sh, interpolation=InterpolationMode.NEAREST)
+        for a, t, s, sh in zip(angle, translate, scale, shear)
+    ])
+    assert _mismatch_fraction(BT.affine(views, angle, translate, scale, shear), expected) < 0.01
+
+
+def test_resized_crop_matches_torchvision():
+    img, views = _views()
+    top, left, height, width = [0, 4, 8, 2], [0, 6, 2, 10], [32, 20, 24, 22], [32, 24, 20, 22]
+    size = [(32, 32)] * K
+    out = BT.resized_crop(views, top, left, height, width, size)
+    expected = torch.stack([FT.resized_crop(img, t, l, h, w, list(s), antialias=False)
+                            for t, l, h, w, s in zip(top, left, height, width, size)])
+    # the outer pixels of an upsampled crop interpolate with the pixels next to the box instead of clamping to it
+    torch.testing.assert_close(out[..., 1:-1, 1:-1], expected[..., 1:-1, 1:-1], rtol=1e-5, atol=1e-5)
+
+
+def test_elastic_deform_is_seeded():
+    img, views = _views()
+    sigma, seed = [10, 20, 30, 50], [0, 1, 2, 3]
+    out = BT.elastic_deform(views, sigma, seed)
+    torch.testing.assert_close(BT.elastic_deform(views, sigma, seed), out)
+    # each view only depends on its own parameters
+    torch.testing.assert_close(BT.elastic_deform(views[2:3], sigma[2:3], seed[2:3]), out[2:3])
+    assert not torch.allclose(BT.elastic_deform(views, sigma, [4, 5, 6, 7]), out)
+
+
+def test_elastic_deform_without_displacement_is_identity():
+    img, views = _views()
+    out = BT.elastic_deform(views, [10] * K, list(range(K)), alpha=0., alpha_affine=0.)
+    torch.testing.assert_close(out, views, rtol=1e-4, atol=1e-4)
@@ -0,0 +1,55 @@
+import numpy as np
+import torch
+
+from invariances.feature_statistics import (FeatureStatistics, merge_shard_statistics, covariance_cholesky, whiten,
+                                            mahalanobis)
+
+
+def _features(n=500, dim=8, seed=0):
+    rng = np.random.default_rng(seed)
+    # correlated features with a large mean, where the naive sum of squares loses precision
+    return rng.normal(size=(n, dim)) @ rng.normal(size=(dim, dim)) + 1e3
+
+
+def test_streaming_statistics_match_numpy():
+    features = _features()
+    stats = FeatureStatistics(features.shape[1])
+    for batch in np.array_split(features, 13):
+        stats.update(torch.from_numpy(batch))
+    assert stats.n == len(features)
+    np.testing.assert_allclose(stats.mean.numpy(), features.mean(axis=0), rtol=1e-12)
+    np.testing.assert_allclose(stats.covariance.numpy(), np.cov(features, rowvar=False), rtol=1e-9, atol=1e-9)
+
+
+def test_merged_shards_match_single_pass(tmp_path):
+    features = _features()
+    full = FeatureStatistics(features.shape[1])
+    full.update(torch.from_numpy(features))
+
+    shard_paths = [str(tmp_path / f'shard{i}.pth') for i in range(3)]
+    for i, path in enumerate(shard_paths):
+        shard = FeatureStatistics(features.shape[1])
+        for batch in np.array_split(features[i::3], 4):
+            shard.update(torch.from_numpy(batch))
+        torch.save(shard.state_dict(), path)
+        # incomplete until every shard exists
+        assert (merge_shard_statistics(shard_paths) is None) == (i < 2)
+
+    merged = merge_shard_statistics(shard_paths)
+    assert merged.n == full.n
+    torch.testing.assert_close(merged.mean, full.mean)
+    torch.testing.assert_close(merged.covariance, full.covariance)
+
+
+def test_whitened_mahalanobis_matches_inverse():
+    features = _features(dim=5)
+    cov = np.cov(features, rowvar=False)
+    cholesky_matrix = covariance_cholesky(cov, epsilon=1e-6)
+    inverse = np.linalg.inv(cov + 1e-6 * np.eye(5))
+
+    x, y = torch.from_numpy(features[:10]), torch.from_numpy(features[10:20])
+    expected = np.sqrt(np.einsum('ij,jk,ik->i', (x - y).numpy(), inverse, (x - y).numpy()))
+    np.testing.assert_allclose(mahalanobis(x, y, cholesky_matrix).numpy(), expected, rtol=1e-8)
+    # inner products of the whitened vectors are x^T cov^-1 y
+    np.testing.assert_allclose((whiten(x, cholesky_matrix) @ whiten(y, cholesky_matrix).T).numpy(),
+                               x.numpy() @ inverse @ y.numpy().T, rtol=1e-6)
@@ -0,0 +1,50 @@
+import numpy as np
+from torchvision import transforms
+
+from datasets.feature_store import FeatureStore
+
+
+def _store(model_dir, tmp_path):
+    (model_dir / 'random.pth').write_bytes(b'weights')
+    return FeatureStore(str(tmp_path / 'features'))
+
+
+def test_save_load_round_trip(model_dir, tmp_path):
+    store = _store(model_dir, tmp_path)
+    key = store.key('random', 'chexpert', 'train', transforms.ToTensor(), dtype='float16')
+    assert store.load(key) is None
+
+    features = np.random.default_rng(0).normal(size=(10, 4))
+    labels = np.arange(10)
+    store.save(key, features, labels)
+    loaded_features, loaded_labels = store.load(key)
+    np.testing.assert_array_equal(loaded_features, features.astype(np.float16))
+    np.testing.assert_array_equal(loaded_labels, labels)
+
+
+def test_allocate_in_place(model_dir, tmp_path):
+    store = _store(model_dir, tmp_path)
+    key = store.key('random', 'chexpert', 'test', transforms.ToTensor())
+    features = store.allocate(key, (6, 3))
+    # not complete until saved
+    assert store.load(key) is None
+    features[:] = np.arange(18).reshape(6, 3)
+    store.save(key, features, np.zeros(6, dtype=int))
+    np.testing.assert_array_equal(store.load(key)[0], np.arange(18).reshape(6, 3))
+
+
+def test_keys_separate_settings(model_dir, tmp_path):
+    """ Features are never shared between transforms, subsets, image caches or source data """
+    store = _store(model_dir, tmp_path)
+    base = dict(model_name='random', dataset='chexpert', split='train', transform=transforms.ToTensor())
+    keys = [
+        store.key(**base),
+        store.key(**dict(base, transform=transforms.Compose([transforms.Resize(224), transforms.ToTensor()]))),
+        store.key(**base, indices=[0, 1, 2]),
+        store.key(**base, image_cache=224),
+        store.key(**base, source='fingerprint'),
+        store.key(**base, dtype='float16'),
+    ]
+    assert len(set(store.path(key) for key in keys)) == len(keys)
+    # the order of the indices does not matter
+    assert store.key(**base, indices=[2, 0, 1]) == store.key(**base, indices=[0, 1, 2])
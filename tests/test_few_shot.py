@@ -0,0 +1,32 @@
+import torch
+import torch.nn as nn
+
+from few_shot import euclidean_dist, batched_euclidean_dist, ProtoNet
+
+
+def _episodes(n_episodes=6, n_class=5, n_support=3, n_query=4, z_dim=32):
+    torch.manual_seed(0)
+    # class-dependent offsets, so both correct and wrong predictions occur
+    offsets = torch.randn(n_episodes, n_class, 1, z_dim)
+    zs = offsets + torch.randn(n_episodes, n_class, n_support, z_dim) * 2
+    zq = offsets + torch.randn(n_episodes, n_class, n_query, z_dim) * 2
+    return zs.double(), zq.double()
+
+
+def test_batched_dist_matches_euclidean_dist():
+    torch.manual_seed(0)
+    x, y = torch.randn(4, 20, 64).double(), torch.randn(4, 7, 64).double()
+    expected = torch.stack([euclidean_dist(x_e, y_e) for x_e, y_e in zip(x, y)])
+    torch.testing.assert_close(batched_euclidean_dist(x, y), expected)
+    # identical points are at distance zero, not slightly negative
+    assert (batched_euclidean_dist(x, x) >= 0).all()
+
+
+def test_batched_loss_matches_per_episode_loss():
+    zs, zq = _episodes()
+    protonet = ProtoNet(nn.Identity())
+    loss, acc = protonet.batched_loss_from_embeddings(zs, zq)
+    expected = [protonet.loss_from_embeddings(zs_e, zq_e) for zs_e, zq_e in zip(zs, zq)]
+    torch.testing.assert_close(loss, torch.stack([l for l, _ in expected]))
+    torch.testing.assert_close(acc, torch.stack([a for _, a in expected]).to(acc.dtype))
+    assert 0 < acc.mean() < 1
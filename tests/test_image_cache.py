@@ -0,0 +1,77 @@
+import os
+
+import numpy as np
+import PIL
+import pytest
+from PIL import Image
+from torchvision import transforms
+
+from datasets.image_cache import CachedImageDataset, build_image_cache
+
+
+class _RandomImageDataset(CachedImageDataset):
+    """Random PNG images of different shapes, read through the image cache when `cache_size` is given."""
+
+    def __init__(self, root, cache_size=None, cache_dir=None):
+        self.root = root
+        self.shapes = [(40, 30), (25, 50), (33, 33), (64, 20)]
+        self.init_image_cache(root, cache_size, cache_dir)
+
+    def image_path(self, idx):
+        return os.path.join(self.root, 'images', f'{idx}.png')
+
+    def __getitem__(self, idx):
+        return self.load_image(self.image_path(idx))
+
+    def __len__(self):
+        return len(self.shapes)
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    root = tmp_path / 'data'
+    (root / 'images').mkdir(parents=True)
+    dataset = _RandomImageDataset(str(root))
+    rng = np.random.default_rng(0)
+    for i, shape in enumerate(dataset.shapes):
+        Image.fromarray(rng.integers(256, size=shape + (3,), dtype=np.uint8)).save(dataset.image_path(i))
+    return dataset
+
+
+def test_cached_images_match_resized_originals(dataset, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    # small shards, so the images are spread over several of them
+    num_images = build_image_cache([dataset], dataset.root, cache_dir, sizes=(16, 24), shard_bytes=3000,
+                                   num_workers=0)
+    assert num_images == len(dataset)
+
+    for size in (16, 24):
+        cached = _RandomImageDataset(dataset.root, size, cache_dir)
+        resize = transforms.Resize(size, interpolation=PIL.Image.BICUBIC)
+        for i in range(len(dataset)):
+            np.testing.assert_array_equal(np.asarray(cached[i]), np.asarray(resize(dataset[i])))
+        assert len(cached.image_cache.shards) > 1
+
+
+def test_missing_image_raises(dataset, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    build_image_cache([dataset], dataset.root, cache_dir, sizes=(16,), num_workers=0)
+    cached = _RandomImageDataset(dataset.root, 16, cache_dir)
+    with pytest.raises(KeyError):
+        cached.load_image(os.path.join(dataset.root, 'images', 'missing.png'))
+    with pytest.raises(FileNotFoundError):
+        _RandomImageDataset(dataset.root, 32, cache_dir)
+
+
+def test_rebuild_replaces_cache(dataset, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    build_image_cache([dataset], dataset.root, cache_dir, sizes=(16,), num_workers=0)
+    old = _RandomImageDataset(dataset.root, 16, cache_dir)
+    old_image = np.asarray(old[0])
+
+    Image.fromarray(np.zeros((40, 30, 3), dtype=np.uint8)).save(dataset.image_path(0))
+    build_image_cache([dataset], dataset.root, cache_dir, sizes=(16,), num_workers=0)
+    assert sorted(os.listdir(os.path.join(cache_dir, '_RandomImageDataset'))) == ['16']
+    assert not np.asarray(_RandomImageDataset(dataset.root, 16, cache_dir)[0]).any()
+    # a cache opened before the rebuild keeps reading the old images
+    np.testing.assert_array_equal(np.asarray(old[0]), old_image)
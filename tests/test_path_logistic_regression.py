@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+import torch
+from sklearn.linear_model import LogisticRegression as LogReg
+
+from linear import PathLogisticRegression
+
+
+def _random_problem(n=300, dim=20, num_classes=3, seed=0):
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(num_classes, dim))
+    y = rng.integers(num_classes, size=n)
+    X = (centres[y] + rng.normal(scale=2., size=(n, dim))).astype(np.float32)
+    return X, y
+
+
+@pytest.mark.parametrize('C', [1e-3, 1e-1, 1e1, 1e3])
+def test_fit_matches_sklearn(C):
+    """ Each C of the path solves the same problem as sklearn's multinomial L-BFGS """
+    X, y = _random_problem()
+    clf = LogReg(C=C, max_iter=10000, tol=1e-10).fit(X, y)
+
+    path = PathLogisticRegression(X.shape[1], 3, 'accuracy', max_iter=1000, tol=1e-6)
+    W, b, converged = path._fit(torch.from_numpy(X), torch.from_numpy(y), C,
+                                torch.zeros(X.shape[1], 3), torch.zeros(3))
+    assert converged
+    proba = torch.softmax(torch.from_numpy(X) @ W + b, dim=-1).numpy()
+    np.testing.assert_allclose(proba, clf.predict_proba(X), atol=2e-3)
+
+
+def test_path_scores_match_sklearn():
+    """ Test scores of the warm-started path match independent sklearn fits """
+    X, y = _random_problem(n=400)
+    X_train, y_train, X_test, y_test = X[:300], y[:300], X[300:], y[300:]
+    Cs = np.logspace(-3, 3, 7).tolist()
+
+    for metric in ['accuracy', 'mean per-class accuracy']:
+        path = PathLogisticRegression(X.shape[1], 3, metric, max_iter=1000, tol=1e-6)
+        scores = path.fit_logistic_regression_path(Cs, X_train, y_train, X_test, y_test)
+        for C, score in zip(Cs, scores):
+            pred = LogReg(C=C, max_iter=10000, tol=1e-10).fit(X_train, y_train).predict(X_test)
+            if metric == 'accuracy':
+                expected = 100. * (pred == y_test).mean()
+            else:
+                expected = 100. * np.mean([(pred[y_test == c] == c).mean() for c in np.unique(y_test)])
+            # at most one test sample may fall on the other side of a decision boundary
+            assert abs(score - expected) <= 100. / len(y_test) + 1e-6
+
+
+def test_thread_count_restored():
+    X, y = _random_problem(n=50)
+    num_threads = torch.get_num_threads()
+    path = PathLogisticRegression(X.shape[1], 3, 'accuracy', num_threads=1)
+    path.fit_logistic_regression_path([1.], X, y, X, y)
+    assert torch.get_num_threads() == num_threads
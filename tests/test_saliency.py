@@ -0,0 +1,74 @@
+import numpy as np
+import torch
+
+from saliency import occlusion_positions, occlusion_window_scores, compute_saliency_map, compute_adaptive_saliency_map
+
+
+def _reference_saliency_map(img, model, size=10, value=0):
+    """Occlusion saliency with one forward pass per window, as the original implementation."""
+    occlusion_scores = np.zeros((img.size(1), img.size(2)))
+    with torch.no_grad():
+        orig_feature = model(img.unsqueeze(0)).squeeze(0).numpy()
+        orig_feature_mag = np.sqrt((orig_feature**2).sum())
+        for i in range(1 + img.size(1) - size):
+            for j in range(1 + img.size(2) - size):
+                img_occluded = img.clone()
+                img_occluded[:, i:i+size, j:j+size] = value
+                occluded_feature = model(img_occluded.unsqueeze(0)).squeeze(0).numpy()
+                occlusion_scores[i:i+size, j:j+size] += np.sqrt(((orig_feature - occluded_feature)**2).sum()) / orig_feature_mag
+    occlusion_scores /= size**2
+    return occlusion_scores[size-1:img.size(1)-size+1, size-1:img.size(2)-size+1]
+
+
+def _image(size=40):
+    torch.manual_seed(1)
+    return torch.randn(3, size, size)
+
+
+def test_batched_map_matches_one_forward_per_window(resnet18_backbone):
+    """ Batched occlusion (training-mode batch norm, per image) reproduces the single-image forward passes """
+    img = _image()
+    reference = _reference_saliency_map(img, resnet18_backbone, size=12)
+    saliency_map = compute_saliency_map(img, resnet18_backbone, 'cpu', size=12, batch_size=7)
+    np.testing.assert_allclose(saliency_map, reference, rtol=1e-4, atol=1e-6)
+    # batch norm layers are restored afterwards
+    assert all('forward' not in vars(m) for m in resnet18_backbone.modules())
+
+
+def test_batch_size_does_not_change_scores(resnet18_backbone):
+    img = _image()
+    rows, cols = occlusion_positions(40, 40, 10, 3)
+    for eval_bn in [False, True]:
+        one = occlusion_window_scores(img, resnet18_backbone, 'cpu', rows, cols, batch_size=1, eval_bn=eval_bn)
+        many = occlusion_window_scores(img, resnet18_backbone, 'cpu', rows, cols, batch_size=16, eval_bn=eval_bn)
+        torch.testing.assert_close(many, one, rtol=1e-4, atol=1e-6)
+    assert resnet18_backbone.model.training
+
+
+def test_incremental_matches_full_occlusion(resnet18_backbone):
+    """ Recomputing only the receptive field of each window gives the scores of full forward passes """
+    img = _image(48)
+    rows, cols = occlusion_positions(48, 48, 10, 2)
+    full = occlusion_window_scores(img, resnet18_backbone, 'cpu', rows, cols, batch_size=32, eval_bn=True)
+    incremental = occlusion_window_scores(img, resnet18_backbone, 'cpu', rows, cols, batch_size=32, eval_bn=True,
+                                          incremental=True)
+    torch.testing.assert_close(incremental, full, rtol=1e-4, atol=1e-5)
+
+
+def test_adaptive_map_refined_everywhere_is_exhaustive(resnet18_backbone):
+    """ Refining every cell down to stride 1 scores every window, so the map is the exhaustive one """
+    img = _image()
+    exhaustive = compute_saliency_map(img, resnet18_backbone, 'cpu', size=10, batch_size=64)
+    adaptive, info = compute_adaptive_saliency_map(img, resnet18_backbone, 'cpu', size=10, coarse_stride=8,
+                                                   refine_quantile=0., num_validation=0, batch_size=64)
+    assert info['evaluated'] == info['exhaustive']
+    np.testing.assert_allclose(adaptive, exhaustive, rtol=1e-6, atol=1e-9)
+
+
+def test_adaptive_error_estimate_and_savings(resnet18_backbone):
+    img = _image(64)
+    adaptive, info = compute_adaptive_saliency_map(img, resnet18_backbone, 'cpu', size=10, coarse_stride=8,
+                                                   num_validation=32, batch_size=64)
+    assert info['forwards'] == info['evaluated'] + info['validation'] < info['exhaustive']
+    assert np.isfinite(info['estimated_error']) and info['estimated_error'] >= 0
+    assert adaptive.shape == (64 - 18, 64 - 18)